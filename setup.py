@@ -29,6 +29,8 @@ setup(name='tileserver',
       entry_points=dict(
           console_scripts=[
               'tileserver = tileserver:main',
+              'tileserver-invalidate = tileserver.invalidate:main',
+              'tileserver-simulate = tileserver.simulate:main',
           ]
       )
       )
@@ -122,13 +122,36 @@ class FileCacheTests(unittest.TestCase):
         os.remove(key)
         clean_empty_parent_dirs(os.path.dirname(key))
 
+    def test_set_chunks(self):
+        import os
+        from ModestMaps.Core import Coordinate
+        from tileserver.cache import CacheKey, FileCache, \
+            clean_empty_parent_dirs
+        from tilequeue.format import lookup_format_by_extension
+
+        coord = Coordinate(zoom=0, column=0, row=0)
+        fmt = lookup_format_by_extension('json')
+        cache_key = CacheKey(coord, 1, 'all', fmt)
+
+        c = FileCache('foo')
+        c.set_chunks(cache_key, ['{', '"water":{}', '}'])
+        self.assertEquals('{"water":{}}', c.get(cache_key))
+
+        key = c._generate_key('data', cache_key)
+        os.remove(key)
+        clean_empty_parent_dirs(os.path.dirname(key))
+
 
 class MockRedis(object):
     def __init__(self):
         self._data = {}
+        self.round_trips = 0
 
-    def set(self, key, data, ex=None):
+    def set(self, key, data, ex=None, nx=False):
+        if nx and key in self._data:
+            return None
         self._data[key] = data
+        return True
 
     def get(self, key):
         return self._data.get(key)
@@ -147,6 +170,34 @@ class MockRedis(object):
         self._data[key] = data
         return val
 
+    def hmget(self, key, fields):
+        values = self._data.get(key, {})
+        return [values.get(x) for x in fields]
+
+    def hincrby(self, key, field, amount=1):
+        values = self._data.setdefault(key, {})
+        values[field] = values.get(field, 0) + amount
+        return values[field]
+
+    def pipeline(self, transaction=True):
+        return MockRedisPipeline(self)
+
+
+class MockRedisPipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return queue
+
+    def execute(self):
+        self.redis.round_trips += 1
+        return [getattr(self.redis, name)(*args, **kwargs)
+                for name, args, kwargs in self.commands]
+
 
 class RedisCacheTests(unittest.TestCase):
     def setUp(self):
@@ -190,6 +241,23 @@ class RedisCacheTests(unittest.TestCase):
 
         c.obtain_lock(cache_key)
 
+    def test_obtain_lock_no_wait(self):
+        from ModestMaps.Core import Coordinate
+        from tileserver.cache import CacheKey, RedisCache, LockTimeout
+        from tilequeue.format import lookup_format_by_extension
+        import time
+
+        coord = Coordinate(0, 0, 0)
+        fmt = lookup_format_by_extension('mvt')
+        cache_key = CacheKey(coord, 1, 'all', fmt)
+
+        c = RedisCache(self.redis)
+        with c.lock(cache_key):
+            start = time.time()
+            with self.assertRaises(LockTimeout):
+                c.obtain_lock(cache_key, timeout=0)
+            self.assertLess(time.time() - start, 0.5)
+
     def test_contextmanager_lock(self):
         from ModestMaps.Core import Coordinate
         from tileserver.cache import CacheKey, RedisCache, LockTimeout
@@ -232,3 +300,531 @@ class RedisCacheTests(unittest.TestCase):
         self.assertEquals(tile_data, actual_data)
         self.redis.delete(
             c._generate_key('data', cache_key))
+
+
+class SharedMemoryCacheTests(unittest.TestCase):
+    def _cache_key(self, zoom=0, column=0, row=0):
+        from ModestMaps.Core import Coordinate
+        from tileserver.cache import CacheKey
+        from tilequeue.format import lookup_format_by_extension
+
+        coord = Coordinate(zoom=zoom, column=column, row=row)
+        fmt = lookup_format_by_extension('mvt')
+        return CacheKey(coord, 1, 'all', fmt)
+
+    def test_set_get(self):
+        from tileserver.cache import SharedMemoryCache
+
+        cache_key = self._cache_key()
+        c = SharedMemoryCache(1024 * 1024, 4096)
+        self.assertIsNone(c.get(cache_key))
+
+        c.set(cache_key, 'hello world')
+        self.assertEquals('hello world', c.get(cache_key))
+
+        # another key mapping to the same slot should not be returned
+        c = SharedMemoryCache(4096, 4096)
+        c.set(cache_key, 'hello world')
+        self.assertIsNone(c.get(self._cache_key(1, 1, 1)))
+
+    def test_large_tiles_only_in_backing(self):
+        from tileserver.cache import SharedMemoryCache
+
+        cache_key = self._cache_key()
+        backing = SharedMemoryCache(1024 * 1024, 1024 * 1024)
+        c = SharedMemoryCache(1024 * 1024, 1024, backing)
+        tile_data = 'x' * 2048
+
+        c.set(cache_key, tile_data)
+        self.assertIsNone(c._get_memory(c._digest(cache_key)))
+        self.assertEquals(tile_data, c.get(cache_key))
+
+    def test_get_fills_from_backing(self):
+        from tileserver.cache import SharedMemoryCache
+
+        cache_key = self._cache_key()
+        backing = SharedMemoryCache(1024 * 1024, 4096)
+        c = SharedMemoryCache(1024 * 1024, 4096, backing)
+        backing.set(cache_key, 'hello world')
+
+        self.assertEquals('hello world', c.get(cache_key))
+        self.assertEquals(
+            'hello world', c._get_memory(c._digest(cache_key)))
+
+    def test_set_visible_across_fork(self):
+        import os
+        from tileserver.cache import SharedMemoryCache
+
+        cache_key = self._cache_key()
+        c = SharedMemoryCache(1024 * 1024, 4096)
+
+        pid = os.fork()
+        if pid == 0:
+            c.set(cache_key, 'hello world')
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEquals('hello world', c.get(cache_key))
+
+    def test_obtain_lock_already_locked(self):
+        from tileserver.cache import SharedMemoryCache, LockTimeout
+
+        cache_key = self._cache_key()
+        c = SharedMemoryCache(1024 * 1024, 4096)
+        try:
+            c.obtain_lock(cache_key)
+            with self.assertRaises(LockTimeout):
+                c.obtain_lock(cache_key, timeout=0)
+        finally:
+            c.release_lock(cache_key)
+
+        c.obtain_lock(cache_key)
+        c.release_lock(cache_key)
+
+    def test_obtain_lock_locked_by_other_process(self):
+        import os
+        from tileserver.cache import SharedMemoryCache, LockTimeout
+
+        cache_key = self._cache_key()
+        c = SharedMemoryCache(1024 * 1024, 4096)
+
+        locked_r, locked_w = os.pipe()
+        done_r, done_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            c.obtain_lock(cache_key)
+            os.write(locked_w, 'x')
+            os.read(done_r, 1)
+            c.release_lock(cache_key)
+            os._exit(0)
+
+        try:
+            os.read(locked_r, 1)
+            with self.assertRaises(LockTimeout):
+                c.obtain_lock(cache_key, timeout=0)
+        finally:
+            os.write(done_w, 'x')
+            os.waitpid(pid, 0)
+
+        with c.lock(cache_key, timeout=1):
+            pass
+
+
+class ShardedRedisCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.redises = [MockRedis() for i in range(4)]
+
+    def _cache_key(self, zoom=0, column=0, row=0, layers='all'):
+        from ModestMaps.Core import Coordinate
+        from tileserver.cache import CacheKey
+        from tilequeue.format import lookup_format_by_extension
+
+        coord = Coordinate(zoom=zoom, column=column, row=row)
+        fmt = lookup_format_by_extension('mvt')
+        return CacheKey(coord, 1, layers, fmt)
+
+    def _node_of(self, c, cache_key):
+        return c.ring.get_node(c._shard_key(cache_key))
+
+    def test_set_get(self):
+        from tileserver.cache import ShardedRedisCache
+
+        c = ShardedRedisCache(self.redises)
+        cache_keys = [self._cache_key(8, x, 3) for x in range(32)]
+        for i, cache_key in enumerate(cache_keys):
+            c.set(cache_key, 'tile %d' % i)
+
+        for i, cache_key in enumerate(cache_keys):
+            self.assertEquals('tile %d' % i, c.get(cache_key))
+        self.assertTrue(all(x._data for x in self.redises),
+                        'Tiles should be spread over all servers')
+
+    def test_ring_stable(self):
+        from tileserver.cache import HashRing
+
+        keys = ['key %d' % i for i in range(1000)]
+        ring = HashRing(['a', 'b', 'c'])
+        grown = HashRing(['a', 'b', 'c', 'd'])
+        moved = [x for x in keys if ring.get_node(x) != grown.get_node(x)]
+
+        # only keys moving to the new node should move
+        self.assertTrue(all(grown.get_node(x) == 3 for x in moved))
+        self.assertTrue(100 < len(moved) < 400)
+
+    def test_colocate_zoom(self):
+        from tileserver.cache import ShardedRedisCache
+
+        c = ShardedRedisCache(self.redises, colocate_zoom=10)
+        parent = self._cache_key(10, 300, 400)
+        children = [self._cache_key(12, 1200 + x, 1600 + y)
+                    for x in range(4) for y in range(4)]
+        nodes = set(self._node_of(c, x) for x in children + [parent])
+        self.assertEquals(1, len(nodes))
+
+        # all layers and formats of a tile are together
+        c = ShardedRedisCache(self.redises)
+        self.assertEquals(
+            self._node_of(c, self._cache_key(5, 1, 2, 'all')),
+            self._node_of(c, self._cache_key(5, 1, 2, 'water')))
+
+    def test_pipelined_lock(self):
+        from tileserver.cache import ShardedRedisCache
+
+        cache_key = self._cache_key(3, 2, 1)
+        c = ShardedRedisCache(self.redises)
+        redis = self.redises[self._node_of(c, cache_key)]
+
+        with c.lock(cache_key):
+            self.assertIsNone(c.get(cache_key))
+            c.set(cache_key, 'hello world')
+            self.assertEquals('hello world', c.get(cache_key))
+        # lock and get, then set and unlock
+        self.assertEquals(2, redis.round_trips)
+        self.assertEquals('hello world', c.get(cache_key))
+
+        with c.lock(cache_key):
+            self.assertEquals('hello world', c.get(cache_key))
+        self.assertEquals(4, redis.round_trips)
+
+    def test_obtain_lock_already_locked(self):
+        from tileserver.cache import ShardedRedisCache, LockTimeout
+
+        cache_key = self._cache_key()
+        c = ShardedRedisCache(self.redises)
+        other = ShardedRedisCache(self.redises)
+        with c.lock(cache_key):
+            with self.assertRaises(LockTimeout):
+                other.obtain_lock(cache_key, timeout=0)
+
+        other.obtain_lock(cache_key)
+        other.release_lock(cache_key)
+
+    def test_lock_not_tied_to_thread(self):
+        from tileserver.cache import ShardedRedisCache
+        import threading
+
+        cache_key = self._cache_key(3, 2, 1)
+        c = ShardedRedisCache(self.redises)
+        c.obtain_lock(cache_key)
+
+        # greenlets share a thread, so the held lock can't be kept per
+        # thread. what's set while it's held is stored on release.
+        def render():
+            c.set(cache_key, 'hello world')
+            c.release_lock(cache_key)
+        thread = threading.Thread(target=render)
+        thread.start()
+        thread.join()
+        self.assertEquals({}, c.held)
+        self.assertEquals('hello world', c.get(cache_key))
+
+    def test_different_tiles_held_at_once(self):
+        from tileserver.cache import ShardedRedisCache
+        import threading
+
+        c = ShardedRedisCache(self.redises)
+        cache_keys = [self._cache_key(3, x, 1) for x in range(2)]
+        held = []
+        ready = threading.Event()
+        release = threading.Event()
+
+        def render(i):
+            with c.lock(cache_keys[i]):
+                self.assertIsNone(c.get(cache_keys[i]))
+                held.append(i)
+                if len(held) == 2:
+                    ready.set()
+                release.wait(5)
+                c.set(cache_keys[i], 'tile %d' % i)
+
+        threads = [threading.Thread(target=render, args=(i,))
+                   for i in range(2)]
+        for thread in threads:
+            thread.start()
+        # each sees its own tile while both are held
+        self.assertTrue(ready.wait(5))
+        self.assertEquals(2, len(c.held))
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals({}, c.held)
+        self.assertEquals(['tile 0', 'tile 1'],
+                          [c.get(x) for x in cache_keys])
+
+    def test_get_multi(self):
+        from tileserver.cache import ShardedRedisCache
+
+        c = ShardedRedisCache(self.redises)
+        cache_keys = [self._cache_key(8, x, 3) for x in range(32)]
+        for i, cache_key in enumerate(cache_keys[::2]):
+            c.set(cache_key, 'tile %d' % i)
+        for redis in self.redises:
+            redis.round_trips = 0
+
+        result = c.get_multi(cache_keys)
+        self.assertEquals(
+            ['tile %d' % i for i in range(16)], result[::2])
+        self.assertEquals([None] * 16, result[1::2])
+        self.assertTrue(all(x.round_trips == 1 for x in self.redises))
+
+
+def start_redis_servers(n):
+    """
+    Returns (clients, stop) for n empty redis servers, started from a
+    redis-server on the path or else in memory with fakeredis, or None if
+    neither is available.
+    """
+    from distutils.spawn import find_executable
+    import os
+    import socket
+    import subprocess
+    import time
+
+    redis_server = find_executable('redis-server')
+    if redis_server is None:
+        try:
+            import fakeredis
+        except ImportError:
+            return None
+        if hasattr(fakeredis, 'FakeServer'):
+            clients = [fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+                       for i in range(n)]
+        else:
+            clients = [fakeredis.FakeStrictRedis(singleton=False)
+                       for i in range(n)]
+        return clients, lambda: None
+
+    import redis
+
+    processes = []
+    clients = []
+    for i in range(n):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        processes.append(subprocess.Popen(
+            [redis_server, '--port', str(port), '--bind', '127.0.0.1',
+             '--save', '', '--appendonly', 'no'],
+            stdout=open(os.devnull, 'w')))
+        clients.append(redis.StrictRedis(port=port))
+
+    def stop():
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    deadline = time.time() + 5
+    for client in clients:
+        while True:
+            try:
+                client.ping()
+                break
+            except redis.ConnectionError:
+                if time.time() > deadline:
+                    stop()
+                    raise
+                time.sleep(0.05)
+    return clients, stop
+
+
+class RedisServerShardedCacheTests(unittest.TestCase):
+    """the sharded cache against real redis servers, where available"""
+
+    def setUp(self):
+        servers = start_redis_servers(3)
+        if servers is None:
+            self.skipTest('Neither redis-server nor fakeredis is available')
+        self.redises, stop = servers
+        self.addCleanup(stop)
+
+    def _cache_key(self, zoom, column, row):
+        from ModestMaps.Core import Coordinate
+        from tileserver.cache import CacheKey
+        from tilequeue.format import lookup_format_by_extension
+
+        coord = Coordinate(zoom=zoom, column=column, row=row)
+        return CacheKey(coord, 1, 'all', lookup_format_by_extension('mvt'))
+
+    def test_lock_set_get(self):
+        from tileserver.cache import ShardedRedisCache, LockTimeout
+
+        c = ShardedRedisCache(self.redises, expires=60)
+        other = ShardedRedisCache(self.redises)
+        cache_keys = [self._cache_key(8, x, 3) for x in range(16)]
+        for i, cache_key in enumerate(cache_keys):
+            with c.lock(cache_key):
+                self.assertIsNone(c.get(cache_key))
+                with self.assertRaises(LockTimeout):
+                    other.obtain_lock(cache_key, timeout=0)
+                c.set(cache_key, 'tile %d' % i)
+
+        # stored on release, each on its own server, with the lock gone
+        for i, cache_key in enumerate(cache_keys):
+            self.assertEquals('tile %d' % i, other.get(cache_key))
+            client = c._client(cache_key)
+            self.assertTrue(client.exists(c._generate_key('data', cache_key)))
+            self.assertFalse(
+                client.exists(c._generate_key('lock', cache_key)))
+            self.assertLessEqual(
+                client.ttl(c._generate_key('data', cache_key)), 60)
+        self.assertTrue(all(x.keys() for x in self.redises),
+                        'Tiles should be spread over all servers')
+
+        self.assertEquals(
+            ['tile 0', None, 'tile 2'],
+            other.get_multi([cache_keys[0], self._cache_key(9, 0, 0),
+                             cache_keys[2]]))
+
+
+class InvalidatingCacheTests(unittest.TestCase):
+    def _cache_key(self, zoom, column, row):
+        from ModestMaps.Core import Coordinate
+        from tileserver.cache import CacheKey
+        from tilequeue.format import lookup_format_by_extension
+
+        coord = Coordinate(zoom=zoom, column=column, row=row)
+        fmt = lookup_format_by_extension('mvt')
+        return CacheKey(coord, 1, 'all', fmt)
+
+    def _cache(self, generations=None):
+        from tileserver.cache import InvalidatingCache, RedisCache
+        from tileserver.cache import MemoryGenerationStore
+
+        self.redis = MockRedis()
+        return InvalidatingCache(
+            RedisCache(self.redis), generations or MemoryGenerationStore(),
+            bucket_zoom=10, refresh_interval=0)
+
+    def test_set_get(self):
+        c = self._cache()
+        cache_key = self._cache_key(12, 1000, 2000)
+        self.assertIsNone(c.get(cache_key))
+        c.set(cache_key, 'hello world')
+        self.assertEquals('hello world', c.get(cache_key))
+
+    def test_set_chunks(self):
+        c = self._cache()
+        cache_key = self._cache_key(12, 1000, 2000)
+        c.set_chunks(cache_key, ['hello', ' ', 'world'])
+        self.assertEquals('hello world', c.get(cache_key))
+
+    def test_invalidate_coords(self):
+        from ModestMaps.Core import Coordinate
+
+        c = self._cache()
+        inside = self._cache_key(14, 4000, 8000)
+        bucket = self._cache_key(10, 250, 500)
+        ancestor = self._cache_key(5, 7, 15)
+        neighbour = self._cache_key(14, 4016, 8000)
+        other_ancestor = self._cache_key(5, 8, 15)
+        cache_keys = [inside, bucket, ancestor, neighbour, other_ancestor]
+        for cache_key in cache_keys:
+            c.set(cache_key, 'hello world')
+
+        # a tile within the bucket at a higher zoom invalidates the bucket
+        n_counters = c.invalidate_coords(
+            [Coordinate(zoom=12, column=1001, row=2002)])
+        self.assertEquals(11, n_counters)
+
+        self.assertIsNone(c.get(inside))
+        self.assertIsNone(c.get(bucket))
+        self.assertIsNone(c.get(ancestor))
+        self.assertEquals('hello world', c.get(neighbour))
+        self.assertEquals('hello world', c.get(other_ancestor))
+
+        # stale data is still available
+        self.assertEquals('hello world', c.get_stale(inside))
+
+        # re-rendering makes it current again
+        c.set(inside, 'new world')
+        self.assertEquals('new world', c.get(inside))
+
+    def test_invalidate_min_zoom(self):
+        from ModestMaps.Core import Coordinate
+
+        c = self._cache()
+        inside = self._cache_key(14, 4000, 8000)
+        ancestor = self._cache_key(5, 7, 15)
+        c.set(inside, 'hello world')
+        c.set(ancestor, 'hello world')
+
+        c.invalidate_coords(
+            [Coordinate(zoom=14, column=4000, row=8000)], min_zoom=8)
+        self.assertIsNone(c.get(inside))
+        self.assertEquals('hello world', c.get(ancestor))
+
+    def test_invalidate_bounds(self):
+        c = self._cache()
+        # tiles containing (0.1, 0.1) and (10.1, 10.1)
+        inside = self._cache_key(12, 2049, 2046)
+        outside = self._cache_key(12, 2163, 1932)
+        world = self._cache_key(0, 0, 0)
+        for cache_key in (inside, outside, world):
+            c.set(cache_key, 'hello world')
+
+        c.invalidate_bounds((0.05, 0.05, 0.15, 0.15), 0, 16)
+        self.assertIsNone(c.get(inside))
+        self.assertIsNone(c.get(world))
+        self.assertEquals('hello world', c.get(outside))
+
+    def test_invalidated_during_render(self):
+        from ModestMaps.Core import Coordinate
+
+        c = self._cache()
+        cache_key = self._cache_key(12, 1000, 2000)
+        self.assertIsNone(c.get(cache_key))
+        generation = c.generation(cache_key.coord)
+        c.invalidate_coords([Coordinate(zoom=10, column=250, row=500)])
+        # another request for the tile while it's being rendered
+        self.assertIsNone(c.get(cache_key))
+        c.set_chunks(cache_key, ['hello world'], generation)
+
+        # the render started before the invalidation, so isn't current
+        self.assertIsNone(c.get(cache_key))
+        self.assertEquals('hello world', c.get_stale(cache_key))
+
+    def test_counters_bounded(self):
+        c = self._cache()
+        c.max_counters = 10
+        for column in range(20):
+            c.generation(self._cache_key(12, column, 0).coord)
+            self.assertLessEqual(len(c.counters), 10 + 11)
+
+    def test_unversioned_data(self):
+        from ModestMaps.Core import Coordinate
+
+        c = self._cache()
+        cache_key = self._cache_key(12, 1000, 2000)
+        c.backend.set(cache_key, 'hello world')
+        self.assertEquals('hello world', c.get(cache_key))
+
+        c.invalidate_coords([Coordinate(zoom=10, column=250, row=500)])
+        self.assertIsNone(c.get(cache_key))
+
+    def test_redis_generation_store(self):
+        from ModestMaps.Core import Coordinate
+        from tileserver.cache import RedisGenerationStore
+
+        redis = MockRedis()
+        c = self._cache(RedisGenerationStore(redis))
+        cache_key = self._cache_key(12, 1000, 2000)
+        c.set(cache_key, 'hello world')
+        c.invalidate_coords([Coordinate(zoom=10, column=250, row=500)])
+        self.assertIsNone(c.get(cache_key))
+        self.assertEquals(11, len(redis._data['tiles.generations']))
+
+    def test_file_generation_store(self):
+        import shutil
+        import tempfile
+        from tileserver.cache import FileGenerationStore
+
+        path = tempfile.mkdtemp()
+        try:
+            store = FileGenerationStore(path)
+            self.assertEquals([0, 0], store.get_multi(['tree/0/0/0', 'b']))
+            store.incr_multi(['tree/0/0/0'])
+            store.incr_multi(['tree/0/0/0', 'b'])
+            self.assertEquals([2, 1], store.get_multi(['tree/0/0/0', 'b']))
+        finally:
+            shutil.rmtree(path)
@@ -0,0 +1,198 @@
+import unittest
+
+
+def _cache_key(zoom, column, row, extension='mvt', layers='all',
+               tile_size=1):
+    from ModestMaps.Core import Coordinate
+    from tileserver.cache import CacheKey
+    from tilequeue.format import lookup_format_by_extension
+
+    coord = Coordinate(zoom=zoom, column=column, row=row)
+    fmt = lookup_format_by_extension(extension)
+    return CacheKey(coord, tile_size, layers, fmt)
+
+
+class CoverageIndexTests(unittest.TestCase):
+    def setUp(self):
+        from tileserver.coverage import CoverageIndex
+        self.index = CoverageIndex(max_data_zoom=16)
+        self.generations = {}
+
+    def generation(self, coord):
+        return self.generations.get((coord.zoom, coord.column, coord.row), 0)
+
+    def record(self, cache_key, tile_data='empty'):
+        self.index.record_empty(
+            cache_key, tile_data, self.generation(cache_key.coord),
+            self.generation)
+
+    def test_exact_tile(self):
+        cache_key = _cache_key(12, 100, 200)
+        self.assertIsNone(self.index.get_template(cache_key, self.generation))
+
+        self.record(cache_key)
+        self.assertEquals(
+            'empty', self.index.get_template(cache_key, self.generation))
+
+        # below max data zoom, children may still have features
+        child = _cache_key(13, 200, 400)
+        self.assertFalse(
+            self.index.is_empty(child.coord, 1, self.generation))
+
+    def test_subtree(self):
+        self.record(_cache_key(16, 100, 200))
+        descendant = _cache_key(19, 807, 1601)
+        self.assertTrue(
+            self.index.is_empty(descendant.coord, 1, self.generation))
+        neighbour = _cache_key(19, 808, 1601)
+        self.assertFalse(
+            self.index.is_empty(neighbour.coord, 1, self.generation))
+
+    def test_merge_siblings(self):
+        for column in (200, 201):
+            for row in (400, 401):
+                self.record(_cache_key(17, column, row))
+
+        self.assertEquals(1, self.index.stats()['entries'])
+        self.assertEquals({16: 1}, self.index.stats()['entries_by_zoom'])
+        self.assertTrue(self.index.is_empty(
+            _cache_key(16, 100, 200).coord, 1, self.generation))
+
+    def test_tile_sizes_apart(self):
+        # an empty z15 tile doesn't mean the same tile at a larger size,
+        # which is rendered at a higher nominal zoom, is empty
+        self.record(_cache_key(15, 100, 200))
+        self.assertIsNone(self.index.get_template(
+            _cache_key(15, 100, 200, tile_size=4), self.generation))
+
+        # and the subtree rule applies from the nominal zoom
+        self.record(_cache_key(14, 50, 100, tile_size=3))
+        self.assertTrue(self.index.is_empty(
+            _cache_key(17, 400, 800).coord, 3, self.generation))
+        self.assertFalse(self.index.is_empty(
+            _cache_key(17, 400, 800).coord, 1, self.generation))
+
+    def test_generation_without_lock(self):
+        self.record(_cache_key(16, 100, 200))
+        for column in (200, 201):
+            self.record(_cache_key(17, column, 400))
+            self.record(_cache_key(17, column, 401))
+
+        def generation(coord):
+            # would block if the lock were held
+            self.assertTrue(self.index.lock.acquire(False))
+            self.index.lock.release()
+            return self.generation(coord)
+
+        self.index.record_empty(
+            _cache_key(18, 400, 800), 'empty', 0, generation)
+        self.assertTrue(self.index.is_empty(
+            _cache_key(19, 800, 1600).coord, 1, generation))
+
+    def test_invalidated(self):
+        cache_key = _cache_key(16, 100, 200)
+        self.record(cache_key)
+        self.generations[(16, 100, 200)] = 1
+
+        self.assertFalse(
+            self.index.is_empty(cache_key.coord, 1, self.generation))
+        self.assertEquals(0, self.index.stats()['entries'])
+
+    def test_templates_per_format(self):
+        self.record(_cache_key(12, 100, 200, 'topojson'))
+        self.assertIsNone(self.index.get_template(
+            _cache_key(12, 100, 200, 'topojson'), self.generation))
+
+        self.record(_cache_key(12, 100, 200, 'json'), '{}')
+        self.assertIsNone(self.index.get_template(
+            _cache_key(12, 100, 200, 'mvt'), self.generation))
+        self.assertEquals('{}', self.index.get_template(
+            _cache_key(12, 100, 200, 'json'), self.generation))
+
+    def test_differing_templates_dropped(self):
+        self.record(_cache_key(12, 100, 200), 'empty')
+        self.record(_cache_key(12, 100, 201), 'different')
+        self.record(_cache_key(12, 100, 202), 'empty')
+        self.assertIsNone(self.index.get_template(
+            _cache_key(12, 100, 200), self.generation))
+
+    def test_max_entries(self):
+        from tileserver.coverage import CoverageIndex
+        self.index = CoverageIndex(max_data_zoom=16, max_entries=2)
+        for column in range(3):
+            self.record(_cache_key(12, column, 0))
+        self.assertEquals(1, self.index.stats()['entries'])
+
+    def test_uniform_templates_per_zoom(self):
+        ocean = "[('water', [([('kind', 'ocean')], None)])]"
+        self.index.record(_cache_key(12, 100, 200), ocean, 'ocean 12', 0,
+                          self.generation)
+        self.index.record(_cache_key(13, 100, 200), ocean, 'ocean 13', 0,
+                          self.generation)
+        self.assertEquals('ocean 12', self.index.get_template(
+            _cache_key(12, 100, 200), self.generation))
+        self.assertEquals('ocean 13', self.index.get_template(
+            _cache_key(13, 100, 200), self.generation))
+        self.assertFalse(self.index.is_empty(
+            _cache_key(12, 100, 200).coord, 1, self.generation))
+
+        # json is in lon/lat, so differs from tile to tile
+        self.index.record(_cache_key(12, 100, 201, 'json'), ocean,
+                          '{"ocean": 12}', 0, self.generation)
+        self.assertIsNone(self.index.get_template(
+            _cache_key(12, 100, 201, 'json'), self.generation))
+
+    def test_uniform_subtree(self):
+        ocean = "[('water', [([('kind', 'ocean')], None)])]"
+        self.index.record(_cache_key(16, 100, 200), ocean, 'ocean 16', 0,
+                          self.generation)
+        # known to be ocean, but there's no template at that zoom yet
+        descendant = _cache_key(17, 201, 401)
+        self.assertIsNone(
+            self.index.get_template(descendant, self.generation))
+        self.index.record(_cache_key(17, 0, 0), ocean, 'ocean 17', 0,
+                          self.generation)
+        self.assertEquals('ocean 17', self.index.get_template(
+            descendant, self.generation))
+
+    def test_merge_same_signature(self):
+        ocean = "[('water', [([('kind', 'ocean')], None)])]"
+        for column in (200, 201):
+            for row in (400, 401):
+                signature = ocean if (column, row) != (201, 401) else \
+                    "[('water', [([('kind', 'lake')], None)])]"
+                self.index.record(_cache_key(17, column, row), signature,
+                                  'tile', 0, self.generation)
+        self.assertEquals(4, self.index.stats()['entries'])
+        self.assertIsNone(self.index.signature(
+            _cache_key(16, 100, 200).coord, 1, self.generation))
+
+    def test_uniform_signature(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import box
+        from tileserver.coverage import EMPTY
+        from tileserver.coverage import uniform_signature
+
+        padded_bounds = dict(polygon=(0, 0, 10, 10))
+
+        def layers(*features):
+            return [
+                dict(name='earth', features=[], padded_bounds=padded_bounds),
+                dict(name='water', features=list(features),
+                     padded_bounds=padded_bounds),
+            ]
+
+        self.assertEquals(EMPTY, uniform_signature(layers()))
+
+        ocean = box(-5, -5, 15, 15), dict(kind='ocean'), None
+        signature = uniform_signature(layers(ocean))
+        self.assertEquals(
+            "[('water', [([('kind', 'ocean')], None)])]", signature)
+        # the same features anywhere else give the same signature
+        elsewhere = box(-50, -50, 150, 150), dict(kind='ocean'), None
+        self.assertEquals(signature, uniform_signature(layers(elsewhere)))
+
+        lake = box(2, 2, 8, 8), dict(kind='lake'), None
+        self.assertIsNone(uniform_signature(layers(lake)))
+        river = LineString([(0, 0), (10, 10)]), dict(kind='river'), None
+        self.assertIsNone(uniform_signature(layers(ocean, river)))
@@ -0,0 +1,165 @@
+import unittest
+
+
+class MockCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query):
+        if self.conn.fail:
+            raise Exception('connection failed')
+
+    def fetchall(self):
+        return [(1,)]
+
+
+class MockConnection(object):
+    def __init__(self, dbname, fail=False):
+        self.dbname = dbname
+        self.fail = fail
+        self.closed = False
+
+    def cursor(self):
+        return MockCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+def make_pool(dbnames, failing=(), prober=False):
+    from tileserver.database import DatabasePool
+
+    class MockDatabasePool(DatabasePool):
+        def _make_conn(self, dbname):
+            return MockConnection(dbname, dbname in failing)
+
+        def _start_prober(self):
+            self.n_probers_started += 1
+            # only run the background prober in tests which ask for it
+            if prober:
+                DatabasePool._start_prober(self)
+
+    pool = MockDatabasePool(
+        dict(dbnames=dbnames), max_idle=2, probe_interval=0.01)
+    pool.n_probers_started = 0
+    return pool
+
+
+class DatabasePoolTests(unittest.TestCase):
+    def test_conns_from_one_dbname(self):
+        pool = make_pool(['a', 'b'])
+        conns = pool.get_conns(3)
+        self.assertEquals(3, len(conns))
+        self.assertEquals(1, len(set(x.dbname for x in conns)))
+
+    def test_least_loaded(self):
+        pool = make_pool(['a', 'b'])
+        first = pool.get_conns(2)
+        second = pool.get_conns(2)
+        self.assertNotEquals(first[0].dbname, second[0].dbname)
+
+        pool.put_conns(first)
+        third = pool.get_conns(2)
+        self.assertEquals(first[0].dbname, third[0].dbname)
+
+    def test_reuse_idle_conns(self):
+        pool = make_pool(['a'])
+        conns = pool.get_conns(3)
+        pool.put_conns(conns)
+
+        # only max_idle are kept, the rest are closed
+        self.assertEquals(1, sum(1 for x in conns if x.closed))
+        reused = pool.get_conns(2)
+        self.assertEquals(
+            set(id(x) for x in conns if not x.closed),
+            set(id(x) for x in reused))
+
+    def test_closed_conns_not_reused(self):
+        pool = make_pool(['a'])
+        conns = pool.get_conns(1)
+        conns[0].close()
+        pool.put_conns(conns)
+        self.assertEquals(0, pool.stats()['a']['idle'])
+        self.assertEquals(0, pool.stats()['a']['in_use'])
+
+    def test_probe(self):
+        pool = make_pool(['a', 'b'], failing=['b'])
+        pool.probe()
+
+        stats = pool.stats()
+        self.assertTrue(stats['a']['healthy'])
+        self.assertIsNotNone(stats['a']['rtt_ms'])
+        self.assertTrue(pool.is_fresh(stats['a']))
+        self.assertFalse(stats['b']['healthy'])
+        self.assertEquals('connection failed', stats['b']['last_error'])
+
+        # unhealthy dbnames aren't used while there are healthy ones
+        for i in range(3):
+            conns = pool.get_conns(1)
+            self.assertEquals('a', conns[0].dbname)
+
+    def test_latency_weighted(self):
+        pool = make_pool(['a', 'b'])
+        backend_a, backend_b = pool.backends
+        backend_a.rtt = 0.010
+        backend_b.rtt = 0.001
+
+        # b is ten times faster, so takes nine renders before a is as
+        # good a choice
+        dbnames = [pool.get_conns(1)[0].dbname for i in range(11)]
+        self.assertEquals(['b'] * 9, dbnames[:9])
+        self.assertIn('a', dbnames[9:])
+
+    def test_prober(self):
+        import time
+
+        pool = make_pool(['a', 'b'], failing=['b'], prober=True)
+        pool.start()
+        try:
+            deadline = time.time() + 5
+            while (pool.stats()['b']['last_probed'] is None and
+                   time.time() < deadline):
+                time.sleep(0.01)
+            stats = pool.stats()
+            self.assertTrue(stats['a']['healthy'])
+            self.assertFalse(stats['b']['healthy'])
+            # started once, however often it's asked
+            pool.start()
+            self.assertEquals(1, pool.n_probers_started)
+        finally:
+            # the prober stops once the pool belongs to another process
+            pool.pid = None
+
+    def test_fork_reset(self):
+        pool = make_pool(['a'])
+        pool.start()
+        inherited = pool.get_conns(2)
+        self.assertEquals(1, pool.n_probers_started)
+
+        # as if in a process forked after the connections were taken
+        pool.pid = -1
+        pool.start()
+        self.assertEquals(2, pool.n_probers_started)
+        self.assertEquals(0, pool.stats()['a']['in_use'])
+        conns = pool.get_conns(1)
+        self.assertNotIn(id(conns[0]), set(id(x) for x in inherited))
+        # inherited connections are kept, not closed for the parent
+        self.assertFalse(any(x.closed for x in inherited))
+
+    def test_health_before_first_probe(self):
+        from tileserver import HealthChecker
+
+        pool = make_pool(['a', 'b'], failing=['b'])
+        checker = HealthChecker('/health', dict(dbnames=['a', 'b']), pool)
+        response = checker.pool_health()
+        self.assertEquals(200, response.status_code)
+        lines = response.get_data().split('\n')
+        self.assertEquals('OK', lines[0])
+        self.assertTrue(lines[1].startswith('a healthy '))
+        self.assertTrue(lines[2].startswith('b unhealthy '))
+
+        pool = make_pool(['a'], failing=['a'])
+        checker = HealthChecker('/health', dict(dbnames=['a']), pool)
+        response = checker.pool_health()
+        self.assertEquals(503, response.status_code)
+        self.assertEquals('Unhealthy', response.get_data().split('\n')[0])
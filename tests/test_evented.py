@@ -0,0 +1,69 @@
+import unittest
+
+
+def make_tile_server():
+    from tileserver import LayerConfig
+    from tileserver import RenderResult
+    from tileserver import TileServer
+    from tileserver.cache import SharedMemoryCache
+    import os
+
+    class StubTileServer(TileServer):
+        def render_tile(self, coord, format, tile_size, layer_spec,
+                        unique_layer_names):
+            # says where it was rendered
+            return RenderResult(['{"pid": %d}' % os.getpid()], None)
+
+    layer_config = LayerConfig(
+        ['roads', 'water'], [dict(name='roads'), dict(name='water')])
+    cache = SharedMemoryCache(1024 * 1024, 4096)
+    # render processes recreate their io after forking
+    return StubTileServer(
+        layer_config, set(['json']), None, None, None, cache, {}, [],
+        io_factory=lambda: (None, None))
+
+
+class RenderPoolTests(unittest.TestCase):
+    def _request(self, tile_server):
+        from ModestMaps.Core import Coordinate
+        from tileserver.cache import CacheKey
+        from tilequeue.format import lookup_format_by_extension
+        from werkzeug.test import EnvironBuilder
+        from werkzeug.test import run_wsgi_app
+        import json
+
+        environ = EnvironBuilder(path='/all/3/2/1.json').get_environ()
+        app_iter, status, headers = run_wsgi_app(tile_server, environ)
+        self.assertEquals('200 OK', status)
+        body = ''.join(app_iter)
+
+        cache_key = CacheKey(Coordinate(zoom=3, column=2, row=1), 1,
+                             'all', lookup_format_by_extension('json'))
+        self.assertEquals(body, tile_server.cache.get(cache_key))
+        return json.loads(body)['pid']
+
+    def test_thread_render_pool(self):
+        from gevent.threadpool import ThreadPool
+        import os
+
+        tile_server = make_tile_server()
+        tile_server.render_pool = ThreadPool(2)
+        try:
+            self.assertEquals(os.getpid(), self._request(tile_server))
+        finally:
+            tile_server.render_pool.kill()
+
+    def test_process_render_pool(self):
+        from gevent.threadpool import ThreadPool
+        from tileserver.evented import ProcessRenderPool
+        import os
+
+        tile_server = make_tile_server()
+        wait_pool = ThreadPool(2)
+        tile_server.render_pool = ProcessRenderPool(
+            tile_server, 2, wait_pool)
+        try:
+            self.assertNotEquals(os.getpid(), self._request(tile_server))
+        finally:
+            tile_server.render_pool.pool.terminate()
+            wait_pool.kill()
@@ -0,0 +1,88 @@
+import unittest
+
+
+class FailureCacheTests(unittest.TestCase):
+    def test_backoff_doubles(self):
+        from tileserver.failures import FailureCache
+
+        failures = FailureCache(backoff=1, max_backoff=5)
+        self.assertIsNone(failures.suppressed('tile', now=0))
+
+        self.assertEquals(1, failures.record_failure('tile', now=0))
+        self.assertEquals(0.5, failures.suppressed('tile', now=0.5))
+        self.assertIsNone(failures.suppressed('tile', now=1))
+        self.assertIsNone(failures.suppressed('other', now=0.5))
+
+        self.assertEquals(2, failures.record_failure('tile', now=1))
+        self.assertEquals(4, failures.record_failure('tile', now=3))
+        self.assertEquals(5, failures.record_failure('tile', now=7))
+        self.assertIsNotNone(failures.suppressed('tile', now=11))
+
+        stats = failures.stats()
+        self.assertEquals(4, stats['failures'])
+        self.assertEquals(2, stats['suppressed_renders'])
+
+    def test_success_resets(self):
+        from tileserver.failures import FailureCache
+
+        failures = FailureCache(backoff=1)
+        failures.record_failure('tile', now=0)
+        failures.record_failure('tile', now=1)
+        failures.record_success('tile')
+        self.assertIsNone(failures.suppressed('tile', now=1))
+        self.assertEquals(1, failures.record_failure('tile', now=10))
+
+    def test_bounded(self):
+        from tileserver.failures import FailureCache
+
+        failures = FailureCache(max_entries=2)
+        for key in ('a', 'b', 'c'):
+            failures.record_failure(key, now=0)
+        self.assertIsNone(failures.suppressed('a', now=0.5))
+        self.assertIsNotNone(failures.suppressed('c', now=0.5))
+
+    def test_not_found(self):
+        from tileserver.failures import FailureCache
+
+        failures = FailureCache(not_found_ttl=60)
+        self.assertFalse(failures.is_not_found('nope', now=0))
+        failures.record_not_found('nope', now=0)
+        self.assertTrue(failures.is_not_found('nope', now=30))
+        self.assertFalse(failures.is_not_found('nope', now=60))
+        self.assertEquals(1, failures.stats()['suppressed_not_found'])
+
+    def test_suppressed_without_lock(self):
+        from ModestMaps.Core import Coordinate
+        from tileserver import LayerConfig
+        from tileserver import TileServer
+        from tileserver.cache import CacheKey
+        from tileserver.cache import SharedMemoryCache
+        from tileserver.failures import FailureCache
+        from tilequeue.format import lookup_format_by_extension
+        from werkzeug.test import EnvironBuilder
+        from werkzeug.test import run_wsgi_app
+
+        class NoLockCache(SharedMemoryCache):
+            def lock(self, cache_key, **kwargs):
+                raise AssertionError('suppressed tiles wait for the lock')
+
+        failures = FailureCache(backoff=60)
+        cache_key = CacheKey(Coordinate(zoom=3, column=2, row=1), 1, 'all',
+                             lookup_format_by_extension('json'))
+        failures.record_failure(cache_key)
+        layer_config = LayerConfig(['roads'], [dict(name='roads')])
+        cache = NoLockCache(1024 * 1024, 4096)
+        tile_server = TileServer(
+            layer_config, set(['json']), None, None, None, cache, {}, [],
+            failure_cache=failures)
+
+        environ = EnvironBuilder(path='/all/3/2/1.json').get_environ()
+        app_iter, status, headers = run_wsgi_app(tile_server, environ)
+        self.assertEquals('500 INTERNAL SERVER ERROR', status)
+        self.assertEquals('60', headers['Retry-After'])
+
+        # unless it's been rendered elsewhere since
+        cache.set(cache_key, '{}')
+        app_iter, status, headers = run_wsgi_app(tile_server, environ)
+        self.assertEquals('200 OK', status)
+        self.assertEquals('{}', ''.join(app_iter))
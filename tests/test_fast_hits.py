@@ -0,0 +1,91 @@
+import unittest
+
+
+def make_tile_server(**kwargs):
+    from tileserver import LayerConfig
+    from tileserver import TileServer
+    from tileserver.cache import SharedMemoryCache
+
+    layer_config = LayerConfig(
+        ['roads', 'water'], [dict(name='roads'), dict(name='water')])
+    cache = SharedMemoryCache(1024 * 1024, 4096)
+    return TileServer(
+        layer_config, set(['json', 'mvt']), None, None, None, cache, {}, [],
+        add_cors_headers=True, max_age=300, path_tile_size={'512': 2},
+        **kwargs)
+
+
+def call(tile_server, path, **kwargs):
+    from werkzeug.test import EnvironBuilder
+    from werkzeug.test import run_wsgi_app
+
+    environ = EnvironBuilder(path=path, **kwargs).get_environ()
+    app_iter, status, headers = run_wsgi_app(tile_server, environ)
+    return status, headers, ''.join(app_iter)
+
+
+class FastHitTests(unittest.TestCase):
+    def _cache_tile(self, tile_server, tile_data, tile_size=1, layers='all'):
+        from ModestMaps.Core import Coordinate
+        from tileserver.cache import CacheKey
+        from tilequeue.format import lookup_format_by_extension
+
+        coord = Coordinate(zoom=3, column=2, row=1)
+        fmt = lookup_format_by_extension('json')
+        tile_server.cache.set(
+            CacheKey(coord, tile_size, layers, fmt), tile_data)
+
+    def test_same_as_slow_path(self):
+        fast = make_tile_server(fast_hits=True)
+        slow = make_tile_server(fast_hits=False)
+        for tile_server in (fast, slow):
+            self._cache_tile(tile_server, '{"water": {}}')
+            self._cache_tile(tile_server, '{}', 2, 'roads,water')
+
+        for path in ('/all/3/2/1.json', '/512/water,roads/3/2/1.json'):
+            fast_status, fast_headers, fast_body = call(fast, path)
+            slow_status, slow_headers, slow_body = call(slow, path)
+            self.assertEquals(slow_status, fast_status)
+            self.assertEquals(slow_body, fast_body)
+            # apart from the date, which may have just changed
+            self.assertIn('Date', fast_headers)
+            self.assertEquals(
+                sorted(x for x in slow_headers.items() if x[0] != 'Date'),
+                sorted(x for x in fast_headers.items() if x[0] != 'Date'))
+
+    def test_left_to_slow_path(self):
+        tile_server = make_tile_server(fast_hits=True)
+        self._cache_tile(tile_server, '{}')
+
+        def fail(*args):
+            raise AssertionError('Should not be handled on the fast path')
+
+        for path, kwargs in (
+                ('/all/3/2/1.json', dict(method='HEAD')),
+                ('/all/3/2/1.json', dict(
+                    headers={'If-None-Match': '"x"'})),
+                ('/all/3/9/1.json', {}),
+                ('/bogus/3/2/1.json', {}),
+                ('/1024/all/3/2/1.json', {}),
+                ('/all/3/2/1.topojson', {}),
+                ('/preview.html', {})):
+            from werkzeug.test import EnvironBuilder
+            environ = EnvironBuilder(path=path, **kwargs).get_environ()
+            self.assertIsNone(tile_server.handle_hit(environ, fail))
+
+    def test_conditional_hit(self):
+        tile_server = make_tile_server(fast_hits=True)
+        self._cache_tile(tile_server, '{}')
+        status, headers, body = call(tile_server, '/all/3/2/1.json')
+        status, headers, body = call(
+            tile_server, '/all/3/2/1.json',
+            headers={'If-None-Match': headers['ETag']})
+        self.assertEquals('304 NOT MODIFIED', status)
+
+    def test_layer_spec_memo(self):
+        tile_server = make_tile_server()
+        result, layers = tile_server.parse_layer_spec('water,roads')
+        self.assertEquals('roads,water', layers)
+        self.assertIs(result, tile_server.parse_layer_spec('water,roads')[0])
+        self.assertIsNone(tile_server.parse_layer_spec('buildings'))
+        self.assertNotIn('buildings', tile_server.layer_spec_memo)
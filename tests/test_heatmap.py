@@ -0,0 +1,201 @@
+import unittest
+
+
+def cache_key(zoom, column, row, layers='all', extension='mvt'):
+    from ModestMaps.Core import Coordinate
+    from tileserver.cache import CacheKey
+    from tilequeue.format import lookup_format_by_extension
+
+    coord = Coordinate(zoom=zoom, column=column, row=row)
+    return CacheKey(coord, 1, layers, lookup_format_by_extension(extension))
+
+
+class CountMinSketchTests(unittest.TestCase):
+    def test_never_underestimates(self):
+        from tileserver.heatmap import CountMinSketch
+
+        sketch = CountMinSketch(width=64, depth=3)
+        counts = {}
+        for i in range(1000):
+            key = (i * 7) % 200
+            counts[key] = counts.get(key, 0) + 1
+            sketch.add(key)
+        for key, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+
+    def test_exact_when_sparse(self):
+        from tileserver.heatmap import CountMinSketch
+
+        sketch = CountMinSketch()
+        for i in range(5):
+            sketch.add('a')
+        self.assertEquals(6, sketch.add('a'))
+        self.assertEquals(0, sketch.estimate('b'))
+
+
+class TopKTests(unittest.TestCase):
+    def test_keeps_highest(self):
+        from tileserver.heatmap import TopK
+
+        top = TopK(2)
+        top.update('a', 1)
+        top.update('b', 2)
+        top.update('a', 3)
+        # higher than b, which has the lowest count
+        top.update('c', 3)
+        self.assertEquals([('a', 3), ('c', 3)], top.most_common())
+        # not higher than any
+        top.update('d', 2)
+        self.assertEquals(['a', 'c'], [x[0] for x in top.most_common()])
+
+    def test_evicted_written_back(self):
+        from tileserver.heatmap import Heatmap
+
+        heatmap = Heatmap(top_tiles=1)
+        tile = ('a',)
+        heatmap._count(tile, heatmap.tile_sketch, heatmap.top_tiles)
+        for i in range(4):
+            # counted in the top k, not the sketch
+            heatmap._count(tile, heatmap.tile_sketch, heatmap.top_tiles)
+        self.assertEquals(1, heatmap.tile_sketch.estimate(tile))
+        for i in range(6):
+            heatmap._count(('b',), heatmap.tile_sketch, heatmap.top_tiles)
+        self.assertEquals([(('b',), 6)], heatmap.top_tiles.most_common())
+        self.assertEquals(5, heatmap.tile_sketch.estimate(tile))
+
+
+class HeatmapTests(unittest.TestCase):
+    def test_snapshot(self):
+        from tileserver.heatmap import Heatmap
+
+        heatmap = Heatmap(bucket_zoom=10)
+        for i in range(3):
+            heatmap.record(cache_key(12, 1025, 2050), 'hit')
+        heatmap.record(cache_key(12, 1026, 2051), 'miss')
+        heatmap.record(cache_key(5, 3, 4), 'miss')
+
+        snapshot = heatmap.snapshot()
+        self.assertEquals(dict(hit=3, miss=1), snapshot['by_zoom'][12])
+        top_area = snapshot['areas'][0]
+        self.assertEquals((10, 256, 512, 12, 'hit', 3), (
+            top_area['zoom'], top_area['column'], top_area['row'],
+            top_area['tile_zoom'], top_area['outcome'], top_area['count']))
+        top_tile = snapshot['tiles'][0]
+        self.assertEquals((12, 1025, 2050, 3), (
+            top_tile['zoom'], top_tile['column'], top_tile['row'],
+            top_tile['count']))
+        self.assertEquals(3, len(snapshot['tiles']))
+
+    def test_persist_merges(self):
+        from tileserver.heatmap import Heatmap
+        from tileserver.heatmap import load_heatmap
+        import os
+        import shutil
+        import tempfile
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'heatmap.json')
+            first = Heatmap()
+            for i in range(4):
+                first.record(cache_key(3, 1, 1), 'hit')
+            first.record(cache_key(3, 2, 2), 'hit')
+            first.persist(path)
+
+            second = Heatmap()
+            second.record(cache_key(3, 2, 2), 'hit')
+            second.record(cache_key(3, 2, 2), 'hit')
+            second.persist(path, decay=0.5)
+
+            tiles = dict(((x['column'], x['row']), x['count'])
+                         for x in load_heatmap(path)['tiles'])
+            # only in the file, so decayed, and the larger of the two
+            self.assertEquals({(1, 1): 2, (2, 2): 2}, tiles)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_tile_paths(self):
+        from tileserver.heatmap import tile_paths
+
+        snapshot = dict(tiles=[
+            dict(zoom=3, column=2, row=1, tile_size=1, layers='all',
+                 format='mvt', count=5),
+            dict(zoom=3, column=2, row=1, tile_size=2, layers='water',
+                 format='json', count=4),
+            dict(zoom=3, column=2, row=1, tile_size=4, layers='all',
+                 format='json', count=3),
+            dict(zoom=3, column=2, row=1, tile_size=1, layers='all',
+                 format='topojson', count=2),
+        ])
+        self.assertEquals(
+            ['/all/3/2/1.mvt', '/512/water/3/2/1.json'],
+            tile_paths(snapshot, {'512': 2}, set(['mvt', 'json'])))
+
+    def test_warm_up(self):
+        from tileserver.heatmap import warm_up
+
+        class MockTileServer(object):
+            heatmap = 'heatmap'
+
+            def __init__(self):
+                self.paths = []
+
+            def __call__(self, environ, start_response):
+                # warm up requests aren't counted, but the real requests
+                # served alongside them still are
+                assert self.heatmap is None
+                assert tile_server.heatmap == 'heatmap'
+                self.paths.append(environ['PATH_INFO'])
+                start_response('200 OK', [])
+                return ['tile']
+
+        tile_server = MockTileServer()
+        paths = ['/all/3/2/1.mvt', '/all/3/2/2.mvt']
+        statuses = warm_up(tile_server, paths, concurrency=2)
+        self.assertEquals({'200 OK': 2}, statuses)
+        self.assertEquals(sorted(paths), sorted(tile_server.paths))
+
+    def test_warm_up_in_background(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        from tileserver.heatmap import WarmUp
+
+        class MockTileServer(object):
+            heatmap = None
+            path_tile_size = {}
+            extensions = set(['mvt'])
+
+            def __init__(self):
+                self.paths = []
+
+            def __call__(self, environ, start_response):
+                self.paths.append(environ['PATH_INFO'])
+                start_response('200 OK', [])
+                return ['tile']
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'heatmap.json')
+            with open(path, 'w') as fp:
+                json.dump(dict(tiles=[
+                    dict(zoom=3, column=x, row=1, tile_size=1, layers='all',
+                         format='mvt', count=10 - x) for x in range(3)]), fp)
+
+            tile_server = MockTileServer()
+            warm_up = WarmUp(path, 2)
+            warm_up.start(tile_server).join()
+            self.assertEquals(['/all/3/0/1.mvt', '/all/3/1/1.mvt'],
+                              tile_server.paths)
+
+            # another process sharing the file leaves it to the first
+            pid = os.fork()
+            if pid == 0:
+                other = MockTileServer()
+                WarmUp(path, 2).run(other)
+                os._exit(len(other.paths))
+            _, status = os.waitpid(pid, 0)
+            self.assertEquals(0, os.WEXITSTATUS(status))
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,130 @@
+import unittest
+
+
+class EstimateSizeTests(unittest.TestCase):
+    def test_strings_counted_by_length(self):
+        from tileserver.memory import estimate_size
+
+        small = estimate_size([dict(__geometry__='x')])
+        large = estimate_size([dict(__geometry__='x' * 10000)])
+        self.assertEquals(9999, large - small)
+
+    def test_nested(self):
+        from tileserver.memory import estimate_size
+
+        rows = [dict(__id__=1, __geometry__='x' * 100,
+                     __water_properties__=dict(kind='ocean'))]
+        self.assertGreater(estimate_size(rows), 100 + len('ocean'))
+
+
+class MemoryBudgetTests(unittest.TestCase):
+    def test_records_by_zoom(self):
+        from tileserver.memory import MemoryBudget
+
+        budget = MemoryBudget(source_expansion=2)
+        reservation = budget.reserve(6)
+        reservation.source_fetched(['x' * 1000])
+        reservation.output_formatted(500)
+        reservation.release()
+
+        stats = budget.stats()
+        self.assertEquals(0, stats['in_use'])
+        zoom_stats = stats['by_zoom'][6]
+        self.assertEquals(1, zoom_stats['renders'])
+        self.assertGreater(zoom_stats['max_bytes'], 2500)
+        self.assertEquals(zoom_stats['max_bytes'], zoom_stats['average_bytes'])
+
+    def test_reserves_recent_usage(self):
+        from tileserver.memory import MemoryBudget
+
+        budget = MemoryBudget(limit=10000)
+        budget.record(6, 4000)
+        reservation = budget.reserve(6)
+        self.assertEquals(4000, budget.in_use)
+        reservation.release(completed=False)
+        self.assertEquals(0, budget.in_use)
+        self.assertEquals(1, budget.stats()['by_zoom'][6]['renders'])
+
+    def test_average_over_limit(self):
+        from tileserver.memory import MemoryBudget
+
+        budget = MemoryBudget(limit=1000, source_expansion=1)
+        reservation = budget.reserve(6)
+        reservation.source_fetched(['x' * 900])
+        reservation.output_formatted(500)
+        reservation.release()
+        self.assertGreater(budget.stats()['by_zoom'][6]['average_bytes'],
+                           1000)
+
+        # later renders at the zoom still go ahead, on their own
+        reservation = budget.reserve(6)
+        self.assertEquals(1000, budget.in_use)
+        reservation.source_fetched(['x' * 100])
+        reservation.output_formatted(50)
+        reservation.release()
+        self.assertEquals(0, budget.in_use)
+        self.assertLess(budget.stats()['by_zoom'][6]['average_bytes'], 1400)
+
+    def test_rejects_oversized(self):
+        from tileserver.memory import MemoryBudget
+        from tileserver.memory import MemoryBudgetExceeded
+
+        budget = MemoryBudget(limit=1000, source_expansion=1)
+        reservation = budget.reserve(6)
+        with self.assertRaises(MemoryBudgetExceeded):
+            reservation.source_fetched(['x' * 2000])
+        reservation.release(completed=False)
+        self.assertEquals(0, budget.in_use)
+        self.assertEquals(1, budget.stats()['by_zoom'][6]['rejected'])
+
+    def test_waits_for_memory(self):
+        from tileserver.memory import MemoryBudget
+        from tileserver.memory import MemoryBudgetExceeded
+        import threading
+
+        budget = MemoryBudget(limit=1000, wait_timeout=0.05)
+        first = budget.reserve(6)
+        first.grow(800)
+
+        second = budget.reserve(6)
+        with self.assertRaises(MemoryBudgetExceeded):
+            second.grow(500)
+
+        # once the first render finishes, the second can go ahead
+        timer = threading.Timer(0.01, first.release)
+        timer.start()
+        budget.wait_timeout = 5
+        second.grow(500)
+        timer.join()
+        self.assertEquals(500, budget.in_use)
+        second.release()
+
+    def test_growers_waiting_on_each_other(self):
+        from tileserver.memory import MemoryBudget
+        from tileserver.memory import MemoryBudgetExceeded
+        import threading
+        import time
+
+        budget = MemoryBudget(limit=1000, wait_timeout=5)
+        budget.average_bytes[6] = 400
+        first = budget.reserve(6)
+        second = budget.reserve(6)
+
+        thread = threading.Thread(target=first.grow, args=(700,))
+        thread.start()
+        while not budget.growing:
+            time.sleep(0.001)
+
+        # the first is waiting on the second's memory, so the second
+        # can't wait on the first's
+        start = time.time()
+        with self.assertRaises(MemoryBudgetExceeded):
+            second.grow(700)
+        self.assertLess(time.time() - start, 1)
+
+        # which lets the first go ahead once the second is given up
+        second.release(completed=False)
+        thread.join()
+        self.assertEquals(700, budget.in_use)
+        self.assertEquals(0, budget.growing)
+        first.release()
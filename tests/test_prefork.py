@@ -0,0 +1,35 @@
+import unittest
+
+
+class PreforkTests(unittest.TestCase):
+    def _exit_status(self, exit_fn):
+        import os
+
+        pid = os.fork()
+        if pid == 0:
+            exit_fn()
+        _, status = os.waitpid(pid, 0)
+        return status
+
+    def test_describe_exit(self):
+        from tileserver.prefork import describe_exit
+        import os
+        import signal
+
+        status = self._exit_status(lambda: os._exit(3))
+        self.assertEquals('exited with code 3', describe_exit(status))
+
+        status = self._exit_status(
+            lambda: os.kill(os.getpid(), signal.SIGKILL))
+        self.assertEquals(
+            'was killed by signal %d' % signal.SIGKILL, describe_exit(status))
+
+    def test_respawn_delay(self):
+        from tileserver.prefork import MAX_RESPAWN_DELAY
+        from tileserver.prefork import RESPAWN_BACKOFF
+        from tileserver.prefork import respawn_delay
+
+        self.assertEquals(0, respawn_delay(0))
+        self.assertEquals(RESPAWN_BACKOFF, respawn_delay(1))
+        self.assertEquals(RESPAWN_BACKOFF * 4, respawn_delay(3))
+        self.assertEquals(MAX_RESPAWN_DELAY, respawn_delay(100))
@@ -0,0 +1,90 @@
+import unittest
+
+
+def fetch_rows(rows, layer_datum, delay=0):
+    import time
+    time.sleep(delay)
+    return rows, layer_datum, None
+
+
+def fail(layer_datum):
+    raise ValueError('query failed')
+
+
+class QuerySchedulerTests(unittest.TestCase):
+    def test_results_and_stats(self):
+        from tileserver.scheduler import QueryScheduler
+        from tileserver.scheduler import query_zoom
+
+        scheduler = QueryScheduler(min_limit=2, max_limit=4)
+        with query_zoom(6):
+            water = scheduler.apply_async(
+                fetch_rows, ([1, 2, 3], dict(name='water')))
+            roads = scheduler.apply_async(
+                fetch_rows, ([1], dict(name='roads')))
+        self.assertEquals([1, 2, 3], water.get()[0])
+        self.assertEquals([1], roads.get()[0])
+
+        stats = scheduler.stats()
+        self.assertEquals(0, stats['running'])
+        self.assertEquals(1, stats['layers']['water'][6]['queries'])
+        self.assertEquals(3, stats['layers']['water'][6]['mean_rows'])
+        self.assertEquals(1, stats['layers']['roads'][6]['mean_rows'])
+
+    def test_errors_raised_from_get(self):
+        from tileserver.scheduler import QueryScheduler
+
+        scheduler = QueryScheduler(min_limit=1, max_limit=2)
+        result = scheduler.apply_async(fail, (dict(name='water'),))
+        with self.assertRaises(ValueError):
+            result.get()
+        self.assertEquals(1, scheduler.stats()['layers']['water'][None][
+            'errors'])
+
+    def test_limit_bounds_concurrency(self):
+        from tileserver.scheduler import QueryScheduler
+
+        scheduler = QueryScheduler(min_limit=1, max_limit=1)
+        results = [scheduler.apply_async(
+            fetch_rows, ([], dict(name='water'), 0.05)) for i in range(3)]
+        stats = scheduler.stats()
+        self.assertEquals(1, stats['running'])
+        self.assertEquals(2, stats['waiting'])
+        for result in results:
+            result.get()
+        self.assertEquals(0, scheduler.stats()['waiting'])
+
+    def test_limit_adapts(self):
+        from tileserver.scheduler import QueryScheduler
+        from tileserver.scheduler import ScheduledQuery
+
+        scheduler = QueryScheduler(min_limit=2, max_limit=8, initial_limit=4)
+
+        def finish(elapsed, epoch=None):
+            query = ScheduledQuery(None, (), 'water', 10)
+            query.value = ([], None, None)
+            query.epoch = scheduler.epoch if epoch is None else epoch
+            scheduler.n_running = int(scheduler.limit)
+            scheduler._finished(query, elapsed)
+
+        # queries finishing in good time while the limit is used grow it
+        for i in range(8):
+            finish(0.1)
+        self.assertEquals(5, int(scheduler.limit))
+
+        # a slow one cuts it back, but only once for queries started
+        # before the cut
+        epoch = scheduler.epoch
+        limit = scheduler.limit
+        finish(1.0, epoch)
+        self.assertAlmostEqual(limit * 0.75, scheduler.limit)
+        finish(1.0, epoch)
+        self.assertAlmostEqual(limit * 0.75, scheduler.limit)
+
+        # and the limit isn't grown while it isn't all used
+        limit = scheduler.limit
+        scheduler.n_running = 0
+        query = ScheduledQuery(None, (), 'water', 10)
+        query.value = ([], None, None)
+        scheduler._finished(query, 0.1)
+        self.assertEquals(limit, scheduler.limit)
@@ -0,0 +1,177 @@
+import unittest
+
+
+class CacheModelTests(unittest.TestCase):
+    def test_lru(self):
+        from tileserver.simulate import LRUModel
+
+        model = LRUModel(300)
+        self.assertFalse(model.access('a', 100, 0))
+        self.assertFalse(model.access('b', 100, 0))
+        self.assertFalse(model.access('c', 100, 0))
+        self.assertTrue(model.access('a', 100, 0))
+        # b is least recently used, so makes room for d
+        self.assertFalse(model.access('d', 100, 0))
+        self.assertFalse(model.access('b', 100, 0))
+        self.assertTrue(model.access('a', 100, 0))
+        self.assertEquals(300, model.used)
+
+    def test_lfu(self):
+        from tileserver.simulate import LFUModel
+
+        model = LFUModel(200)
+        model.access('a', 100, 0)
+        model.access('a', 100, 0)
+        model.access('b', 100, 0)
+        # b has been used least, so makes room for c
+        self.assertFalse(model.access('c', 100, 0))
+        self.assertTrue(model.access('a', 100, 0))
+        self.assertFalse(model.access('b', 100, 0))
+        self.assertEquals(200, model.used)
+
+    def test_ttl(self):
+        from tileserver.simulate import TTLModel
+
+        model = TTLModel(60)
+        self.assertFalse(model.access('a', 100, 0))
+        self.assertTrue(model.access('a', 100, 30))
+        # reading it doesn't extend its life
+        self.assertFalse(model.access('a', 100, 60))
+        self.assertTrue(model.access('a', 100, 90))
+        self.assertEquals(100, model.used)
+
+    def test_ttl_with_capacity(self):
+        from tileserver.simulate import TTLModel
+
+        model = TTLModel(60, 200)
+        model.access('a', 100, 0)
+        model.access('b', 100, 1)
+        model.access('c', 100, 2)
+        self.assertEquals(200, model.used)
+        # a was evicted, and b and c expire on time
+        self.assertFalse(model.access('a', 100, 3))
+        model.access('d', 100, 62)
+        self.assertEquals(200, model.used)
+
+    def test_gdsf_prefers_small_tiles(self):
+        from tileserver.simulate import GDSFModel
+
+        model = GDSFModel(1000)
+        model.access('large', 800, 0)
+        model.access('small', 100, 0)
+        self.assertFalse(model.access('other', 200, 0))
+        self.assertTrue(model.access('small', 100, 0))
+        self.assertFalse(model.access('large', 800, 0))
+
+    def test_too_large(self):
+        from tileserver.simulate import create_model
+
+        for policy in ('lru:100', 'lfu:100', 'gdsf:100', 'ttl:60:100'):
+            model = create_model(policy)
+            self.assertFalse(model.access('a', 200, 0))
+            self.assertFalse(model.access('a', 200, 0))
+            self.assertEquals(0, model.used)
+
+    def test_create_model(self):
+        from tileserver.simulate import create_model
+        from tileserver.simulate import LRUModel
+        from tileserver.simulate import TTLModel
+
+        model = create_model('lru:2M')
+        self.assertIsInstance(model, LRUModel)
+        self.assertEquals(2 * 1024 * 1024, model.capacity)
+        model = create_model('ttl:900')
+        self.assertIsInstance(model, TTLModel)
+        self.assertIsNone(model.capacity)
+        with self.assertRaises(ValueError):
+            create_model('mru:1G')
+
+
+class LogParserTests(unittest.TestCase):
+    def _parser(self):
+        from tileserver import LayerConfig
+        from tileserver.simulate import LogParser
+
+        layer_config = LayerConfig(
+            ['roads', 'water'], [dict(name='roads'), dict(name='water')])
+        return LogParser(layer_config, set(['json', 'mvt']),
+                         {'512': 2}, default_size=500)
+
+    def test_parse(self):
+        parser = self._parser()
+        line = ('127.0.0.1 - - [10/Oct/2017:13:55:36 -0700] '
+                '"GET /512/water,roads/3/2/1.mvt HTTP/1.1" 200 2326')
+        now, cache_key, size = parser.parse(line)
+        self.assertEquals(2326, size)
+        self.assertEquals(2, cache_key.tile_size)
+        self.assertEquals('roads,water', cache_key.layers)
+        self.assertEquals((3, 2, 1), (cache_key.coord.zoom,
+                                      cache_key.coord.column,
+                                      cache_key.coord.row))
+
+        later = line.replace('13:55:36', '13:56:36')
+        self.assertEquals(60, parser.parse(later)[0] - now)
+
+    def test_not_modified_uses_default_size(self):
+        parser = self._parser()
+        line = ('127.0.0.1 - - [10/Oct/2017:13:55:36 -0700] '
+                '"GET /all/3/2/1.json HTTP/1.1" 304 -')
+        self.assertEquals(500, parser.parse(line)[2])
+
+    def test_server_time_formats(self):
+        parser = self._parser()
+        request = '"GET /all/3/2/1.json HTTP/1.1" 200 100'
+        times = []
+        for line in (
+                '127.0.0.1 - - [19/Oct/2026:08:00:00 +0000] %s' % request,
+                # gevent's pywsgi, followed by the time taken
+                '127.0.0.1 - - [2026-10-19 08:00:10] %s 0.001' % request,
+                # werkzeug
+                '127.0.0.1 - - [19/Oct/2026 08:00:20] %s' % request):
+            times.append(parser.parse(line)[0])
+        self.assertEquals([0, 10, 20], [x - times[0] for x in times])
+
+    def test_unreadable_time_skipped(self):
+        parser = self._parser()
+        line = ('127.0.0.1 - - [yesterday] '
+                '"GET /all/3/2/1.json HTTP/1.1" 200 100')
+        self.assertIsNone(parser.parse(line))
+        self.assertEquals(1, parser.n_unparsed)
+
+    def test_skipped(self):
+        parser = self._parser()
+        for path, status in (('/all/3/2/1.json', '404'),
+                             ('/buildings/3/2/1.json', '200'),
+                             ('/all/3/2/1.topojson', '200'),
+                             ('/preview.html', '200')):
+            line = ('127.0.0.1 - - [10/Oct/2017:13:55:36 -0700] '
+                    '"GET %s HTTP/1.1" %s 100' % (path, status))
+            self.assertIsNone(parser.parse(line))
+
+
+class SimulationTests(unittest.TestCase):
+    def test_report(self):
+        from ModestMaps.Core import Coordinate
+        from StringIO import StringIO
+        from tileserver.cache import CacheKey
+        from tileserver.simulate import create_model
+        from tileserver.simulate import Simulation
+        from tilequeue.format import lookup_format_by_extension
+
+        fmt = lookup_format_by_extension('mvt')
+        keys = [CacheKey(Coordinate(zoom=1, column=x, row=0), 1, 'all', fmt)
+                for x in range(2)]
+        out = StringIO()
+        simulation = Simulation(
+            [('lru:100', create_model('lru:100')),
+             ('unbounded', create_model('unbounded'))], 60, out)
+        for now, key in ((0, 0), (1, 1), (2, 0), (70, 1)):
+            simulation.add(now, keys[key], 100)
+        simulation.finish()
+
+        lru, unbounded = simulation.totals
+        self.assertEquals(0, lru.hits)
+        self.assertEquals(2, unbounded.hits)
+        self.assertEquals(200, unbounded.hit_bytes)
+        # two intervals and the overall report
+        self.assertEquals(3, out.getvalue().count('lru:100'))
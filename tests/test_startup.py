@@ -0,0 +1,160 @@
+import unittest
+
+
+def _generated_functions():
+    # functions compiled at runtime, like those generated from yaml
+    source = '\n'.join([
+        'from os.path import join',
+        'def output_fn(shape, props, fid, meta=None):',
+        '    return dict(kind=join("a", props["kind"]), meta=meta)',
+    ])
+    fn_globals = {}
+    exec compile(source, '<generated>', 'exec') in fn_globals
+    return dict(layer=fn_globals['output_fn'])
+
+
+class FunctionSerializationTests(unittest.TestCase):
+    def test_generated_function_round_trip(self):
+        from tileserver.startup import dump_functions, load_functions
+        import cPickle as pickle
+
+        dumped = dump_functions(_generated_functions())
+        self.assertIsNotNone(dumped)
+        loaded = load_functions(pickle.loads(pickle.dumps(dumped)))
+
+        result = loaded['layer'](None, dict(kind='b'), None)
+        self.assertEquals(dict(kind='a/b', meta=None), result)
+
+    def test_module_global_round_trip(self):
+        from tileserver.startup import dump_functions, load_functions
+        import cPickle as pickle
+
+        source = '\n'.join([
+            'import os.path',
+            'def output_fn(shape, props, fid, meta=None):',
+            '    return dict(kind=os.path.join("a", props["kind"]))',
+        ])
+        fn_globals = {}
+        exec compile(source, '<generated>', 'exec') in fn_globals
+
+        dumped = dump_functions(dict(layer=fn_globals['output_fn']))
+        self.assertIsNotNone(dumped)
+        loaded = load_functions(pickle.loads(pickle.dumps(dumped)))
+        self.assertEquals(
+            'a/b', loaded['layer'](None, dict(kind='b'), None)['kind'])
+
+    def test_importable_function_round_trip(self):
+        from tileserver.startup import dump_functions, load_functions
+        import os.path
+
+        dumped = dump_functions(dict(layer=os.path.join))
+        loaded = load_functions(dumped)
+        self.assertIs(os.path.join, loaded['layer'])
+
+    def test_closure_not_dumped(self):
+        from tileserver.startup import dump_functions
+
+        def make_fn(value):
+            return lambda: value
+
+        self.assertIsNone(dump_functions(dict(layer=make_fn(1))))
+
+
+class ArtifactCacheTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def test_store_load(self):
+        from tileserver.startup import ArtifactCache
+
+        c = ArtifactCache(self.path)
+        self.assertIsNone(c.load('abc'))
+
+        stored = c.store('abc', dict(
+            layer_data=[dict(name='water')],
+            output_calc_mapping=_generated_functions(),
+        ))
+        self.assertTrue(stored)
+
+        artifacts = c.load('abc')
+        self.assertEquals(['water'],
+                          [x['name'] for x in artifacts['layer_data']])
+        output_fn = artifacts['output_calc_mapping']['layer']
+        self.assertEquals(
+            'a/b', output_fn(None, dict(kind='b'), None)['kind'])
+
+    def test_buffered_layer_data(self):
+        from tileserver.startup import ArtifactCache
+        from tilequeue.config import create_query_bounds_pad_fn
+
+        buffer_cfg = dict(mvt=dict(layer=dict(water=dict(polygon=8))))
+        water = dict(name='water', query_bounds_pad_fn=(
+            create_query_bounds_pad_fn(buffer_cfg, 'water')))
+        c = ArtifactCache(self.path)
+        self.assertTrue(c.store('abc', dict(
+            all_layer_data=[water], layer_data=[water],
+            output_calc_mapping={}, buffer_cfg=buffer_cfg)))
+        # not changed by storing
+        self.assertIn('query_bounds_pad_fn', water)
+
+        artifacts = c.load('abc')
+        layer_datum = artifacts['layer_data'][0]
+        self.assertIs(layer_datum, artifacts['all_layer_data'][0])
+        padded = layer_datum['query_bounds_pad_fn']((0, 0, 10, 10), 1)
+        self.assertEquals((-8, -8, 18, 18), tuple(padded['polygon']))
+        self.assertEquals((0, 0, 10, 10), tuple(padded['point']))
+
+    def test_fingerprint_follows_yaml_files(self):
+        import os
+        from tileserver.startup import config_fingerprint
+
+        queries_path = os.path.join(self.path, 'queries.yaml')
+        with open(queries_path, 'w') as fp:
+            fp.write('layers: {}')
+        yaml_path = os.path.join(self.path, 'yaml')
+        os.mkdir(yaml_path)
+        layer_path = os.path.join(yaml_path, 'water.yaml')
+        with open(layer_path, 'w') as fp:
+            fp.write('filters: []')
+        yaml_config = dict(type='parse', parse=dict(path=yaml_path))
+
+        first = config_fingerprint(queries_path, {}, yaml_config)
+        self.assertEquals(
+            first, config_fingerprint(queries_path, {}, yaml_config))
+
+        with open(layer_path, 'w') as fp:
+            fp.write('filters: [{}]')
+        self.assertNotEquals(
+            first, config_fingerprint(queries_path, {}, yaml_config))
+
+    def test_resources_checked_on_load(self):
+        import os
+        from tileserver.startup import ArtifactCache
+        from tileserver.startup import hash_files
+        from tileserver.startup import resource_paths
+
+        queries_config = dict(post_process=[dict(
+            fn='vectordatasource.transform.csv_match_properties',
+            resources=dict(matcher=dict(
+                type='file', init_fn='vectordatasource.transform.CSVMatcher',
+                path='spreadsheets/scale_rank.csv')))])
+        os.mkdir(os.path.join(self.path, 'spreadsheets'))
+        csv_path = os.path.join(self.path, 'spreadsheets', 'scale_rank.csv')
+        with open(csv_path, 'w') as fp:
+            fp.write('kind,scale_rank\nocean,1\n')
+        paths = resource_paths(queries_config, self.path)
+        self.assertEquals([csv_path], paths)
+
+        c = ArtifactCache(os.path.join(self.path, 'cache'))
+        self.assertTrue(c.store('abc', dict(
+            output_calc_mapping={}, resource_hashes=hash_files(paths))))
+        self.assertIsNotNone(c.load('abc'))
+
+        with open(csv_path, 'w') as fp:
+            fp.write('kind,scale_rank\nocean,2\n')
+        self.assertIsNone(c.load('abc'))
@@ -14,13 +14,31 @@ from tilequeue.query import make_db_data_fetcher
 from tilequeue.tile import coord_to_mercator_bounds
 from tilequeue.utils import format_stacktrace_one_line
 from tileserver.cache import CacheKey
+from tileserver.cache import FileGenerationStore
+from tileserver.cache import InvalidatingCache
+from tileserver.cache import LockTimeout
 from tileserver.cache import NullCache
+from tileserver.cache import RedisGenerationStore
+from tileserver.memory import MemoryBudgetExceeded
+from tileserver.scheduler import query_zoom
+from tileserver.startup import ArtifactCache
+from tileserver.startup import config_fingerprint
+from tileserver.startup import hash_files
+from tileserver.startup import resource_paths
+from tileserver.startup import StartupTimer
+from werkzeug.http import http_date
+from werkzeug.utils import get_content_type
 from werkzeug.wrappers import Request
 from werkzeug.wrappers import Response
+import hashlib
+import json
+import math
 import os
 import os.path
 import psycopg2
 import random
+import re
+import time
 import yaml
 
 
@@ -35,6 +53,10 @@ def coord_is_valid(coord):
 
 RequestData = namedtuple('RequestData', 'layer_spec coord format tile_size')
 
+# the paths that parse_request_path can accept, with an optional prefix
+TILE_PATH_RE = re.compile(
+    r'^/(?:([^/]+)/)?([^/]+)/([0-9]+)/([0-9]+)/([0-9]+)\.([^/.]+)$')
+
 
 def parse_request_path(
         path, extensions_to_handle, path_tile_size, max_interesting_zoom):
@@ -114,6 +136,11 @@ def parse_layer_spec(layer_spec, layer_config):
         layer_data, unique_layer_names, sorted_layer_names)
 
 
+# the formatted tile as a list of strings, and its signature from
+# tileserver.coverage.uniform_signature if it was empty or uniform
+RenderResult = namedtuple('RenderResult', 'chunks uniform')
+
+
 def calculate_nominal_zoom(zoom, tile_size):
     assert tile_size >= 1
     return zoom + tile_size - 1
@@ -125,11 +152,18 @@ class TileServer(object):
     # we want this during development, but not during production
     propagate_errors = False
 
+    # number of layer specs to remember the parsed form of
+    max_layer_specs = 1024
+
     def __init__(
             self, layer_config, extensions, data_fetcher, post_process_data,
             io_pool, cache, buffer_cfg, formats, health_checker=None,
             add_cors_headers=False, max_age=None, path_tile_size=None,
-            max_interesting_zoom=None, output_calc_mapping=None):
+            max_interesting_zoom=None, output_calc_mapping=None,
+            render_pool=None, io_factory=None, serve_stale=False,
+            coverage_index=None, memory_budget=None, stream_json=False,
+            stats_handler=None, failure_cache=None, fast_hits=False,
+            heatmap=None, heatmap_handler=None, warm_up=None):
         self.layer_config = layer_config
         self.extensions = extensions
         self.data_fetcher = data_fetcher
@@ -144,8 +178,71 @@ class TileServer(object):
         self.path_tile_size = path_tile_size or {}
         self.max_interesting_zoom = max_interesting_zoom or 20
         self.output_calc_mapping = output_calc_mapping
+        # optional pool used to run renders away from the thread that is
+        # serving the request, anything with a blocking apply(fn, args)
+        self.render_pool = render_pool
+        # optional callable returning a fresh (data_fetcher, io_pool)
+        # pair, used to recreate threads and connections after a fork
+        self.io_factory = io_factory
+        # whether to serve invalidated tiles while they're re-rendered
+        self.serve_stale = serve_stale
+        # optional index of tiles known to render empty
+        self.coverage_index = coverage_index
+        # optional limit on the memory that renders may use at once
+        self.memory_budget = memory_budget
+        # whether to format json tiles a layer at a time
+        self.stream_json = stream_json
+        self.stats_handler = stats_handler
+        # optional memory of failed renders and unknown layer specs
+        self.failure_cache = failure_cache
+        # whether to answer cache hits before building a werkzeug request
+        self.fast_hits = fast_hits
+        # layer spec -> (LayerSpecParseResult, cache key layer names)
+        self.layer_spec_memo = {}
+        # extension -> (format, headers before content length)
+        self.hit_formats = {}
+        for extension in self.extensions:
+            format = extension_to_format[extension]
+            headers = []
+            if self.add_cors_headers:
+                headers.append(('Access-Control-Allow-Origin', '*'))
+            headers.append(('Content-Type',
+                            get_content_type(format.mimetype, 'utf-8')))
+            if self.max_age:
+                headers.append(
+                    ('Cache-Control', 'max-age=%d' % self.max_age))
+            self.hit_formats[extension] = (format, tuple(headers))
+        # (second, formatted date) for the date header of hits
+        self.hit_date = (None, None)
+        # optional counts of where tiles are requested
+        self.heatmap = heatmap
+        self.heatmap_handler = heatmap_handler
+        # optional rendering of previously popular tiles, once serving
+        self.warm_up = warm_up
+
+    def start_warm_up(self, spawn=None):
+        """
+        Start warming up the cache in the background, if configured. This
+        should be called once the server is ready to serve, in the process
+        which will serve.
+        """
+        if self.warm_up is not None:
+            self.warm_up.start(self, spawn)
+
+    def reset_io(self):
+        """recreate the io pool and data fetcher
+
+        thread pools and database connections do not survive a fork, so
+        this should be called in any child process before it renders"""
+        assert self.io_factory, 'No io factory configured'
+        self.data_fetcher, self.io_pool = self.io_factory()
 
     def __call__(self, environ, start_response):
+        if self.fast_hits:
+            response = self.handle_hit(environ, start_response)
+            if response is not None:
+                return response
+
         request = Request(environ)
         try:
             response = self.handle_request(request)
@@ -159,10 +256,92 @@ class TileServer(object):
                 request, 500, 'Internal Server Error', 'text/plain')
         return response(environ, start_response)
 
+    def handle_hit(self, environ, start_response):
+        """
+        Answer a request for a tile which is already cached, without the
+        general request handling. Returns None for anything else, which
+        should be left to handle_request.
+        """
+        # conditional and partial requests are left to werkzeug
+        if (environ.get('REQUEST_METHOD') != 'GET' or
+                'HTTP_IF_NONE_MATCH' in environ or
+                'HTTP_IF_MODIFIED_SINCE' in environ or
+                'HTTP_RANGE' in environ):
+            return None
+
+        match = TILE_PATH_RE.match(environ.get('PATH_INFO', ''))
+        if match is None:
+            return None
+        prefix, layer_spec, zoom, column, row, extension = match.groups()
+        if prefix is None:
+            tile_size = 1
+        else:
+            tile_size = self.path_tile_size.get(prefix)
+            if tile_size is None:
+                return None
+        hit_format = self.hit_formats.get(extension)
+        if hit_format is None:
+            return None
+        zoom, column, row = int(zoom), int(column), int(row)
+        max_coord = 1 << zoom
+        if (column >= max_coord or row >= max_coord or
+                zoom > self.max_interesting_zoom):
+            return None
+        layer_spec_memo = self.parse_layer_spec(layer_spec)
+        if layer_spec_memo is None:
+            return None
+
+        format, headers = hit_format
+        coord = Coordinate(zoom=zoom, column=column, row=row)
+        cache_key = CacheKey(coord, tile_size, layer_spec_memo[1], format)
+        try:
+            tile_data = self.cache.get(cache_key)
+        except Exception:
+            # handle_request reports the error
+            return None
+        if tile_data is None:
+            return None
+        self.record_outcome(cache_key, 'hit')
+
+        # the same headers that create_response would give it
+        now = int(time.time())
+        date_second, date = self.hit_date
+        if date_second != now:
+            date = http_date(now)
+            self.hit_date = (now, date)
+        start_response('200 OK', list(headers) + [
+            ('Content-Length', str(len(tile_data))),
+            ('ETag', '"%s"' % hashlib.md5(tile_data).hexdigest()),
+            ('Date', date),
+            ('Accept-Ranges', 'none'),
+        ])
+        return [tile_data]
+
+    def parse_layer_spec(self, layer_spec):
+        """
+        parse_layer_spec, remembering the results for known layer specs.
+        Returns (LayerSpecParseResult, cache key layer names), or None.
+        """
+        memo = self.layer_spec_memo.get(layer_spec)
+        if memo is None:
+            result = parse_layer_spec(layer_spec, self.layer_config)
+            if result is None:
+                return None
+            memo = (result, ','.join(result.sorted_layer_names))
+            if len(self.layer_spec_memo) >= self.max_layer_specs:
+                self.layer_spec_memo.clear()
+            self.layer_spec_memo[layer_spec] = memo
+        return memo
+
+    def record_outcome(self, cache_key, outcome):
+        """count how a request for a tile was answered"""
+        if self.heatmap is not None:
+            self.heatmap.record(cache_key, outcome)
+
     def generate_404(self, request):
         return self.create_response(request, 404, 'Not Found', 'text/plain')
 
-    def create_response(self, request, status, body, mimetype):
+    def _response_args(self, status, mimetype):
         response_args = dict(
             status=status,
             mimetype=mimetype,
@@ -174,7 +353,10 @@ class TileServer(object):
             headers.append(('Cache-Control', 'max-age=%d' % self.max_age))
         if headers:
             response_args['headers'] = headers
-        response = Response(body, **response_args)
+        return response_args
+
+    def create_response(self, request, status, body, mimetype):
+        response = Response(body, **self._response_args(status, mimetype))
 
         if status == 200:
             response.add_etag()
@@ -182,6 +364,21 @@ class TileServer(object):
 
         return response
 
+    def create_chunked_response(self, request, chunks, mimetype):
+        """a tile response sent as it is, without joining it together"""
+        if len(chunks) == 1:
+            return self.create_response(request, 200, chunks[0], mimetype)
+
+        # the same etag as add_etag would give the joined up tile
+        md5 = hashlib.md5()
+        for chunk in chunks:
+            md5.update(chunk)
+        response = Response(chunks, **self._response_args(200, mimetype))
+        response.headers['Content-Length'] = str(sum(len(x) for x in chunks))
+        response.set_etag(md5.hexdigest())
+        response.make_conditional(request)
+        return response
+
     def preview_static(self, request):
         with open('preview.html') as f:
             return self.create_response(
@@ -192,6 +389,14 @@ class TileServer(object):
                 self.health_checker.is_health_check(request)):
             return self.health_checker(request)
 
+        if (self.stats_handler and
+                self.stats_handler.is_stats_request(request)):
+            return self.stats_handler(request)
+
+        if (self.heatmap_handler and
+                self.heatmap_handler.is_heatmap_request(request)):
+            return self.heatmap_handler(request)
+
         if request.path == '/preview.html':
             return self.preview_static(request)
 
@@ -203,61 +408,217 @@ class TileServer(object):
             return self.generate_404(request)
 
         layer_spec = request_data.layer_spec
-        layer_spec_result = parse_layer_spec(request_data.layer_spec,
-                                             self.layer_config)
-        if layer_spec_result is None:
+        if (self.failure_cache is not None and
+                self.failure_cache.is_not_found(layer_spec)):
+            return self.generate_404(request)
+        layer_spec_memo = self.parse_layer_spec(layer_spec)
+        if layer_spec_memo is None:
+            if self.failure_cache is not None:
+                self.failure_cache.record_not_found(layer_spec)
             return self.generate_404(request)
 
+        layer_spec_result, cache_key_layer_names = layer_spec_memo
         unique_layer_names = layer_spec_result.unique_layer_names
-        sorted_layer_names = layer_spec_result.sorted_layer_names
-        cache_key_layer_names = ','.join(sorted_layer_names)
 
         coord = request_data.coord
         format = request_data.format
         tile_size = request_data.tile_size
-        scale = 4096 * tile_size
 
         cache_key = CacheKey(coord, tile_size, cache_key_layer_names, format)
-        with self.cache.lock(cache_key):
-            tile_data = self.cache.get(cache_key)
 
+        # tiles known to be empty or uniform are answered without rendering
+        if self.coverage_index is not None:
+            tile_data = self.coverage_index.get_template(
+                cache_key, self.cache.generation)
             if tile_data is not None:
+                self.record_outcome(cache_key, 'template')
                 return self.create_response(
                     request, 200, tile_data, format.mimetype)
 
-            nominal_zoom = calculate_nominal_zoom(coord.zoom, tile_size)
+        # if an out of date copy of the tile is available, serve that
+        # rather than wait for someone else to finish re-rendering it
+        lock_kwargs = {}
+        stale_data = None
+        if self.serve_stale:
+            tile_data = self.cache.get(cache_key)
+            if tile_data is not None:
+                self.record_outcome(cache_key, 'hit')
+                return self.create_response(
+                    request, 200, tile_data, format.mimetype)
+            stale_data = self.cache.get_stale(cache_key)
+            if stale_data is not None:
+                lock_kwargs['timeout'] = 0
+
+        # tiles which recently failed to render aren't retried until
+        # they've been left alone for a while, so there's no need to wait
+        # for the lock. they may have been rendered elsewhere since.
+        if self.failure_cache is not None:
+            retry_after = self.failure_cache.suppressed(cache_key)
+            if retry_after is not None:
+                tile_data = self.cache.get(cache_key)
+                if tile_data is not None:
+                    self.record_outcome(cache_key, 'hit')
+                    return self.create_response(
+                        request, 200, tile_data, format.mimetype)
+                return self._suppressed_response(
+                    request, cache_key, retry_after, stale_data)
 
-            # fetch data for all layers, even if the request was for a partial
-            # set. this ensures that we can always store the result, allowing
-            # for reuse, but also that any post-processing functions which
-            # might have dependencies on multiple layers will still work
-            # properly (e.g: buildings or roads layer being cut against
-            # landuse).
-            unpadded_bounds = coord_to_mercator_bounds(coord)
+        try:
+            with self.cache.lock(cache_key, **lock_kwargs):
+                tile_data = self.cache.get(cache_key)
+
+                if tile_data is not None:
+                    self.record_outcome(cache_key, 'hit')
+                    return self.create_response(
+                        request, 200, tile_data, format.mimetype)
+
+                # checked again, as the tile may have failed for whoever
+                # held the lock before us
+                if self.failure_cache is not None:
+                    retry_after = self.failure_cache.suppressed(cache_key)
+                    if retry_after is not None:
+                        return self._suppressed_response(
+                            request, cache_key, retry_after, stale_data)
+
+                # the tile is stored as of the generation before it was
+                # rendered, so that an invalidation during the render
+                # isn't lost
+                generation = self.cache.generation(coord)
+
+                render_args = (coord, format, tile_size, layer_spec,
+                               unique_layer_names)
+                try:
+                    if self.render_pool is not None:
+                        render_result = self.render_pool.apply(
+                            self.render_tile, render_args)
+                    else:
+                        render_result = self.render_tile(*render_args)
+                except MemoryBudgetExceeded:
+                    # not the tile's fault
+                    raise
+                except Exception:
+                    self.record_outcome(cache_key, 'error')
+                    if self.failure_cache is not None:
+                        self.failure_cache.record_failure(cache_key)
+                    raise
+                if self.failure_cache is not None:
+                    self.failure_cache.record_success(cache_key)
+                chunks = render_result.chunks
+                self.record_outcome(cache_key, 'miss')
+
+                self.cache.set_chunks(cache_key, chunks, generation)
+
+                if render_result.uniform is not None:
+                    self.coverage_index.record(
+                        cache_key, render_result.uniform, ''.join(chunks),
+                        generation, self.cache.generation)
+        except LockTimeout:
+            if stale_data is None:
+                raise
+            self.record_outcome(cache_key, 'stale')
+            return self.create_response(
+                request, 200, stale_data, format.mimetype)
+        except MemoryBudgetExceeded as e:
+            print 'Rejected render of %s: %s' % (request.path, e)
+            if stale_data is not None:
+                self.record_outcome(cache_key, 'stale')
+                return self.create_response(
+                    request, 200, stale_data, format.mimetype)
+            self.record_outcome(cache_key, 'rejected')
+            return self.create_response(
+                request, 503, 'Service Unavailable', 'text/plain')
 
-            for fetcher, _ in self.data_fetcher.fetch_tiles(dict(coord=coord)):
-                source_rows = fetcher(nominal_zoom, unpadded_bounds)
+        response = self.create_chunked_response(
+            request, chunks, format.mimetype)
+        return response
 
-            feature_layers = convert_source_data_to_feature_layers(
-                source_rows, self.layer_config.layer_data, unpadded_bounds,
-                nominal_zoom)
+    def _suppressed_response(self, request, cache_key, retry_after,
+                             stale_data):
+        if stale_data is not None:
+            self.record_outcome(cache_key, 'stale')
+            return self.create_response(
+                request, 200, stale_data, cache_key.fmt.mimetype)
+        self.record_outcome(cache_key, 'suppressed')
+        response = self.create_response(
+            request, 500, 'Internal Server Error', 'text/plain')
+        response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return response
 
-            processed_feature_layers, extra_data = process_coord_no_format(
-                feature_layers,
-                nominal_zoom,
-                unpadded_bounds,
-                self.post_process_data,
-                self.output_calc_mapping,
-            )
+    def render_tile(self, coord, format, tile_size, layer_spec,
+                    unique_layer_names):
+        """fetch, process and format a single tile"""
+        scale = 4096 * tile_size
+        nominal_zoom = calculate_nominal_zoom(coord.zoom, tile_size)
 
-            if layer_spec != 'all':
-                kept_feature_layers = []
-                for feature_layer in processed_feature_layers:
-                    name = feature_layer['layer_datum']['name']
-                    if name in unique_layer_names:
-                        kept_feature_layers.append(feature_layer)
-                processed_feature_layers = kept_feature_layers
+        reservation = None
+        if self.memory_budget is not None:
+            reservation = self.memory_budget.reserve(nominal_zoom)
+        completed = False
+        try:
+            render_result = self._render_tile(
+                coord, format, nominal_zoom, scale, layer_spec,
+                unique_layer_names, reservation)
+            completed = True
+        finally:
+            if reservation is not None:
+                reservation.release(completed)
+        return render_result
+
+    def _render_tile(self, coord, format, nominal_zoom, scale, layer_spec,
+                     unique_layer_names, reservation):
+        # fetch data for all layers, even if the request was for a partial
+        # set. this ensures that we can always store the result, allowing
+        # for reuse, but also that any post-processing functions which
+        # might have dependencies on multiple layers will still work
+        # properly (e.g: buildings or roads layer being cut against
+        # landuse).
+        unpadded_bounds = coord_to_mercator_bounds(coord)
+
+        with query_zoom(nominal_zoom):
+            for fetcher, _ in self.data_fetcher.fetch_tiles(
+                    dict(coord=coord)):
+                source_rows = fetcher(nominal_zoom, unpadded_bounds)
 
+        if reservation is not None:
+            reservation.source_fetched(source_rows)
+
+        # each stage is dropped as soon as the next has been built from
+        # it, so that no more than two are held at once
+        feature_layers = convert_source_data_to_feature_layers(
+            source_rows, self.layer_config.layer_data, unpadded_bounds,
+            nominal_zoom)
+        del source_rows
+
+        processed_feature_layers, extra_data = process_coord_no_format(
+            feature_layers,
+            nominal_zoom,
+            unpadded_bounds,
+            self.post_process_data,
+            self.output_calc_mapping,
+        )
+        del feature_layers
+
+        # before filtering, as the tile is only uniform if every layer is
+        if self.coverage_index is not None:
+            from tileserver.coverage import uniform_signature
+            uniform = uniform_signature(processed_feature_layers)
+        else:
+            uniform = None
+
+        if layer_spec != 'all':
+            kept_feature_layers = []
+            for feature_layer in processed_feature_layers:
+                name = feature_layer['layer_datum']['name']
+                if name in unique_layer_names:
+                    kept_feature_layers.append(feature_layer)
+            processed_feature_layers = kept_feature_layers
+
+        if (self.stream_json and format.extension == 'json' and
+                len(processed_feature_layers) > 1):
+            chunks = self._format_json_chunks(
+                coord, nominal_zoom, processed_feature_layers,
+                unpadded_bounds, extra_data, scale)
+        else:
             formatted_tiles, extra_data = format_coord(
                 coord,
                 nominal_zoom,
@@ -269,15 +630,42 @@ class TileServer(object):
                 extra_data,
                 scale,
             )
-
             assert len(formatted_tiles) == 1
-            tile_data = formatted_tiles[0]['tile']
-
-            self.cache.set(cache_key, tile_data)
-
-        response = self.create_response(
-            request, 200, tile_data, format.mimetype)
-        return response
+            chunks = [formatted_tiles[0]['tile']]
+
+        if reservation is not None:
+            reservation.output_formatted(sum(len(x) for x in chunks))
+        return RenderResult(chunks, uniform)
+
+    def _format_json_chunks(self, coord, nominal_zoom, feature_layers,
+                            unpadded_bounds, extra_data, scale):
+        # the same as formatting all the layers at once, but each layer's
+        # features are dropped as soon as it has been formatted, and the
+        # output is kept in pieces rather than joined into one string.
+        # the whole tile is still formatted before any of it is sent, as
+        # it's cached, and may come from a render process.
+        chunks = ['{']
+        while feature_layers:
+            feature_layer = feature_layers.pop(0)
+            formatted_tiles, extra_data = format_coord(
+                coord,
+                nominal_zoom,
+                [feature_layer],
+                (json_format,),
+                unpadded_bounds,
+                [coord],
+                self.buffer_cfg,
+                extra_data,
+                scale,
+            )
+            assert len(formatted_tiles) == 1
+            if len(chunks) > 1:
+                chunks.append(',')
+            chunks.append('%s:' % json.dumps(feature_layer['name']))
+            chunks.append(formatted_tiles[0]['tile'])
+            del formatted_tiles, feature_layer
+        chunks.append('}')
+        return chunks
 
 
 class LayerConfig(object):
@@ -293,17 +681,23 @@ class LayerConfig(object):
 
 class HealthChecker(object):
 
-    def __init__(self, url, conn_info):
+    def __init__(self, url, conn_info, db_pool=None):
         self.url = url
         conn_info_dbnames = conn_info.copy()
         self.dbnames = conn_info_dbnames.pop('dbnames')
         assert len(self.dbnames) > 0
         self.conn_info_no_dbname = conn_info_dbnames
+        # when there's a pool, its background probes are reported instead
+        # of connecting to the database on each check
+        self.db_pool = db_pool
 
     def is_health_check(self, request):
         return request.path == self.url
 
     def __call__(self, request):
+        if self.db_pool is not None:
+            return self.pool_health()
+
         dbname = random.choice(self.dbnames)
         conn_info = dict(self.conn_info_no_dbname, dbname=dbname)
         conn = psycopg2.connect(**conn_info)
@@ -319,6 +713,125 @@ class HealthChecker(object):
             conn.close()
         return Response('OK', mimetype='text/plain')
 
+    def pool_health(self):
+        # rather than report unknown until the prober gets going
+        self.db_pool.ensure_probed()
+        healthy = False
+        lines = []
+        for dbname, stats in sorted(self.db_pool.stats().items()):
+            if not self.db_pool.is_fresh(stats):
+                state = 'unknown'
+            elif stats['healthy']:
+                state = 'healthy'
+                healthy = True
+            else:
+                state = 'unhealthy'
+            rtt_ms = stats['rtt_ms']
+            rtt = '-' if rtt_ms is None else '%.2fms' % rtt_ms
+            lines.append('%s %s rtt=%s in_use=%d idle=%d' % (
+                dbname, state, rtt, stats['in_use'], stats['idle']))
+
+        status = 200 if healthy else 503
+        lines.insert(0, 'OK' if healthy else 'Unhealthy')
+        return Response('\n'.join(lines), status=status,
+                        mimetype='text/plain')
+
+
+class StatsHandler(object):
+    """reports statistics kept by parts of the server, as json
+
+    sources maps a name to a callable returning that part's statistics.
+    each process keeps its own, so with several workers a request only
+    sees the worker which answered it."""
+
+    def __init__(self, url, sources=None):
+        self.url = url
+        self.sources = sources or {}
+
+    def is_stats_request(self, request):
+        return request.path == self.url
+
+    def __call__(self, request):
+        stats = dict((name, fn()) for name, fn in self.sources.items())
+        return Response(json.dumps(stats, sort_keys=True),
+                        mimetype='application/json')
+
+
+def create_cache_from_config(config):
+    """create the tile cache described by the yaml configuration"""
+    cache = NullCache()
+    generation_store = None
+    cache_config = config.get('cache') or os.environ.get('CACHE_TYPE')
+    if cache_config:
+        cache_type = os.environ.get('CACHE_TYPE') or cache_config.get('type')
+        if cache_type == 'redis':
+            import redis
+            from tileserver.cache import RedisCache
+
+            redis_config = cache_config.get('redis', {})
+            redis_url = os.environ.get('REDIS_URL')
+            if not redis_url:
+                redis_url = redis_config.get('url')
+
+            redis_client = redis.from_url(redis_url)
+            redis_options = redis_config.get('options') or {}
+            cache = RedisCache(redis_client, **redis_options)
+            generation_store = RedisGenerationStore(
+                redis_client, cache.key_prefix)
+
+        elif cache_type == 'sharded-redis':
+            import redis
+            from tileserver.cache import ShardedRedisCache
+
+            sharded_config = cache_config.get('sharded-redis', {})
+            redis_urls = os.environ.get('REDIS_URLS')
+            if redis_urls:
+                redis_urls = redis_urls.split(',')
+            else:
+                redis_urls = sharded_config.get('urls')
+            assert redis_urls, 'Missing redis urls'
+
+            redis_clients = [redis.from_url(x) for x in redis_urls]
+            redis_options = sharded_config.get('options') or {}
+            cache = ShardedRedisCache(
+                redis_clients, node_names=redis_urls, **redis_options)
+            # counters are read for every tile, so they're kept together
+            # on one server rather than spread out
+            generation_store = RedisGenerationStore(
+                redis_clients[0], cache.key_prefix)
+
+        elif cache_type == 'file':
+            from tileserver.cache import FileCache
+            file_config = cache_config.get('file', {})
+            cache = FileCache(file_config.get('prefix'))
+            generation_store = FileGenerationStore(
+                os.path.join(file_config.get('prefix'), 'generations'))
+
+    # an optional hot tile cache in shared memory, in front of any other
+    # cache. it's shared by all workers forked from this process.
+    hot_cache_config = (config.get('cache') or {}).get('hot')
+    if hot_cache_config:
+        from tileserver.cache import SharedMemoryCache
+        cache = SharedMemoryCache(
+            int(hot_cache_config['size']),
+            int(hot_cache_config.get('slot-size', 65536)),
+            cache)
+
+    # optionally allow areas of the cache to be invalidated, checking
+    # each tile's generation when it's read. this goes in front of any
+    # hot cache, so that those tiles are checked too.
+    invalidation_config = (config.get('cache') or {}).get('invalidation')
+    if invalidation_config:
+        assert generation_store is not None, \
+            'Invalidation needs a redis or file cache'
+        cache = InvalidatingCache(
+            cache, generation_store,
+            bucket_zoom=int(invalidation_config.get('bucket-zoom', 10)),
+            refresh_interval=float(
+                invalidation_config.get('refresh-interval', 1)))
+
+    return cache
+
 
 def create_tileserver_from_config(config):
     """create a tileserve object from yaml configuration"""
@@ -341,10 +854,58 @@ def create_tileserver_from_config(config):
         extensions = set(['json', 'topojson', 'mvt'])
         formats = [json_format, topojson_format, mvt_format]
 
-    with open(queries_config_path) as query_cfg_fp:
-        queries_config = yaml.load(query_cfg_fp)
-    all_layer_data, layer_data, post_process_data = parse_layer_data(
-        queries_config, buffer_cfg, os.path.dirname(queries_config_path))
+    yaml_config = config.get('yaml')
+    assert yaml_config, 'Missing yaml configuration'
+
+    startup_timer = StartupTimer()
+
+    # the compiled configuration can be cached between starts, keyed by
+    # a hash of everything that goes into it
+    artifacts = None
+    artifact_cache = None
+    startup_cache_config = config.get('startup-cache')
+    if startup_cache_config:
+        artifact_cache = ArtifactCache(startup_cache_config['path'])
+        with startup_timer.phase('fingerprint config'):
+            fingerprint = config_fingerprint(
+                queries_config_path, buffer_cfg, yaml_config)
+        with startup_timer.phase('load cached config'):
+            artifacts = artifact_cache.load(fingerprint)
+
+    if artifacts is None:
+        with startup_timer.phase('parse queries config'):
+            with open(queries_config_path) as query_cfg_fp:
+                queries_config = yaml.load(query_cfg_fp)
+        with startup_timer.phase('parse layer data'):
+            all_layer_data, layer_data, post_process_data = \
+                parse_layer_data(queries_config, buffer_cfg,
+                                 os.path.dirname(queries_config_path))
+        with startup_timer.phase('compile yaml'):
+            output_calc_mapping = make_output_calc_mapping(yaml_config)
+
+        if artifact_cache:
+            with startup_timer.phase('store cached config'):
+                stored = artifact_cache.store(fingerprint, dict(
+                    queries_config=queries_config,
+                    all_layer_data=all_layer_data,
+                    layer_data=layer_data,
+                    post_process_data=post_process_data,
+                    output_calc_mapping=output_calc_mapping,
+                    buffer_cfg=buffer_cfg,
+                    resource_hashes=hash_files(resource_paths(
+                        queries_config,
+                        os.path.dirname(queries_config_path))),
+                ))
+            if not stored:
+                print 'Startup: compiled config could not be cached'
+    else:
+        print 'Startup: using cached config %s' % fingerprint
+        queries_config = artifacts['queries_config']
+        all_layer_data = artifacts['all_layer_data']
+        layer_data = artifacts['layer_data']
+        post_process_data = artifacts['post_process_data']
+        output_calc_mapping = artifacts['output_calc_mapping']
+
     all_layer_names = [x['name'] for x in all_layer_data]
     layer_config = LayerConfig(all_layer_names, layer_data)
 
@@ -359,57 +920,158 @@ def create_tileserver_from_config(config):
         conn_info['password'] = parsed.password
         conn_info['dbnames'] = [parsed.path[1:]]
     n_conn = len(layer_data)
-    io_pool = ThreadPool(n_conn)
-
-    data_fetcher = make_db_data_fetcher(
-        conn_info, template_path, reload_templates, queries_config, io_pool)
-
-    cache = NullCache()
-    cache_config = config.get('cache') or os.environ.get('CACHE_TYPE')
-    if cache_config:
-        cache_type = os.environ.get('CACHE_TYPE') or cache_config.get('type')
-        if cache_type == 'redis':
-            import redis
-            from tileserver.cache import RedisCache
-
-            redis_config = cache_config.get('redis', {})
-            redis_url = os.environ.get('REDIS_URL')
-            if not redis_url:
-                redis_url = redis_config.get('url')
-
-            redis_client = redis.from_url(redis_url)
-            redis_options = redis_config.get('options') or {}
-            cache = RedisCache(redis_client, **redis_options)
 
-        elif cache_type == 'file':
-            from tileserver.cache import FileCache
-            file_config = cache_config.get('file', {})
-            cache = FileCache(file_config.get('prefix'))
+    db_pool = None
+    db_pool_config = config.get('database-pool')
+    if db_pool_config:
+        from tileserver.database import DatabasePool
+        db_pool = DatabasePool(
+            conn_info,
+            max_idle=int(db_pool_config.get('max-idle', 2 * n_conn)),
+            probe_interval=float(db_pool_config.get('probe-interval', 5)))
+
+    scheduler_config = config.get('query-scheduler')
+
+    def io_factory():
+        if scheduler_config:
+            # one pool for the queries of all renders in the process,
+            # running as many as the database can keep up with
+            from tileserver.scheduler import QueryScheduler
+            io_pool = QueryScheduler(
+                min_limit=int(scheduler_config.get('min-limit', n_conn)),
+                max_limit=int(scheduler_config.get('max-limit', 4 * n_conn)),
+                initial_limit=scheduler_config.get('initial-limit'),
+                tolerance=float(scheduler_config.get('tolerance', 2)),
+                backoff=float(scheduler_config.get('backoff', 0.75)))
+        else:
+            io_pool = ThreadPool(n_conn)
+        data_fetcher = make_db_data_fetcher(
+            conn_info, template_path, reload_templates, queries_config,
+            io_pool)
+        if db_pool is not None:
+            # swap tilequeue's pool, which connects afresh for each
+            # render, for the shared one
+            if hasattr(data_fetcher, 'sql_conn_pool'):
+                data_fetcher.sql_conn_pool = db_pool
+            else:
+                print 'Data fetcher has no connection pool to replace'
+            # this is also run after a fork, so that the prober is going
+            # in a worker before its first health check
+            db_pool.start()
+        return data_fetcher, io_pool
+
+    with startup_timer.phase('create data fetcher'):
+        data_fetcher, io_pool = io_factory()
+
+    cache = create_cache_from_config(config)
 
     health_checker = None
     health_check_config = config.get('health')
     if health_check_config:
         health_check_url = health_check_config['url']
-        health_checker = HealthChecker(health_check_url, conn_info)
+        health_checker = HealthChecker(health_check_url, conn_info, db_pool)
 
     http_cfg = config.get('http', {})
     add_cors_headers = bool(http_cfg.get('cors', False))
     max_age = http_cfg.get('max-age')
     if max_age is not None:
         max_age = int(max_age)
+    fast_hits = bool(http_cfg.get('fast-hits', False))
 
     path_tile_size = config.get('path_tile_size')
     max_interesting_zoom = config.get('max_interesting_zoom')
 
-    yaml_config = config.get('yaml')
-    assert yaml_config, 'Missing yaml configuration'
-
-    output_calc_mapping = make_output_calc_mapping(yaml_config)
+    coverage_index = None
+    coverage_config = config.get('coverage')
+    if coverage_config:
+        from tileserver.coverage import CoverageIndex
+        coverage_index = CoverageIndex(
+            int(coverage_config.get('max-data-zoom', 16)),
+            int(coverage_config.get('max-entries', 1000000)))
+
+    invalidation_config = (config.get('cache') or {}).get('invalidation')
+    serve_stale = bool(
+        invalidation_config and invalidation_config.get('serve-stale'))
+
+    render_config = config.get('render', {})
+    stream_json = bool(render_config.get('stream-json', False))
+    memory_budget = None
+    memory_config = render_config.get('memory')
+    if memory_config:
+        from tileserver.memory import MemoryBudget
+        limit = memory_config.get('limit')
+        memory_budget = MemoryBudget(
+            None if limit is None else int(limit),
+            float(memory_config.get('wait-timeout', 10)),
+            float(memory_config.get('source-expansion', 3)))
+
+    failure_cache = None
+    failures_config = config.get('failures')
+    if failures_config:
+        from tileserver.failures import FailureCache
+        failure_cache = FailureCache(
+            float(failures_config.get('backoff', 1)),
+            float(failures_config.get('max-backoff', 300)),
+            float(failures_config.get('not-found-ttl', 60)),
+            int(failures_config.get('max-entries', 10000)))
+
+    heatmap = None
+    heatmap_handler = None
+    warm_up = None
+    heatmap_config = config.get('heatmap')
+    if heatmap_config:
+        from tileserver.heatmap import Heatmap
+        from tileserver.heatmap import HeatmapHandler
+        heatmap = Heatmap(
+            bucket_zoom=int(heatmap_config.get('bucket-zoom', 10)),
+            top_areas=int(heatmap_config.get('top-areas', 1000)),
+            top_tiles=int(heatmap_config.get('top-tiles', 10000)),
+            sketch_width=int(heatmap_config.get('sketch-width', 65536)))
+        if heatmap_config.get('url'):
+            heatmap_handler = HeatmapHandler(heatmap_config['url'], heatmap)
+        if heatmap_config.get('path'):
+            heatmap.persist_every(
+                heatmap_config['path'],
+                float(heatmap_config.get('persist-interval', 60)),
+                float(heatmap_config.get('persist-decay', 0.5)))
+        # render the tiles that were most requested before, so that
+        # they're cached before they're asked for
+        if heatmap_config.get('warm-up'):
+            from tileserver.heatmap import WarmUp
+            assert heatmap_config.get('path'), 'Warm-up needs a heatmap path'
+            warm_up = WarmUp(
+                heatmap_config['path'], int(heatmap_config['warm-up']),
+                int(heatmap_config.get('warm-up-concurrency', 1)))
+
+    stats_handler = None
+    stats_config = config.get('stats')
+    if stats_config:
+        stats_handler = StatsHandler(stats_config['url'])
+        if memory_budget is not None:
+            stats_handler.sources['memory'] = memory_budget.stats
+        if coverage_index is not None:
+            stats_handler.sources['coverage'] = coverage_index.stats
+        if db_pool is not None:
+            stats_handler.sources['database'] = db_pool.stats
+        if failure_cache is not None:
+            stats_handler.sources['failures'] = failure_cache.stats
+
+    startup_timer.report()
 
     tile_server = TileServer(
         layer_config, extensions, data_fetcher, post_process_data, io_pool,
         cache, buffer_cfg, formats, health_checker, add_cors_headers,
-        max_age, path_tile_size, max_interesting_zoom, output_calc_mapping)
+        max_age, path_tile_size, max_interesting_zoom, output_calc_mapping,
+        io_factory=io_factory, serve_stale=serve_stale,
+        coverage_index=coverage_index, memory_budget=memory_budget,
+        stream_json=stream_json, stats_handler=stats_handler,
+        failure_cache=failure_cache, fast_hits=fast_hits, heatmap=heatmap,
+        heatmap_handler=heatmap_handler, warm_up=warm_up)
+
+    if stats_handler and scheduler_config:
+        # the scheduler is replaced along with the io pool after a fork
+        stats_handler.sources['queries'] = lambda: tile_server.io_pool.stats()
+
     return tile_server
 
 
@@ -418,6 +1080,7 @@ def wsgi_server(config_path):
     with open(config_path) as fp:
         config = yaml.load(fp)
     tile_server = create_tileserver_from_config(config)
+    tile_server.start_warm_up()
     return tile_server
 
 
@@ -433,6 +1096,20 @@ def main():
     with open(config_path) as fp:
         config = yaml.load(fp)
 
+    server_config = config['server']
+    server_type = server_config.get('type', 'werkzeug')
+    assert server_type in ('werkzeug', 'gevent', 'prefork'), \
+        'Unknown server type: %s' % server_type
+    if server_type == 'gevent':
+        # sockets and sleeps need to be cooperative before any clients,
+        # such as the redis cache, are created. threads are left alone
+        # so that renders can still run in real threads, and process
+        # handling is left alone so that render processes can be forked
+        # from those threads.
+        from gevent import monkey
+        monkey.patch_all(
+            thread=False, os=False, subprocess=False, signal=False)
+
     from shapely import speedups
     if speedups.available:
         speedups.enable()
@@ -441,9 +1118,18 @@ def main():
         print 'Shapely speedups not enabled because they were not available'
 
     tile_server = create_tileserver_from_config(config)
-    tile_server.propagate_errors = True
 
-    server_config = config['server']
+    if server_type == 'gevent':
+        from tileserver.evented import serve_evented
+        serve_evented(tile_server, server_config)
+        return
+    elif server_type == 'prefork':
+        from tileserver.prefork import serve_prefork
+        serve_prefork(tile_server, server_config)
+        return
+
+    tile_server.propagate_errors = True
+    tile_server.start_warm_up()
     run_simple(server_config['host'], server_config['port'], tile_server,
                threaded=server_config.get('threaded', False),
                use_debugger=server_config.get('debug', False),
@@ -0,0 +1,88 @@
+"""measure how many cached tiles can be served per second
+
+requests for tiles which are all in an in-memory cache are sent straight
+to the server's wsgi application, one at a time, first through the
+general request handling and then through the path for cache hits. the
+rate is for a single core, without any http server in front.
+
+    python -m tileserver.benchmark --requests 20000
+"""
+from ModestMaps.Core import Coordinate
+from tileserver import LayerConfig
+from tileserver import TileServer
+from tileserver.cache import CacheKey
+from tileserver.cache import SharedMemoryCache
+from tilequeue.format import extension_to_format
+import argparse
+import random
+import time
+
+
+def make_environs(paths):
+    from werkzeug.test import EnvironBuilder
+    return [EnvironBuilder(path=x).get_environ() for x in paths]
+
+
+def start_response(status, headers):
+    assert status == '200 OK', status
+
+
+def requests_per_second(tile_server, environs, n_requests):
+    start = time.time()
+    for i in xrange(n_requests):
+        environ = environs[i % len(environs)]
+        for chunk in tile_server(dict(environ), start_response):
+            pass
+    return n_requests / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--tiles', type=int, default=1000)
+    parser.add_argument('--tile-bytes', type=int, default=20000)
+    args = parser.parse_args()
+
+    layer_names = ['boundaries', 'buildings', 'earth', 'landuse', 'places',
+                   'pois', 'roads', 'transit', 'water']
+    layer_config = LayerConfig(layer_names, [dict(name=x)
+                                             for x in layer_names])
+    extension = 'mvt'
+    cache = SharedMemoryCache(
+        4 * args.tiles * (args.tile_bytes + 64), args.tile_bytes + 64)
+    tile_server = TileServer(
+        layer_config, set([extension]), None, None, None, cache, {}, [],
+        add_cors_headers=True, max_age=300)
+
+    layer_specs = ['all', 'water', 'roads,water']
+    tiles = []
+    tile_data = 'x' * args.tile_bytes
+    for i in xrange(args.tiles):
+        zoom = random.randint(8, 16)
+        column = random.randrange(1 << zoom)
+        row = random.randrange(1 << zoom)
+        layer_spec = random.choice(layer_specs)
+        layers = ','.join(sorted(layer_spec.split(',')))
+        coord = Coordinate(zoom=zoom, column=column, row=row)
+        cache_key = CacheKey(
+            coord, 1, layers, extension_to_format[extension])
+        cache.set(cache_key, tile_data)
+        path = '/%s/%d/%d/%d.%s' % (
+            layer_spec, zoom, column, row, extension)
+        tiles.append((path, cache_key))
+    # tiles which share a slot in the cache push each other out
+    paths = [x[0] for x in tiles
+             if cache.get(x[1]) is not None]
+    environs = make_environs(paths)
+
+    for fast_hits in (False, True):
+        tile_server.fast_hits = fast_hits
+        # once through to warm up
+        requests_per_second(tile_server, environs, len(environs))
+        rate = requests_per_second(tile_server, environs, args.requests)
+        print '%-12s %8.0f hits/s' % (
+            'fast path' if fast_hits else 'normal path', rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,17 @@
 import errno
+import fcntl
+import hashlib
+import math
+import mmap
 import os
+import struct
+import tempfile
+import threading
 import time
+from bisect import bisect
 from collections import namedtuple
 from contextlib import contextmanager
+from ModestMaps.Core import Coordinate
 from string import zfill
 
 
@@ -61,6 +70,32 @@ class BaseCache(object):
     def get(self, cache_key):
         raise NotImplemented()
 
+    def get_multi(self, cache_keys):
+        return [self.get(cache_key) for cache_key in cache_keys]
+
+    def set_chunks(self, cache_key, chunks, generation=None):
+        """
+        Store a tile given as a list of strings, for caches which can
+        write it without joining them together first. ``generation`` is
+        what ``generation`` returned for the tile before it was rendered,
+        for caches which keep track of it.
+        """
+        self.set(cache_key, ''.join(chunks))
+
+    def get_stale(self, cache_key):
+        """
+        Returns a tile which is no longer current, but may be served while
+        it's re-rendered, or None if there isn't one.
+        """
+        return None
+
+    def generation(self, coord):
+        """
+        Returns a number which changes whenever the area covered by the
+        coordinate is invalidated.
+        """
+        return 0
+
     @contextmanager
     def lock(self, cache_key, **kwargs):
         self.obtain_lock(cache_key, **kwargs)
@@ -139,6 +174,8 @@ class RedisCache(BaseCache):
                     return
 
             timeout -= 1
+            if timeout < 0:
+                break
             time.sleep(1)
 
         raise LockTimeout("Timeout whilst waiting for a lock")
@@ -156,6 +193,149 @@ class RedisCache(BaseCache):
         return self.client.get(key)
 
 
+class HashRing(object):
+    """
+    Consistent hash ring, mapping keys onto a set of named nodes. Each node
+    is placed on the ring many times so that keys spread evenly, and only
+    the keys of a node which is added or removed move.
+    """
+
+    def __init__(self, node_names, replicas=128):
+        ring = []
+        for node_index, node_name in enumerate(node_names):
+            for replica in range(replicas):
+                point = self._hash('{}#{}'.format(node_name, replica))
+                ring.append((point, node_index))
+        ring.sort()
+        self.points = [x[0] for x in ring]
+        self.node_indexes = [x[1] for x in ring]
+
+    def _hash(self, key):
+        return struct.unpack_from('<Q', hashlib.md5(key).digest())[0]
+
+    def get_node(self, key):
+        """returns the index of the node that the key belongs to"""
+        i = bisect(self.points, self._hash(key)) % len(self.points)
+        return self.node_indexes[i]
+
+
+class ShardedRedisCache(RedisCache):
+    """
+    Spreads tiles over several Redis servers with consistent hashing.
+
+    All layers and formats of a tile go to the same server. If
+    ``colocate_zoom`` is set, tiles are placed by their ancestor at that
+    zoom instead, so that neighbouring tiles share a server.
+
+    Locking and reading a tile are sent together in one round trip, as are
+    storing a tile and releasing its lock.
+    """
+
+    def __init__(self, redis_clients, **kwargs):
+        super(ShardedRedisCache, self).__init__(None, **kwargs)
+        assert redis_clients, 'No redis clients'
+        self.clients = redis_clients
+        # names identify nodes on the ring, so should be stable, such as
+        # the server urls
+        node_names = kwargs.get('node_names') or [
+            str(i) for i in range(len(redis_clients))]
+        assert len(node_names) == len(redis_clients)
+        self.ring = HashRing(node_names, kwargs.get('replicas') or 128)
+        self.colocate_zoom = kwargs.get('colocate_zoom')
+        # data key -> tile fetched when locking, and tile to store when
+        # unlocking. only one request in the process can hold the lock on
+        # a tile, so this is shared by all of them rather than kept per
+        # thread, which greenlets on the same thread would share anyway.
+        self.held = {}
+
+    def _shard_key(self, cache_key):
+        coord = cache_key.coord
+        if self.colocate_zoom is not None and coord.zoom > self.colocate_zoom:
+            dz = coord.zoom - self.colocate_zoom
+            return '{}/{}/{}'.format(
+                self.colocate_zoom, coord.column >> dz, coord.row >> dz)
+        return '{}/{}/{}'.format(coord.zoom, coord.column, coord.row)
+
+    def _client(self, cache_key):
+        return self.clients[self.ring.get_node(self._shard_key(cache_key))]
+
+    def obtain_lock(self, cache_key, **kwargs):
+        """
+        Obtains a lock based on the given tile coordinate, waiting up to
+        ``timeout`` seconds before throwing a ``LockTimeout`` exception.
+        Locks expire by themselves after ``expires`` seconds.
+
+        The tile is read in the same round trip that obtains the lock, and
+        a following ``get`` for it is answered from that.
+        """
+        lock_key = self._generate_key('lock', cache_key)
+        data_key = self._generate_key('data', cache_key)
+        expires = kwargs.get('expires', 60)
+        timeout = kwargs.get('timeout', 10)
+        client = self._client(cache_key)
+
+        while timeout >= 0:
+            pipe = client.pipeline(transaction=False)
+            pipe.set(lock_key, time.time() + expires, ex=expires, nx=True)
+            pipe.get(data_key)
+            locked, data = pipe.execute()
+
+            if locked:
+                self.held[data_key] = dict(prefetched=data, pending=None)
+                return
+
+            timeout -= 1
+            if timeout < 0:
+                break
+            time.sleep(1)
+
+        raise LockTimeout("Timeout whilst waiting for a lock")
+
+    def release_lock(self, cache_key):
+        lock_key = self._generate_key('lock', cache_key)
+        data_key = self._generate_key('data', cache_key)
+        held = self.held.pop(data_key, None)
+
+        pipe = self._client(cache_key).pipeline(transaction=False)
+        if held and held['pending'] is not None:
+            pipe.set(data_key, held['pending'], ex=self.expires)
+        pipe.delete(lock_key)
+        pipe.execute()
+
+    def set(self, cache_key, data):
+        data_key = self._generate_key('data', cache_key)
+        held = self.held.get(data_key)
+        if held is not None:
+            # stored along with releasing the lock
+            held['pending'] = data
+            held['prefetched'] = data
+            return
+        self._client(cache_key).set(data_key, data, ex=self.expires)
+
+    def get(self, cache_key):
+        data_key = self._generate_key('data', cache_key)
+        held = self.held.get(data_key)
+        if held is not None:
+            return held['prefetched']
+        return self._client(cache_key).get(data_key)
+
+    def get_multi(self, cache_keys):
+        """get several tiles, with one round trip to each server"""
+        by_node = {}
+        for i, cache_key in enumerate(cache_keys):
+            node = self.ring.get_node(self._shard_key(cache_key))
+            by_node.setdefault(node, []).append(i)
+
+        result = [None] * len(cache_keys)
+        for node, indexes in by_node.items():
+            pipe = self.clients[node].pipeline(transaction=False)
+            for i in indexes:
+                pipe.get(self._generate_key('data', cache_keys[i]))
+            for i, data in zip(indexes, pipe.execute()):
+                result[i] = data
+        return result
+
+
 class FileCache(BaseCache):
     def __init__(self, file_prefix, **kwargs):
         self.prefix = file_prefix
@@ -213,6 +393,8 @@ class FileCache(BaseCache):
                 return
 
             timeout -= 1
+            if timeout < 0:
+                break
             time.sleep(1)
 
         raise LockTimeout("Timeout whilst waiting for a lock")
@@ -235,6 +417,15 @@ class FileCache(BaseCache):
         with open(key, 'w') as f:
             f.write(data)
 
+    def set_chunks(self, cache_key, chunks, generation=None):
+        key = self._generate_key('data', cache_key)
+        directory = os.path.dirname(key)
+        mkdir_p(directory)
+
+        with open(key, 'w') as f:
+            for chunk in chunks:
+                f.write(chunk)
+
     def get(self, cache_key):
         key = self._generate_key('data', cache_key)
         try:
@@ -242,3 +433,408 @@ class FileCache(BaseCache):
                 return f.read()
         except IOError:
             return None
+
+
+class SharedMemoryCache(BaseCache):
+    """
+    A fixed size cache of hot tiles held in anonymous shared memory, so
+    that it can be shared by processes forked after it's created.
+
+    The memory is split into equally sized slots, and each tile is mapped
+    to a single slot by a hash of its key, evicting whatever was there
+    before. Tiles larger than a slot are only stored in the backing cache.
+
+    Locks are held across all processes sharing the cache, which gives
+    single-flight rendering between them. The backing cache is locked too,
+    so that this can sit in front of a cache shared between servers.
+    """
+
+    # write sequence number, key digest, data length
+    slot_header = struct.Struct('<Q20sI')
+
+    def __init__(self, size, slot_size=65536, backing=None, **kwargs):
+        assert slot_size > self.slot_header.size, 'Slot size too small'
+        self.slot_size = slot_size
+        self.n_slots = size // slot_size
+        assert self.n_slots > 0, 'Cache size must hold at least one slot'
+        self.max_data_size = slot_size - self.slot_header.size
+        self.backing = backing or NullCache()
+        self.lock_stripes = kwargs.get('lock_stripes') or 4096
+
+        self.memory = mmap.mmap(-1, self.n_slots * slot_size)
+        # byte range locks on this file coordinate between processes. the
+        # first n_slots bytes guard slot writes, the rest are the tile
+        # locks. they don't coordinate threads within a process, so those
+        # are covered by the thread locks.
+        self.lock_file = tempfile.TemporaryFile()
+        self.write_thread_lock = threading.Lock()
+        self.thread_locks = [
+            threading.Lock() for i in range(self.lock_stripes)]
+
+    def _digest(self, cache_key):
+        return hashlib.sha1('{}-{}-{}-{}-{}-{}'.format(
+            cache_key.tile_size,
+            cache_key.layers,
+            cache_key.fmt.extension,
+            cache_key.coord.zoom,
+            cache_key.coord.column,
+            cache_key.coord.row,
+        )).digest()
+
+    def _slot_offset(self, digest):
+        slot = struct.unpack_from('<Q', digest)[0] % self.n_slots
+        return slot, slot * self.slot_size
+
+    def _lock_stripe(self, digest):
+        return struct.unpack_from('<Q', digest, 8)[0] % self.lock_stripes
+
+    def obtain_lock(self, cache_key, **kwargs):
+        """
+        Obtains a lock on the tile, shared across all processes using this
+        cache, and then on the backing cache. By default, it will wait
+        ``timeout`` seconds before giving up and throwing a ``LockTimeout``
+        exception.
+
+        Locks are striped, so unrelated tiles may occasionally contend.
+        They are released if the holding process dies.
+        """
+        timeout = kwargs.get('timeout', 10)
+        deadline = time.time() + timeout
+        stripe = self._lock_stripe(self._digest(cache_key))
+        thread_lock = self.thread_locks[stripe]
+
+        while not thread_lock.acquire(False):
+            if time.time() >= deadline:
+                raise LockTimeout("Timeout whilst waiting for a lock")
+            time.sleep(0.01)
+
+        try:
+            while True:
+                try:
+                    fcntl.lockf(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB,
+                                1, self.n_slots + stripe)
+                    break
+                except IOError as e:
+                    if e.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                if time.time() >= deadline:
+                    raise LockTimeout("Timeout whilst waiting for a lock")
+                time.sleep(0.01)
+
+            try:
+                remaining = max(0, int(deadline - time.time()))
+                self.backing.obtain_lock(
+                    cache_key, **dict(kwargs, timeout=remaining))
+            except BaseException:
+                fcntl.lockf(self.lock_file, fcntl.LOCK_UN, 1,
+                            self.n_slots + stripe)
+                raise
+        except BaseException:
+            thread_lock.release()
+            raise
+
+    def release_lock(self, cache_key):
+        stripe = self._lock_stripe(self._digest(cache_key))
+        try:
+            self.backing.release_lock(cache_key)
+        finally:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_UN, 1,
+                        self.n_slots + stripe)
+            self.thread_locks[stripe].release()
+
+    def _set_memory(self, digest, data):
+        if len(data) > self.max_data_size:
+            return
+        slot, offset = self._slot_offset(digest)
+        header = self.slot_header
+        with self.write_thread_lock:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_EX, 1, slot)
+            try:
+                # an odd sequence number marks the slot as being written,
+                # readers check it's unchanged after copying the data out
+                seq = header.unpack_from(self.memory, offset)[0]
+                header.pack_into(self.memory, offset, seq + 1, digest, 0)
+                data_offset = offset + header.size
+                self.memory[data_offset:data_offset + len(data)] = data
+                header.pack_into(
+                    self.memory, offset, seq + 2, digest, len(data))
+            finally:
+                fcntl.lockf(self.lock_file, fcntl.LOCK_UN, 1, slot)
+
+    def _get_memory(self, digest):
+        slot, offset = self._slot_offset(digest)
+        header = self.slot_header
+        seq, slot_digest, length = header.unpack_from(self.memory, offset)
+        if seq & 1 or slot_digest != digest:
+            return None
+        data_offset = offset + header.size
+        data = self.memory[data_offset:data_offset + length]
+        if header.unpack_from(self.memory, offset)[0] != seq:
+            return None
+        return data
+
+    def set(self, cache_key, data):
+        self._set_memory(self._digest(cache_key), data)
+        self.backing.set(cache_key, data)
+
+    def set_chunks(self, cache_key, chunks, generation=None):
+        # only tiles small enough to be held here are joined together
+        if sum(len(x) for x in chunks) <= self.max_data_size:
+            self._set_memory(self._digest(cache_key), ''.join(chunks))
+        self.backing.set_chunks(cache_key, chunks)
+
+    def get(self, cache_key):
+        digest = self._digest(cache_key)
+        data = self._get_memory(digest)
+        if data is None:
+            data = self.backing.get(cache_key)
+            if data is not None:
+                self._set_memory(digest, data)
+        return data
+
+
+class MemoryGenerationStore(object):
+    """Generation counters held in this process, mostly for testing."""
+
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get_multi(self, keys):
+        with self.lock:
+            return [self.counters.get(key, 0) for key in keys]
+
+    def incr_multi(self, keys):
+        with self.lock:
+            for key in keys:
+                self.counters[key] = self.counters.get(key, 0) + 1
+
+
+class RedisGenerationStore(object):
+    """Generation counters held in a single Redis hash."""
+
+    def __init__(self, redis_client, key_prefix='tiles'):
+        self.client = redis_client
+        self.key = '{}.generations'.format(key_prefix)
+
+    def get_multi(self, keys):
+        if not keys:
+            return []
+        return [int(x or 0) for x in self.client.hmget(self.key, keys)]
+
+    def incr_multi(self, keys):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hincrby(self.key, key, 1)
+        pipe.execute()
+
+
+class FileGenerationStore(object):
+    """Generation counters held in files, one per counter."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _counter_path(self, key):
+        return os.path.join(self.path, key.replace('/', '-'))
+
+    def get_multi(self, keys):
+        counters = []
+        for key in keys:
+            try:
+                with open(self._counter_path(key), 'r') as f:
+                    counters.append(int(f.read() or 0))
+            except IOError:
+                counters.append(0)
+        return counters
+
+    def incr_multi(self, keys):
+        mkdir_p(self.path)
+        for key in keys:
+            with open(self._counter_path(key), 'a+') as f:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    counter = int(f.read() or 0) + 1
+                    f.seek(0)
+                    f.truncate()
+                    f.write(str(counter))
+                    f.flush()
+                finally:
+                    fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    """returns the column and row of the tile containing a point"""
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511287798), -85.0511287798)
+    lat_rad = math.radians(lat)
+    column = int((lon + 180.0) / 360.0 * n)
+    row = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) /
+               math.pi) / 2.0 * n)
+    return min(max(column, 0), n - 1), min(max(row, 0), n - 1)
+
+
+class InvalidatingCache(BaseCache):
+    """
+    Wraps another cache so that areas of it can be invalidated cheaply.
+
+    Rather than deleting tiles, invalidating an area increments generation
+    counters for the tiles at ``bucket_zoom`` covering it. Each tile is
+    stored with the generation it was rendered at, which is compared with
+    the current one when it's read. The cost of an invalidation depends on
+    the number of buckets, not on the number of tiles within them.
+
+    A tile's generation is the sum of the "tree" counters of its ancestors
+    (down to ``bucket_zoom``), which are incremented when an area is
+    invalidated, and, for tiles at or below ``bucket_zoom``, its own
+    "touch" counter, which is incremented when any area inside it is.
+
+    Counters are remembered for ``refresh_interval`` seconds, so an
+    invalidation can take that long to be seen.
+    """
+
+    # prefix for stored tiles, followed by the generation
+    header = struct.Struct('<4sQ')
+    magic = 'TSG1'
+
+    # number of counters to remember, beyond which expired ones are dropped
+    max_counters = 100000
+
+    def __init__(self, backend, generations, bucket_zoom=10,
+                 refresh_interval=1.0):
+        self.backend = backend
+        self.generations = generations
+        self.bucket_zoom = bucket_zoom
+        self.refresh_interval = refresh_interval
+        self.counters = {}
+        self.counters_lock = threading.Lock()
+
+    def _counter_keys(self, coord):
+        keys = []
+        for zoom in range(min(coord.zoom, self.bucket_zoom) + 1):
+            dz = coord.zoom - zoom
+            keys.append('tree/{}/{}/{}'.format(
+                zoom, coord.column >> dz, coord.row >> dz))
+        if coord.zoom <= self.bucket_zoom:
+            keys.append('touch/{}/{}/{}'.format(
+                coord.zoom, coord.column, coord.row))
+        return keys
+
+    def generation(self, coord):
+        keys = self._counter_keys(coord)
+        now = time.time()
+        with self.counters_lock:
+            cached = [self.counters.get(key) for key in keys]
+        to_fetch = [key for key, value in zip(keys, cached)
+                    if value is None or value[1] < now]
+        if to_fetch:
+            fetched = dict(zip(to_fetch,
+                               self.generations.get_multi(to_fetch)))
+            expires = now + self.refresh_interval
+            with self.counters_lock:
+                if len(self.counters) >= self.max_counters:
+                    self._drop_expired(now)
+                for key, counter in fetched.items():
+                    self.counters[key] = (counter, expires)
+            cached = [(fetched[key], expires) if key in fetched else value
+                      for key, value in zip(keys, cached)]
+        return sum(value[0] for value in cached)
+
+    def _drop_expired(self, now):
+        # called with the counters lock held
+        self.counters = dict(
+            (key, value) for key, value in self.counters.iteritems()
+            if value[1] >= now)
+        if len(self.counters) >= self.max_counters // 2:
+            # mostly still current, so start over rather than sweep again
+            # on the next refresh
+            self.counters = {}
+
+    def _unpack(self, stored):
+        """returns the generation and data of a stored tile"""
+        if stored is None:
+            return None, None
+        if stored[:len(self.magic)] != self.magic:
+            # stored before invalidation was enabled
+            return 0, stored
+        _, generation = self.header.unpack_from(stored)
+        return generation, stored[self.header.size:]
+
+    def _check(self, cache_key, stored):
+        stored_generation, data = self._unpack(stored)
+        if data is not None and \
+                stored_generation == self.generation(cache_key.coord):
+            return data
+        return None
+
+    def obtain_lock(self, cache_key, **kwargs):
+        self.backend.obtain_lock(cache_key, **kwargs)
+
+    def release_lock(self, cache_key):
+        self.backend.release_lock(cache_key)
+
+    def get(self, cache_key):
+        return self._check(cache_key, self.backend.get(cache_key))
+
+    def get_multi(self, cache_keys):
+        return [self._check(cache_key, stored) for cache_key, stored in
+                zip(cache_keys, self.backend.get_multi(cache_keys))]
+
+    def get_stale(self, cache_key):
+        return self._unpack(self.backend.get(cache_key))[1]
+
+    def _set_header(self, cache_key, generation):
+        # callers pass the generation from before the tile was rendered,
+        # so that an invalidation during the render isn't lost
+        if generation is None:
+            generation = self.generation(cache_key.coord)
+        return self.header.pack(self.magic, generation)
+
+    def set(self, cache_key, data, generation=None):
+        self.backend.set(
+            cache_key, self._set_header(cache_key, generation) + data)
+
+    def set_chunks(self, cache_key, chunks, generation=None):
+        self.backend.set_chunks(
+            cache_key, [self._set_header(cache_key, generation)] + chunks)
+
+    def invalidate_coords(self, coords, min_zoom=0):
+        """
+        Invalidate the areas covered by the coordinates, for tiles from
+        ``min_zoom`` up. Coordinates beyond ``bucket_zoom`` invalidate the
+        whole bucket they're in. Returns the number of counters changed.
+        """
+        keys = set()
+        for coord in coords:
+            zoom = min(coord.zoom, self.bucket_zoom)
+            dz = coord.zoom - zoom
+            column, row = coord.column >> dz, coord.row >> dz
+            keys.add('tree/{}/{}/{}'.format(zoom, column, row))
+            for ancestor_zoom in range(min_zoom, zoom):
+                adz = zoom - ancestor_zoom
+                keys.add('touch/{}/{}/{}'.format(
+                    ancestor_zoom, column >> adz, row >> adz))
+
+        keys = sorted(keys)
+        self.generations.incr_multi(keys)
+        with self.counters_lock:
+            self.counters.clear()
+        return len(keys)
+
+    def invalidate_bounds(self, bounds, min_zoom=0, max_zoom=None):
+        """
+        Invalidate the tiles from ``min_zoom`` to ``max_zoom`` intersecting
+        the ``(min_lon, min_lat, max_lon, max_lat)`` bounds. Tiles beyond
+        ``max_zoom`` may be invalidated too.
+        """
+        zoom = self.bucket_zoom
+        if max_zoom is not None:
+            zoom = min(zoom, max_zoom)
+        min_lon, min_lat, max_lon, max_lat = bounds
+        min_column, min_row = lonlat_to_tile(min_lon, max_lat, zoom)
+        max_column, max_row = lonlat_to_tile(max_lon, min_lat, zoom)
+        coords = (Coordinate(zoom=zoom, column=column, row=row)
+                  for column in range(min_column, max_column + 1)
+                  for row in range(min_row, max_row + 1))
+        return self.invalidate_coords(coords, min(min_zoom, zoom))
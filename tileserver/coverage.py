@@ -0,0 +1,265 @@
+"""index of areas known to render to empty or uniform tiles
+
+a lot of requests are for tiles over open ocean or empty land, which
+still need every layer to be queried only to find nothing there, or only
+a polygon covering the whole tile. this remembers which tiles rendered
+like that, so that later requests for them can be answered with a
+template without touching the database.
+
+empty tiles are the same in every format which doesn't include the
+tile's location. a tile whose only features are polygons covering it is
+the same as any other with the same features at that zoom, but only in
+formats which use tile coordinates (mvt), so those templates are kept
+per zoom and per set of features.
+
+beyond the (nominal) zoom at which data stops changing, an empty or
+uniform tile means that everything beneath it of the same size is the
+same, so there a single entry covers the whole subtree, and four
+siblings with the same features are merged into their parent.
+
+entries record the cache generation of their tile when it was rendered,
+so they go out of date along with the cache when the area is invalidated.
+"""
+from ModestMaps.Core import Coordinate
+from shapely.geometry import box
+from tileserver import calculate_nominal_zoom
+import threading
+
+
+# signature of a tile without any features
+EMPTY = repr([])
+
+
+def uniform_signature(feature_layers):
+    """
+    Returns a signature of the processed feature layers if every feature
+    is a polygon covering the whole of the tile's padded bounds, or None
+    otherwise. Tiles with the same signature format to the same data in
+    tile coordinates, as each polygon is clipped to the same box.
+    """
+    signature = []
+    for feature_layer in feature_layers:
+        features = feature_layer['features']
+        if not features:
+            continue
+        padded_bounds = feature_layer.get('padded_bounds')
+        if padded_bounds is None:
+            return None
+        tile_box = box(*padded_bounds['polygon'])
+        layer_signature = []
+        for shape, props, fid in features:
+            if shape.geom_type not in ('Polygon', 'MultiPolygon'):
+                return None
+            if not shape.covers(tile_box):
+                return None
+            layer_signature.append((sorted(props.items()), fid))
+        signature.append((feature_layer['name'], layer_signature))
+    return repr(signature)
+
+
+class CoverageIndex(object):
+
+    # formats whose empty tiles are the same wherever they are. topojson
+    # includes the tile's bounds, so can't be shared between tiles.
+    template_extensions = ('json', 'mvt', 'mvtb')
+    # formats in tile coordinates, where uniform tiles are the same at
+    # each zoom. json is in lon/lat, so only its empty tiles are shared.
+    uniform_extensions = ('mvt', 'mvtb')
+    # distinct templates to keep, as each set of features has its own
+    max_templates = 10000
+
+    def __init__(self, max_data_zoom=16, max_entries=1000000):
+        # nominal zoom beyond which data stops changing
+        self.max_data_zoom = max_data_zoom
+        self.max_entries = max_entries
+        # (tile size, zoom) -> packed column and row ->
+        # (generation, signature)
+        self.entries = {}
+        self.n_entries = 0
+        # (tile size, layers, extension, zoom, signature) -> tile data,
+        # where the zoom is None for empty tiles
+        self.templates = {}
+        # keys which rendered differently with the same signature, so
+        # can't be shared after all
+        self.untemplatable = set()
+        self.lock = threading.Lock()
+
+    def _template_key(self, cache_key, signature):
+        """
+        Returns the key of the template for the tile with the signature,
+        or None if it can't be answered from a template.
+        """
+        extension = cache_key.fmt.extension
+        if extension not in self.template_extensions:
+            return None
+        if signature == EMPTY:
+            zoom = None
+        elif extension in self.uniform_extensions:
+            zoom = cache_key.coord.zoom
+        else:
+            return None
+        return (cache_key.tile_size, cache_key.layers, extension, zoom,
+                signature)
+
+    def _current(self, tile_size, tiles, generation_fn):
+        """
+        Returns (zoom, column, row, signature) for those of the
+        (zoom, column, row) tiles which have an entry still at the
+        tile's generation, in order, dropping entries which have been
+        invalidated since. The generations may need a round
+        trip to the cache, so aren't fetched with the lock held.
+        """
+        found = []
+        with self.lock:
+            for zoom, column, row in tiles:
+                entries = self.entries.get((tile_size, zoom))
+                if entries is None:
+                    continue
+                packed = (column << zoom) | row
+                entry = entries.get(packed)
+                if entry is not None:
+                    found.append((zoom, column, row, packed, entry))
+
+        current = []
+        invalidated = []
+        for zoom, column, row, packed, entry in found:
+            generation, signature = entry
+            coord = Coordinate(zoom=zoom, column=column, row=row)
+            if generation_fn(coord) == generation:
+                current.append((zoom, column, row, signature))
+            else:
+                invalidated.append((zoom, packed, entry))
+
+        if invalidated:
+            with self.lock:
+                for zoom, packed, entry in invalidated:
+                    # unless it's been recorded again in the meantime
+                    entries = self.entries.get((tile_size, zoom))
+                    if entries is not None and entries.get(packed) == entry:
+                        self._remove(tile_size, zoom, packed)
+        return current
+
+    def _remove(self, tile_size, zoom, packed):
+        entries = self.entries.get((tile_size, zoom))
+        if entries is None or packed not in entries:
+            return
+        del entries[packed]
+        self.n_entries -= 1
+        if not entries:
+            del self.entries[(tile_size, zoom)]
+
+    def signature(self, coord, tile_size, generation_fn):
+        """
+        Returns the signature the tile is known to render with, or None
+        if it isn't known to be empty or uniform.
+        """
+        # the tile itself, or any ancestor of the same size at or beyond
+        # max data zoom, where a uniform tile covers its whole subtree
+        tiles = [(coord.zoom, coord.column, coord.row)]
+        for zoom in range(coord.zoom - 1, -1, -1):
+            if calculate_nominal_zoom(zoom, tile_size) < self.max_data_zoom:
+                break
+            dz = coord.zoom - zoom
+            tiles.append((zoom, coord.column >> dz, coord.row >> dz))
+        current = self._current(tile_size, tiles, generation_fn)
+        if not current:
+            return None
+        # the tile itself, or else the nearest ancestor
+        return current[0][3]
+
+    def is_empty(self, coord, tile_size, generation_fn):
+        """whether the tile is known to render with no features"""
+        return self.signature(coord, tile_size, generation_fn) == EMPTY
+
+    def get_template(self, cache_key, generation_fn):
+        """returns tile data for a tile known to be uniform, or None"""
+        signature = self.signature(
+            cache_key.coord, cache_key.tile_size, generation_fn)
+        if signature is None:
+            return None
+        template_key = self._template_key(cache_key, signature)
+        if template_key is None:
+            return None
+        return self.templates.get(template_key)
+
+    def _add(self, tile_size, zoom, column, row, generation, signature):
+        entries = self.entries.setdefault((tile_size, zoom), {})
+        packed = (column << zoom) | row
+        if packed not in entries:
+            self.n_entries += 1
+        entries[packed] = (generation, signature)
+
+    def _merge_siblings(self, tile_size, zoom, column, row, signature,
+                        generation_fn):
+        # four tiles beyond max data zoom with the same features mean
+        # their parent has them too
+        while zoom > 0 and \
+                calculate_nominal_zoom(zoom, tile_size) > self.max_data_zoom:
+            parent_column, parent_row = column >> 1, row >> 1
+            siblings = [(zoom, parent_column * 2 + dx, parent_row * 2 + dy)
+                        for dx in (0, 1) for dy in (0, 1)]
+            current = self._current(tile_size, siblings, generation_fn)
+            if len(current) < 4 or \
+                    any(x[3] != signature for x in current):
+                return
+            parent = Coordinate(
+                zoom=zoom - 1, column=parent_column, row=parent_row)
+            generation = generation_fn(parent)
+            with self.lock:
+                for _, x, y in siblings:
+                    self._remove(tile_size, zoom, (x << zoom) | y)
+                self._add(tile_size, zoom - 1, parent_column, parent_row,
+                          generation, signature)
+            zoom, column, row = zoom - 1, parent_column, parent_row
+
+    def record(self, cache_key, signature, tile_data, generation,
+               generation_fn):
+        """
+        Record that a tile rendered with the signature from
+        uniform_signature, as of the cache generation it was rendered at.
+        """
+        coord = cache_key.coord
+        tile_size = cache_key.tile_size
+        template_key = self._template_key(cache_key, signature)
+        with self.lock:
+            if self.n_entries >= self.max_entries:
+                self.entries.clear()
+                self.n_entries = 0
+            self._add(tile_size, coord.zoom, coord.column, coord.row,
+                      generation, signature)
+
+            if (template_key is not None and
+                    template_key not in self.untemplatable):
+                template = self.templates.get(template_key)
+                if template is None:
+                    if len(self.templates) < self.max_templates:
+                        self.templates[template_key] = tile_data
+                elif template != tile_data:
+                    # these tiles aren't all the same after all
+                    del self.templates[template_key]
+                    self.untemplatable.add(template_key)
+
+        self._merge_siblings(tile_size, coord.zoom, coord.column, coord.row,
+                             signature, generation_fn)
+
+    def record_empty(self, cache_key, tile_data, generation, generation_fn):
+        """
+        Record that a tile rendered with no features in any layer, as of
+        the cache generation it was rendered at.
+        """
+        self.record(cache_key, EMPTY, tile_data, generation, generation_fn)
+
+    def _entries_by_zoom(self):
+        by_zoom = {}
+        for (tile_size, zoom), entries in self.entries.items():
+            nominal_zoom = calculate_nominal_zoom(zoom, tile_size)
+            by_zoom[nominal_zoom] = by_zoom.get(nominal_zoom, 0) + len(entries)
+        return by_zoom
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                entries=self.n_entries,
+                entries_by_zoom=self._entries_by_zoom(),
+                templates=len(self.templates),
+            )
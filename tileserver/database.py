@@ -0,0 +1,243 @@
+"""pooled database connections across the configured dbnames
+
+connections to each dbname are kept open between renders, and each
+render is sent to the dbname with the least outstanding work, weighted by
+how long it has recently taken to answer. a background thread in each
+process checks each dbname periodically, and health checks are answered
+from what it last found. the thread is started as soon as the pool is
+set up in the process which will use it, and a health check before the
+first check has finished waits for one.
+"""
+from psycopg2.extras import register_hstore
+from psycopg2.extras import register_json
+import os
+import psycopg2
+import random
+import threading
+import time
+import ujson
+
+
+class DatabaseBackend(object):
+    """connections to, and what we know about, a single dbname"""
+
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.idle_conns = []
+        self.n_in_use = 0
+        # assume healthy until we hear otherwise, so that renders can
+        # start before the first probe has finished
+        self.healthy = True
+        # moving average of the probe round trip time, in seconds
+        self.rtt = None
+        self.last_error = None
+        self.last_probed = None
+        self.probe_conn = None
+
+    def stats(self):
+        return dict(
+            healthy=self.healthy,
+            rtt_ms=None if self.rtt is None else self.rtt * 1000.0,
+            in_use=self.n_in_use,
+            idle=len(self.idle_conns),
+            last_error=self.last_error,
+            last_probed=self.last_probed,
+        )
+
+
+class DatabasePool(object):
+    """keeps connections open to each dbname and picks between them
+
+    this can stand in for tilequeue's connection pools, through get_conns
+    and put_conns. all the connections for a single get_conns call come
+    from the same dbname."""
+
+    # weight given to each new probe in the round trip time average
+    rtt_alpha = 0.3
+    # round trip times below this are treated as equal
+    min_rtt = 0.001
+
+    def __init__(self, conn_info, max_idle=8, readonly=True,
+                 probe_interval=5):
+        self.conn_info = dict(conn_info)
+        self.dbnames = self.conn_info.pop('dbnames')
+        assert len(self.dbnames) > 0
+        self.max_idle = max_idle
+        self.readonly = readonly
+        self.probe_interval = probe_interval
+        self.inherited = None
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.backends = [DatabaseBackend(x) for x in self.dbnames]
+        self.backend_by_conn = {}
+        self.prober_started = False
+        # held while probing, so that probes don't share a probe_conn
+        self.probe_lock = threading.Lock()
+
+    def _check_pid(self):
+        # connections, threads and locks can't be shared with a parent
+        # process, so start afresh after a fork. the connections we
+        # inherited are kept referenced rather than closed, as closing
+        # them would close them for the parent too.
+        if self.pid != os.getpid():
+            self.inherited = (self.backends, self.inherited)
+            self._reset()
+        if not self.prober_started:
+            with self.lock:
+                if not self.prober_started:
+                    self.prober_started = True
+                    self._start_prober()
+
+    def _start_prober(self):
+        thread = threading.Thread(target=self._run_prober)
+        thread.daemon = True
+        thread.start()
+
+    def start(self):
+        """
+        Start the background prober in this process, if it isn't running
+        already. This should be called in each process using the pool
+        once it's been forked, otherwise the prober is only started on
+        first use.
+        """
+        self._check_pid()
+
+    def _make_conn(self, dbname):
+        conn = psycopg2.connect(**dict(self.conn_info, dbname=dbname))
+        conn.set_session(readonly=self.readonly, autocommit=True)
+        register_hstore(conn)
+        register_json(conn, loads=ujson.loads)
+        return conn
+
+    def _choose_backend(self, n_conn):
+        candidates = [x for x in self.backends if x.healthy]
+        if not candidates:
+            # nothing is known to be good, so try anything
+            candidates = self.backends
+
+        def score(backend):
+            rtt = max(backend.rtt or self.min_rtt, self.min_rtt)
+            return (backend.n_in_use + n_conn) * rtt
+
+        best_score = min(score(x) for x in candidates)
+        best = [x for x in candidates if score(x) == best_score]
+        return random.choice(best)
+
+    def get_conns(self, n_conn):
+        self._check_pid()
+        with self.lock:
+            backend = self._choose_backend(n_conn)
+            backend.n_in_use += n_conn
+            conns = backend.idle_conns[:n_conn]
+            del backend.idle_conns[:n_conn]
+
+        try:
+            while len(conns) < n_conn:
+                conns.append(self._make_conn(backend.dbname))
+        except Exception:
+            # these aren't tracked yet, so are closed rather than kept
+            self.put_conns(conns)
+            with self.lock:
+                backend.n_in_use -= n_conn
+                backend.healthy = False
+            raise
+
+        with self.lock:
+            for conn in conns:
+                self.backend_by_conn[id(conn)] = backend
+        return conns
+
+    def put_conns(self, conns):
+        to_close = []
+        with self.lock:
+            for conn in conns:
+                backend = self.backend_by_conn.pop(id(conn), None)
+                if backend is None:
+                    to_close.append(conn)
+                    continue
+                backend.n_in_use -= 1
+                # connections which had errors are closed by the fetcher
+                if (not conn.closed and
+                        len(backend.idle_conns) < self.max_idle):
+                    backend.idle_conns.append(conn)
+                else:
+                    to_close.append(conn)
+        for conn in to_close:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _probe_backend(self, backend):
+        start = time.time()
+        try:
+            if backend.probe_conn is None or backend.probe_conn.closed:
+                backend.probe_conn = self._make_conn(backend.dbname)
+            cursor = backend.probe_conn.cursor()
+            cursor.execute('select 1')
+            records = cursor.fetchall()
+            assert records == [(1,)], 'Unexpected result: %r' % records
+        except Exception as e:
+            if backend.probe_conn is not None:
+                try:
+                    backend.probe_conn.close()
+                except Exception:
+                    pass
+                backend.probe_conn = None
+            with self.lock:
+                backend.healthy = False
+                backend.last_error = str(e)
+                backend.last_probed = time.time()
+            return
+
+        rtt = time.time() - start
+        with self.lock:
+            if backend.rtt is None:
+                backend.rtt = rtt
+            else:
+                backend.rtt += self.rtt_alpha * (rtt - backend.rtt)
+            backend.healthy = True
+            backend.last_error = None
+            backend.last_probed = time.time()
+
+    def _probe_all(self):
+        with self.lock:
+            backends = list(self.backends)
+        for backend in backends:
+            self._probe_backend(backend)
+
+    def probe(self):
+        """check each dbname in turn, updating health and round trip time"""
+        with self.probe_lock:
+            self._probe_all()
+
+    def ensure_probed(self):
+        """probe now, unless a probe has already finished in this process"""
+        self._check_pid()
+        # waits for any probe in progress, which may be the first
+        with self.probe_lock:
+            with self.lock:
+                probed = any(x.last_probed is not None
+                             for x in self.backends)
+            if not probed:
+                self._probe_all()
+
+    def _run_prober(self):
+        pid = os.getpid()
+        while self.pid == pid:
+            self.probe()
+            time.sleep(self.probe_interval)
+
+    def stats(self):
+        self._check_pid()
+        with self.lock:
+            return dict((x.dbname, x.stats()) for x in self.backends)
+
+    def is_fresh(self, backend_stats):
+        """whether stats were probed recently enough to be trusted"""
+        last_probed = backend_stats['last_probed']
+        return (last_probed is not None and
+                time.time() - last_probed < 3 * self.probe_interval)
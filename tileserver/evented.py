@@ -0,0 +1,89 @@
+"""event loop front end for the tile server, built on gevent
+
+the werkzeug development server dedicates a thread to each request for
+its whole lifetime, including any time spent waiting on a cache lock. here
+connections are handled by greenlets instead, so that idle keep-alive
+connections, cache lookups and lock waits are cheap, and the cpu and
+database heavy part of a request, the render, is handed off to a pool of
+threads or processes.
+
+this expects sockets and sleeps to have been made cooperative with
+gevent's monkey patching before any clients are created, see main().
+"""
+from multiprocessing import cpu_count
+from multiprocessing import Pool
+
+
+# the tile server used by process render workers. it gets set in the
+# parent before the pool forks, so that children inherit it instead of
+# needing it to be pickled.
+_render_tile_server = None
+
+
+def _init_render_process():
+    _render_tile_server.reset_io()
+
+
+def _render_in_process(method_name, args):
+    render_fn = getattr(_render_tile_server, method_name)
+    return render_fn(*args)
+
+
+class ProcessRenderPool(object):
+    """run renders in forked processes
+
+    the multiprocessing pool waits for results on native locks, which
+    would block the whole event loop, so that wait is handed off to a
+    gevent thread pool instead."""
+
+    def __init__(self, tile_server, n_processes, wait_pool):
+        global _render_tile_server
+        _render_tile_server = tile_server
+        self.pool = Pool(n_processes, _init_render_process)
+        self.wait_pool = wait_pool
+
+    def apply(self, fn, args):
+        # bound methods can't be pickled, so only the name is sent over
+        return self.wait_pool.apply(
+            self.pool.apply, (_render_in_process, (fn.__name__, args)))
+
+
+def serve_evented(tile_server, server_config):
+    """serve the tile server with gevent until interrupted"""
+    from gevent.pool import Pool as GreenletPool
+    from gevent.pywsgi import WSGIServer
+    from gevent.threadpool import ThreadPool as GeventThreadPool
+    import gevent
+
+    render_workers = int(server_config.get('render-workers') or cpu_count())
+    render_executor = server_config.get('render-executor', 'thread')
+    assert render_executor in ('thread', 'process'), \
+        'Unknown render executor: %s' % render_executor
+
+    wait_pool = GeventThreadPool(render_workers)
+    if render_executor == 'process':
+        tile_server.render_pool = ProcessRenderPool(
+            tile_server, render_workers, wait_pool)
+    else:
+        tile_server.render_pool = wait_pool
+
+    # by default every connection gets its own greenlet, with no limit
+    max_connections = server_config.get('max-connections')
+    spawn = 'default'
+    if max_connections:
+        spawn = GreenletPool(int(max_connections))
+
+    log = 'default' if server_config.get('access-log', False) else None
+
+    host = server_config['host']
+    port = server_config['port']
+    server = WSGIServer(
+        (host, port), tile_server, backlog=server_config.get('backlog'),
+        spawn=spawn, log=log)
+
+    print 'Serving on %s:%d with gevent, rendering with %d %s workers' % (
+        host, port, render_workers, render_executor)
+    # in a greenlet, as renders are handed to the pool from the event loop
+    server.start()
+    tile_server.start_warm_up(gevent.spawn)
+    server.serve_forever()
@@ -0,0 +1,108 @@
+"""remembering requests which failed, so they aren't retried straight away
+
+a tile whose render fails, perhaps because of a query error or a bug in
+post processing, tends to fail every time, and popular tiles are asked
+for by many clients. once a tile's render has failed, further requests
+for it are answered with an error without rendering, at first for a
+short while, then for twice as long after each failure since the last
+success. layer specs naming unknown layers are remembered in the same
+way, for a fixed time.
+
+this is kept per process, and only the most recent entries are kept.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class FailureEntry(object):
+
+    def __init__(self):
+        self.failures = 0
+        self.until = 0
+
+
+class FailureCache(object):
+
+    def __init__(self, backoff=1.0, max_backoff=300.0, not_found_ttl=60.0,
+                 max_entries=10000):
+        # seconds a tile isn't rendered for after its first failure,
+        # doubled after each failure since, up to max_backoff
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.not_found_ttl = not_found_ttl
+        self.max_entries = max_entries
+        # cache key -> FailureEntry, least recently failed first
+        self.entries = OrderedDict()
+        # layer spec -> time to forget it
+        self.not_found = OrderedDict()
+        self.lock = threading.Lock()
+        self.n_failures = 0
+        self.n_suppressed_renders = 0
+        self.n_suppressed_not_found = 0
+
+    def suppressed(self, cache_key, now=None):
+        """
+        Returns the seconds until the tile may be rendered again, or
+        None if it may be rendered now.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is None or entry.until <= now:
+                return None
+            self.n_suppressed_renders += 1
+            return entry.until - now
+
+    def record_failure(self, cache_key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.n_failures += 1
+            entry = self.entries.pop(cache_key, None)
+            if entry is None:
+                entry = FailureEntry()
+            entry.failures += 1
+            backoff = min(self.max_backoff,
+                          self.backoff * 2 ** min(entry.failures - 1, 32))
+            entry.until = now + backoff
+            self.entries[cache_key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return backoff
+
+    def record_success(self, cache_key):
+        if cache_key in self.entries:
+            with self.lock:
+                self.entries.pop(cache_key, None)
+
+    def is_not_found(self, layer_spec, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            until = self.not_found.get(layer_spec)
+            if until is None:
+                return False
+            if until <= now:
+                del self.not_found[layer_spec]
+                return False
+            self.n_suppressed_not_found += 1
+            return True
+
+    def record_not_found(self, layer_spec, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.not_found.pop(layer_spec, None)
+            self.not_found[layer_spec] = now + self.not_found_ttl
+            while len(self.not_found) > self.max_entries:
+                self.not_found.popitem(last=False)
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return dict(
+                failures=self.n_failures,
+                suppressed_renders=self.n_suppressed_renders,
+                suppressed_not_found=self.n_suppressed_not_found,
+                backing_off=sum(
+                    1 for x in self.entries.itervalues() if x.until > now),
+                not_found=len(self.not_found),
+            )
@@ -0,0 +1,424 @@
+"""where in the pyramid tiles are being asked for
+
+requests are counted by zoom, by area (the tile's ancestor at a coarse
+zoom), layers, format and how the request was answered, and separately
+by tile. there are far too many of either to count them all exactly, so
+each is counted in a count-min sketch, a fixed size table of counters
+which can overestimate but never underestimate, and only the most
+requested are kept by name.
+
+the most requested tiles and areas can be exported as json, and saved to
+a file every so often. several processes can save to the same file, each
+merging what it has with what's there. a new server can then read the
+file at startup and render the tiles which were most requested before,
+so that they're in the cache before anyone asks for them.
+"""
+from array import array
+from tilequeue.format import extension_to_format
+from werkzeug.wrappers import Response
+import copy
+import errno
+import fcntl
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class CountMinSketch(object):
+
+    def __init__(self, width=65536, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('l', [0]) * width for i in range(depth)]
+
+    def _indexes(self, key):
+        # each row's index comes from a combination of two hashes, the
+        # second mixed from the first rather than hashing the key again
+        h1 = hash(key)
+        h2 = ((h1 * 0x9e3779b1) >> 7) | 1
+        width = self.width
+        return [(h1 + i * h2) % width for i in range(self.depth)]
+
+    def add(self, key, n=1):
+        """count the key, returning its estimated count"""
+        return self.raise_to(key, n, True)
+
+    def raise_to(self, key, count, add=False):
+        """
+        Make the key's estimate at least count, or when add is true,
+        its current estimate plus count. Returns the new estimate.
+        """
+        indexes = self._indexes(key)
+        rows = self.rows
+        counts = [row[i] for row, i in zip(rows, indexes)]
+        estimate = min(counts)
+        estimate = estimate + count if add else max(estimate, count)
+        # only raise the counters which are below the new estimate, which
+        # keeps the overestimates down
+        for row, i, current in zip(rows, indexes, counts):
+            if current < estimate:
+                row[i] = estimate
+        return estimate
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+
+class TopK(object):
+    """the k keys with the highest counts seen"""
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        # (count, key) for each key in counts. counts only rise, so an
+        # entry may be lower than the key's count, and is put right when
+        # it reaches the top.
+        self.heap = []
+
+    def increment(self, key):
+        """
+        Add one to the key's count, if it's one of the top k, returning
+        whether it was.
+        """
+        counts = self.counts
+        count = counts.get(key)
+        if count is None:
+            return False
+        counts[key] = count + 1
+        return True
+
+    def update(self, key, count):
+        """
+        Set the key's count, if it's high enough to be one of the top k.
+        Returns the (key, count) pushed out to make room, if any.
+        """
+        counts = self.counts
+        if key in counts:
+            counts[key] = count
+            return None
+        if len(counts) < self.k:
+            counts[key] = count
+            heapq.heappush(self.heap, (count, key))
+            return None
+        heap = self.heap
+        while True:
+            min_count, min_key = heap[0]
+            current = counts[min_key]
+            if current == min_count:
+                break
+            heapq.heapreplace(heap, (current, min_key))
+        if count <= min_count:
+            return None
+        heapq.heapreplace(heap, (count, key))
+        del counts[min_key]
+        counts[key] = count
+        return min_key, min_count
+
+    def most_common(self):
+        return sorted(self.counts.items(), key=lambda x: (-x[1], x[0]))
+
+
+class Heatmap(object):
+
+    def __init__(self, bucket_zoom=10, top_areas=1000, top_tiles=10000,
+                 sketch_width=65536, sketch_depth=4):
+        # areas are tiles at this zoom, or the tile itself when lower
+        self.bucket_zoom = bucket_zoom
+        self.area_sketch = CountMinSketch(sketch_width, sketch_depth)
+        self.tile_sketch = CountMinSketch(sketch_width, sketch_depth)
+        self.top_areas = TopK(top_areas)
+        self.top_tiles = TopK(top_tiles)
+        # zoom -> outcome -> count, which are few enough to keep exactly
+        self.by_zoom = {}
+        self.lock = threading.Lock()
+        self.persist_path = None
+        self.persist_interval = None
+        self.persist_decay = None
+        self.persister_pid = None
+
+    def record(self, cache_key, outcome):
+        """
+        Count a request for a tile. outcome is how it was answered, such
+        as hit, miss or stale.
+        """
+        coord = cache_key.coord
+        zoom = coord.zoom
+        dz = max(zoom - self.bucket_zoom, 0)
+        extension = cache_key.fmt.extension
+        area = (zoom, coord.column >> dz, coord.row >> dz,
+                cache_key.layers, extension, outcome)
+        tile = (zoom, coord.column, coord.row, cache_key.tile_size,
+                cache_key.layers, extension)
+        if self.persist_path is not None:
+            self._check_persister()
+        with self.lock:
+            outcomes = self.by_zoom.get(zoom)
+            if outcomes is None:
+                outcomes = self.by_zoom[zoom] = {}
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            self._count(area, self.area_sketch, self.top_areas)
+            self._count(tile, self.tile_sketch, self.top_tiles)
+
+    def _count(self, key, sketch, top):
+        # keys in the top k are counted there, and only written back to
+        # the sketch when they're pushed out, which saves hashing the
+        # most requested keys into the sketch on every request
+        if top.increment(key):
+            return
+        evicted = top.update(key, sketch.add(key))
+        if evicted is not None:
+            sketch.raise_to(*evicted)
+
+    def snapshot(self):
+        with self.lock:
+            by_zoom = dict((zoom, dict(x)) for zoom, x in
+                           self.by_zoom.items())
+            areas = self.top_areas.most_common()
+            tiles = self.top_tiles.most_common()
+        return dict(
+            bucket_zoom=self.bucket_zoom,
+            by_zoom=by_zoom,
+            areas=[dict(zoom=min(zoom, self.bucket_zoom), column=column,
+                        row=row, tile_zoom=zoom, layers=layers,
+                        format=extension, outcome=outcome, count=count)
+                   for (zoom, column, row, layers, extension, outcome),
+                   count in areas],
+            tiles=[dict(zoom=zoom, column=column, row=row,
+                        tile_size=tile_size, layers=layers,
+                        format=extension, count=count)
+                   for (zoom, column, row, tile_size, layers, extension),
+                   count in tiles],
+        )
+
+    def persist_every(self, path, interval, decay=0.5):
+        """
+        Save to path every interval seconds, from a thread started in
+        each process that records requests. Entries in the file which
+        this process doesn't have are multiplied by decay each time, so
+        that tiles no longer being requested anywhere fade out.
+        """
+        self.persist_path = path
+        self.persist_interval = interval
+        self.persist_decay = decay
+
+    def _check_persister(self):
+        # threads don't survive a fork, so each process starts its own
+        pid = os.getpid()
+        if self.persister_pid == pid:
+            return
+        with self.lock:
+            if self.persister_pid == pid:
+                return
+            self.persister_pid = pid
+        thread = threading.Thread(target=self._run_persister, args=(pid,))
+        thread.daemon = True
+        thread.start()
+
+    def _run_persister(self, pid):
+        while self.persister_pid == pid:
+            time.sleep(self.persist_interval)
+            try:
+                self.persist(self.persist_path, self.persist_decay)
+            except Exception as e:
+                print 'Error saving heatmap to %s: %s' % (
+                    self.persist_path, e)
+
+    def persist(self, path, decay=0.5):
+        """merge into the file at path, creating it if need be"""
+        snapshot = self.snapshot()
+        with open(path + '.lock', 'a') as lock_file:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            try:
+                existing = load_heatmap(path)
+                if existing is not None:
+                    snapshot = merge_snapshots(
+                        snapshot, existing, decay, self.top_areas.k,
+                        self.top_tiles.k)
+                directory = os.path.dirname(os.path.abspath(path))
+                fd, tmp_path = tempfile.mkstemp(dir=directory)
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(snapshot, fp)
+                os.rename(tmp_path, path)
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+
+def _entry_key(entry):
+    return tuple(sorted((k, v) for k, v in entry.items() if k != 'count'))
+
+
+def _merge_entries(ours, theirs, decay, limit):
+    counts = {}
+    for entry in theirs:
+        counts[_entry_key(entry)] = entry['count'] * decay
+    for entry in ours:
+        # each process counts from when it started, so the larger of the
+        # two is the better guess of how popular the entry is
+        key = _entry_key(entry)
+        counts[key] = max(counts.get(key, 0), entry['count'])
+    merged = sorted(counts.items(), key=lambda x: -x[1])[:limit]
+    return [dict(fields, count=int(count)) for fields, count in merged
+            if count >= 1]
+
+
+def merge_snapshots(ours, theirs, decay, max_areas, max_tiles):
+    by_zoom = {}
+    for zoom, outcomes in theirs['by_zoom'].items():
+        by_zoom[int(zoom)] = dict(
+            (outcome, int(count * decay)) for outcome, count in
+            outcomes.items())
+    for zoom, outcomes in ours['by_zoom'].items():
+        merged = by_zoom.setdefault(int(zoom), {})
+        for outcome, count in outcomes.items():
+            merged[outcome] = max(merged.get(outcome, 0), count)
+    return dict(
+        bucket_zoom=ours['bucket_zoom'],
+        by_zoom=by_zoom,
+        areas=_merge_entries(
+            ours['areas'], theirs['areas'], decay, max_areas),
+        tiles=_merge_entries(
+            ours['tiles'], theirs['tiles'], decay, max_tiles),
+    )
+
+
+def load_heatmap(path):
+    """a saved heatmap snapshot, or None if there isn't a usable one"""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def tile_paths(snapshot, path_tile_size, extensions):
+    """request paths for the tiles in a snapshot, most requested first"""
+    prefixes = dict((tile_size, prefix) for prefix, tile_size in
+                    (path_tile_size or {}).items())
+    paths = []
+    for tile in snapshot['tiles']:
+        if tile['format'] not in extensions:
+            continue
+        if tile['format'] not in extension_to_format:
+            continue
+        tile_size = tile['tile_size']
+        if tile_size == 1:
+            prefix = ''
+        elif tile_size in prefixes:
+            prefix = '/%s' % prefixes[tile_size]
+        else:
+            continue
+        paths.append('%s/%s/%d/%d/%d.%s' % (
+            prefix, tile['layers'], tile['zoom'], tile['column'],
+            tile['row'], tile['format']))
+    return paths
+
+
+def warm_up(tile_server, paths, concurrency=1):
+    """
+    Request each path from the tile server, so that any which aren't
+    cached are rendered. Returns the number of each response status.
+    """
+    from werkzeug.test import EnvironBuilder
+    from werkzeug.test import run_wsgi_app
+
+    # these aren't real requests, so shouldn't count towards the heatmap.
+    # real requests are served alongside, so they go to a copy of the
+    # server which shares everything else with it.
+    tile_server = copy.copy(tile_server)
+    tile_server.heatmap = None
+    statuses = {}
+
+    def request(path):
+        environ = EnvironBuilder(path=path).get_environ()
+        app_iter, status, headers = run_wsgi_app(tile_server, environ)
+        for chunk in app_iter:
+            pass
+        return status
+
+    if concurrency > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(concurrency)
+        try:
+            results = pool.map(request, paths)
+        finally:
+            pool.close()
+    else:
+        results = map(request, paths)
+    for status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return statuses
+
+
+class WarmUp(object):
+    """
+    Renders the tiles most requested in a saved heatmap, in the
+    background once the server is running.
+    """
+
+    def __init__(self, path, n_tiles, concurrency=1):
+        self.path = path
+        self.n_tiles = n_tiles
+        self.concurrency = concurrency
+        self.lock_file = None
+
+    def _claim(self):
+        # only one of the processes sharing the file warms up. the lock is
+        # kept for as long as the process lives, so that workers started
+        # later don't warm up all over again.
+        lock_file = open(self.path + '.warm-up.lock', 'a')
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            lock_file.close()
+            if e.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def run(self, tile_server):
+        try:
+            if not self._claim():
+                return
+            snapshot = load_heatmap(self.path)
+            if snapshot is None:
+                return
+            paths = tile_paths(snapshot, tile_server.path_tile_size,
+                               tile_server.extensions)[:self.n_tiles]
+            start = time.time()
+            statuses = warm_up(tile_server, paths, self.concurrency)
+            print 'Warm-up: requested %d tiles in %.1fs: %s' % (
+                len(paths), time.time() - start, ', '.join(
+                    '%s=%d' % x for x in sorted(statuses.items())))
+        except Exception as e:
+            print 'Error warming up from %s: %s' % (self.path, e)
+
+    def start(self, tile_server, spawn=None):
+        """
+        Start warming up, with spawn, which is given the function to run
+        and its argument, or by default in a daemon thread.
+        """
+        if spawn is not None:
+            return spawn(self.run, tile_server)
+        thread = threading.Thread(target=self.run, args=(tile_server,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class HeatmapHandler(object):
+    """exports the heatmap as json"""
+
+    def __init__(self, url, heatmap):
+        self.url = url
+        self.heatmap = heatmap
+
+    def is_heatmap_request(self, request):
+        return request.path == self.url
+
+    def __call__(self, request):
+        return Response(json.dumps(self.heatmap.snapshot()),
+                        mimetype='application/json')
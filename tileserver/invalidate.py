@@ -0,0 +1,78 @@
+"""invalidate areas of the tile cache
+
+areas can be given as bounding boxes in longitude and latitude, or as a
+tile expiry list such as the one written by osm2pgsql, with one z/x/y
+coordinate per line. this needs invalidation to be enabled in the cache
+configuration.
+"""
+from ModestMaps.Core import Coordinate
+from tileserver import create_cache_from_config
+from tileserver.cache import InvalidatingCache
+import argparse
+import sys
+import yaml
+
+
+def read_expiry_coords(fp, max_zoom=None):
+    """parse z/x/y coordinates, one per line, capped at max_zoom"""
+    for line in fp:
+        line = line.strip()
+        if not line:
+            continue
+        zoom, column, row = map(int, line.split('/'))
+        if max_zoom is not None and zoom > max_zoom:
+            dz = zoom - max_zoom
+            zoom, column, row = max_zoom, column >> dz, row >> dz
+        yield Coordinate(zoom=zoom, column=column, row=row)
+
+
+def parse_bounds(bounds_str):
+    bounds = tuple(float(x) for x in bounds_str.split(','))
+    if len(bounds) != 4:
+        raise argparse.ArgumentTypeError(
+            'Bounds should be min_lon,min_lat,max_lon,max_lat')
+    return bounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('config', help='path to the tileserver config')
+    parser.add_argument('--bounds', type=parse_bounds, action='append',
+                        default=[],
+                        help='min_lon,min_lat,max_lon,max_lat to invalidate, '
+                        'may be given more than once')
+    parser.add_argument('--expiry-file', action='append', default=[],
+                        help='file of z/x/y tiles to invalidate, or - for '
+                        'stdin. may be given more than once')
+    parser.add_argument('--min-zoom', type=int, default=0,
+                        help='lowest zoom to invalidate')
+    parser.add_argument('--max-zoom', type=int,
+                        help='highest zoom to invalidate')
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        config = yaml.load(fp)
+    cache = create_cache_from_config(config)
+    if not isinstance(cache, InvalidatingCache):
+        print 'Invalidation is not enabled in the cache configuration'
+        sys.exit(1)
+
+    n_counters = 0
+    for bounds in args.bounds:
+        n_counters += cache.invalidate_bounds(
+            bounds, args.min_zoom, args.max_zoom)
+
+    for expiry_path in args.expiry_file:
+        if expiry_path == '-':
+            coords = read_expiry_coords(sys.stdin, args.max_zoom)
+            n_counters += cache.invalidate_coords(coords, args.min_zoom)
+        else:
+            with open(expiry_path) as fp:
+                coords = read_expiry_coords(fp, args.max_zoom)
+                n_counters += cache.invalidate_coords(coords, args.min_zoom)
+
+    print 'Updated %d generation counters' % n_counters
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""accounting for the memory that renders use
+
+python 2 has no way to ask how much a piece of code allocated, so this
+estimates a render's peak from the size of the rows fetched for it, and
+the size of its output. the rows are measured directly; the geometries
+built from them live in GEOS, out of python's sight, so the stages after
+fetching are taken to be a multiple of the rows' size.
+
+a budget limits how much all the renders in a process may be estimated
+to use at once. each render reserves what renders at its zoom have
+recently needed before it starts, and the rest once its rows are known.
+renders wait in turn for memory to become free, and those which could
+never fit, or wait too long, are rejected. a render which needs to grow
+while everything else is held by renders also waiting to grow is
+rejected straight away, as none of them could finish to free any.
+"""
+from collections import namedtuple
+import sys
+import threading
+import time
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+def estimate_size(obj):
+    """rough number of bytes held by a structure of python objects"""
+    total = 0
+    stack = [obj]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, (str, unicode, buffer, bytearray)):
+            total += len(x)
+        elif isinstance(x, dict):
+            total += sys.getsizeof(x)
+            stack.extend(x.iterkeys())
+            stack.extend(x.itervalues())
+        elif isinstance(x, (list, tuple, set, frozenset)):
+            total += sys.getsizeof(x)
+            stack.extend(x)
+        else:
+            total += sys.getsizeof(x)
+    return total
+
+
+ZoomMemoryStats = namedtuple(
+    'ZoomMemoryStats', 'renders average_bytes max_bytes rejected')
+
+
+class MemoryBudget(object):
+
+    # weight given to each new render in the per zoom average
+    alpha = 0.2
+
+    def __init__(self, limit=None, wait_timeout=10, source_expansion=3.0):
+        # bytes that all renders may be estimated to use at once, or None
+        # to only record what they use
+        self.limit = limit
+        self.wait_timeout = wait_timeout
+        # how much bigger the processed features are than the rows they
+        # were built from
+        self.source_expansion = source_expansion
+        self.in_use = 0
+        # bytes held by renders waiting to grow their reservations
+        self.growing = 0
+        self.cond = threading.Condition()
+        # zoom -> moving average of estimated peak, max peak, renders
+        self.average_bytes = {}
+        self.max_bytes = {}
+        self.renders = {}
+        self.rejected = {}
+
+    def _acquire(self, n_bytes, zoom, held=0):
+        # called with the condition held. held is what the caller already
+        # has, which it can't wait on others to give back.
+        if self.limit is None or n_bytes <= 0:
+            self.in_use += n_bytes
+            return
+        if held + n_bytes > self.limit:
+            self.rejected[zoom] = self.rejected.get(zoom, 0) + 1
+            raise MemoryBudgetExceeded(
+                'Render needs %d bytes, more than the budget of %d' % (
+                    held + n_bytes, self.limit))
+        if (held and self.in_use + n_bytes > self.limit and
+                self.in_use - held <= self.growing):
+            # the rest is held by renders which are waiting on us
+            self.rejected[zoom] = self.rejected.get(zoom, 0) + 1
+            raise MemoryBudgetExceeded(
+                'Render needs %d more bytes, held by renders waiting to '
+                'grow' % n_bytes)
+        self.growing += held
+        try:
+            deadline = time.time() + self.wait_timeout
+            while (self.in_use + n_bytes > self.limit and
+                   self.in_use > held):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.rejected[zoom] = self.rejected.get(zoom, 0) + 1
+                    raise MemoryBudgetExceeded(
+                        'Timed out waiting for %d bytes' % n_bytes)
+                self.cond.wait(remaining)
+        finally:
+            self.growing -= held
+        self.in_use += n_bytes
+
+    def _release(self, n_bytes):
+        with self.cond:
+            self.in_use -= n_bytes
+            self.cond.notify_all()
+
+    def reserve(self, zoom):
+        """
+        Reserve what renders at this zoom have recently needed, waiting
+        for it if need be. Returns a MemoryReservation to be released
+        when the render is done.
+        """
+        with self.cond:
+            expected = int(self.average_bytes.get(zoom, 0))
+            # the average is only a guess, and may be over the limit when
+            # recent renders' output took them over it. the render is
+            # only rejected once its own rows are known to be too big,
+            # otherwise nothing at this zoom could ever bring it down.
+            if self.limit is not None:
+                expected = min(expected, self.limit)
+            self._acquire(expected, zoom)
+        return MemoryReservation(self, zoom, expected)
+
+    def record(self, zoom, peak_bytes):
+        with self.cond:
+            average = self.average_bytes.get(zoom)
+            if average is None:
+                self.average_bytes[zoom] = float(peak_bytes)
+            else:
+                self.average_bytes[zoom] = (
+                    average + self.alpha * (peak_bytes - average))
+            self.max_bytes[zoom] = max(self.max_bytes.get(zoom, 0),
+                                       peak_bytes)
+            self.renders[zoom] = self.renders.get(zoom, 0) + 1
+
+    def stats(self):
+        with self.cond:
+            by_zoom = {}
+            for zoom in set(self.renders) | set(self.rejected):
+                by_zoom[zoom] = ZoomMemoryStats(
+                    self.renders.get(zoom, 0),
+                    int(self.average_bytes.get(zoom, 0)),
+                    self.max_bytes.get(zoom, 0),
+                    self.rejected.get(zoom, 0))._asdict()
+            return dict(
+                limit=self.limit,
+                in_use=self.in_use,
+                by_zoom=by_zoom,
+            )
+
+
+class MemoryReservation(object):
+    """memory held by one render, grown as its needs become known"""
+
+    def __init__(self, budget, zoom, n_bytes):
+        self.budget = budget
+        self.zoom = zoom
+        self.n_bytes = n_bytes
+        self.peak_bytes = 0
+
+    def source_fetched(self, source_rows):
+        """
+        Account for the rows fetched for the render, reserving more if
+        they need more than was expected. Raises MemoryBudgetExceeded if
+        that can't be had.
+        """
+        source_bytes = estimate_size(source_rows)
+        self.peak_bytes = int(source_bytes * self.budget.source_expansion)
+        self.grow(self.peak_bytes)
+        return source_bytes
+
+    def output_formatted(self, output_bytes):
+        # the formatted output and the processed features are both held
+        # while the last layer is formatted
+        self.peak_bytes += output_bytes
+
+    def grow(self, n_bytes):
+        extra = n_bytes - self.n_bytes
+        if extra <= 0:
+            return
+        with self.budget.cond:
+            self.budget._acquire(extra, self.zoom, self.n_bytes)
+            self.n_bytes = n_bytes
+
+    def release(self, completed=True):
+        if completed:
+            self.budget.record(self.zoom, self.peak_bytes)
+        self.budget._release(self.n_bytes)
+        self.n_bytes = 0
@@ -0,0 +1,132 @@
+"""pre-fork server mode
+
+configuration is loaded and compiled once in the master process, which
+then binds the listening socket and forks a number of workers to accept
+connections on it. the workers share the compiled configuration, and any
+shared memory cache, with the master copy-on-write. workers that exit are
+replaced until the master is told to stop, waiting longer each time
+workers keep exiting soon after starting, so that a worker which can
+never start doesn't take the master's time respawning it.
+"""
+from multiprocessing import cpu_count
+import errno
+import os
+import signal
+import socket
+import time
+
+
+# workers which exit sooner than this after starting count as failing
+# to start, and their replacements are delayed
+MIN_UPTIME = 10.0
+# seconds to wait before replacing the first worker to fail to start,
+# doubled for each since a worker last ran for long enough
+RESPAWN_BACKOFF = 0.5
+MAX_RESPAWN_DELAY = 60.0
+
+
+def describe_exit(status):
+    """describe a status returned by os.wait"""
+    if os.WIFSIGNALED(status):
+        return 'was killed by signal %d' % os.WTERMSIG(status)
+    if os.WIFEXITED(status):
+        return 'exited with code %d' % os.WEXITSTATUS(status)
+    return 'stopped with status %d' % status
+
+
+def respawn_delay(n_quick_exits):
+    """seconds to wait before replacing a worker, after quick exits"""
+    if n_quick_exits <= 0:
+        return 0
+    return min(RESPAWN_BACKOFF * 2 ** (n_quick_exits - 1),
+               MAX_RESPAWN_DELAY)
+
+
+def _run_worker(tile_server, listen_socket, server_config):
+    from werkzeug.serving import make_server
+
+    # the master's thread pools didn't survive the fork
+    tile_server.reset_io()
+
+    server = make_server(
+        server_config['host'], server_config['port'], tile_server,
+        threaded=server_config.get('threaded', False),
+        fd=listen_socket.fileno())
+    # only one worker warms up, see WarmUp
+    tile_server.start_warm_up()
+    server.serve_forever()
+
+
+def serve_prefork(tile_server, server_config):
+    """serve the tile server from forked workers until interrupted"""
+    n_workers = int(server_config.get('workers') or cpu_count())
+    host = server_config['host']
+    port = server_config['port']
+
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((host, port))
+    listen_socket.listen(int(server_config.get('backlog') or 128))
+
+    # pid -> time started
+    workers = {}
+    stopping = []
+    # workers which have exited soon after starting, since one last ran
+    # for long enough
+    quick_exits = 0
+
+    def spawn_worker():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            exit_code = 0
+            try:
+                _run_worker(tile_server, listen_socket, server_config)
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        workers[pid] = time.time()
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(n_workers):
+        spawn_worker()
+    print 'Serving on %s:%d with %d worker processes' % (
+        host, port, n_workers)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        started = workers.pop(pid, None)
+        if stopping or started is None:
+            continue
+        if time.time() - started < MIN_UPTIME:
+            quick_exits += 1
+        else:
+            quick_exits = 0
+        delay = respawn_delay(quick_exits)
+        print 'Worker %d %s, replacing it in %.1fs' % (
+            pid, describe_exit(status), delay)
+        # cut short by a signal to stop
+        time.sleep(delay)
+        if not stopping:
+            spawn_worker()
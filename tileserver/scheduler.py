@@ -0,0 +1,221 @@
+"""a shared limit on the layer queries running at once
+
+tilequeue's data fetcher sends every layer's query to its io pool at
+once, so with a pool per render, or a pool sized to the number of layers,
+concurrent renders multiply the queries sent to the database. this
+stands in for that pool, and all renders in the process share it. it
+runs as many queries at once as the database seems able to take: the
+limit grows by one for each round of queries which finish in good time,
+and is cut back when they slow down to well beyond what's usual for that
+layer and zoom, or fail.
+
+it also keeps the time taken and rows returned by each layer's queries,
+by zoom, to show which queries renders spend their time on.
+"""
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import collections
+import sys
+import threading
+import time
+
+
+_local = threading.local()
+
+
+@contextmanager
+def query_zoom(zoom):
+    """label queries sent from this thread with the zoom being rendered"""
+    previous = getattr(_local, 'zoom', None)
+    _local.zoom = zoom
+    try:
+        yield
+    finally:
+        _local.zoom = previous
+
+
+class ScheduledQuery(object):
+    """a query waiting for, or given, a place to run
+
+    this has the get() of the AsyncResult that a pool would return."""
+
+    def __init__(self, fn, args, layer_name, zoom):
+        self.fn = fn
+        self.args = args
+        self.layer_name = layer_name
+        self.zoom = zoom
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+        # the limit adjustment in force when the query started
+        self.epoch = None
+
+    def get(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise Exception('Timed out waiting for query')
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class QueryStats(object):
+
+    def __init__(self):
+        self.queries = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_rows = 0
+        # a slowly rising minimum, what the query takes when the
+        # database isn't busy
+        self.baseline = None
+
+    def as_dict(self):
+        return dict(
+            queries=self.queries,
+            errors=self.errors,
+            total_ms=self.total_time * 1000.0,
+            mean_ms=(self.total_time * 1000.0 / self.queries
+                     if self.queries else None),
+            max_ms=self.max_time * 1000.0,
+            mean_rows=(float(self.total_rows) / self.queries
+                       if self.queries else None),
+        )
+
+
+def _layer_name(args):
+    # tilequeue passes the query's layer datum along with it
+    for arg in args:
+        if isinstance(arg, dict) and 'name' in arg:
+            return arg['name']
+    return None
+
+
+def _row_count(value):
+    # and returns the rows first
+    if isinstance(value, tuple) and value and isinstance(value[0], list):
+        return len(value[0])
+    return 0
+
+
+class QueryScheduler(object):
+    """a thread pool whose concurrency follows database latency
+
+    used in place of the io pool given to tilequeue's data fetcher,
+    through apply_async."""
+
+    # how fast the baseline follows queries which are slower than it
+    baseline_alpha = 0.01
+    # query times below this are treated as equal
+    min_time = 0.01
+
+    def __init__(self, min_limit=2, max_limit=64, initial_limit=None,
+                 tolerance=2.0, backoff=0.75):
+        assert 1 <= min_limit <= max_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(
+            min(max(initial_limit or min_limit, min_limit), max_limit))
+        # queries slower than tolerance times their baseline mean the
+        # database is struggling
+        self.tolerance = tolerance
+        # what the limit is multiplied by when it is
+        self.backoff = backoff
+        self.pool = ThreadPool(max_limit)
+        self.lock = threading.Lock()
+        self.waiting = collections.deque()
+        self.n_running = 0
+        # only queries started since the last cut can cut the limit
+        # again, so that one slow round doesn't cut it many times over
+        self.epoch = 0
+        # (layer name, zoom) -> QueryStats
+        self.query_stats = {}
+
+    def apply_async(self, fn, args=()):
+        query = ScheduledQuery(
+            fn, args, _layer_name(args), getattr(_local, 'zoom', None))
+        with self.lock:
+            self.waiting.append(query)
+            to_start = self._take_startable()
+        self._start(to_start)
+        return query
+
+    def _take_startable(self):
+        # called with the lock held
+        to_start = []
+        while self.waiting and self.n_running < int(self.limit):
+            query = self.waiting.popleft()
+            query.epoch = self.epoch
+            self.n_running += 1
+            to_start.append(query)
+        return to_start
+
+    def _start(self, queries):
+        for query in queries:
+            self.pool.apply_async(self._run, (query,))
+
+    def _run(self, query):
+        start = time.time()
+        try:
+            query.value = query.fn(*query.args)
+        except Exception:
+            query.exc_info = sys.exc_info()
+        elapsed = time.time() - start
+        to_start = self._finished(query, elapsed)
+        query.done.set()
+        self._start(to_start)
+
+    def _finished(self, query, elapsed):
+        # records the query and adjusts the limit, returning the queries
+        # which can start now there's room
+        with self.lock:
+            # only grow the limit if it's being used
+            was_full = self.n_running >= int(self.limit)
+            self.n_running -= 1
+            congested = self._record(query, elapsed)
+            if congested:
+                if query.epoch == self.epoch:
+                    self.limit = max(
+                        self.min_limit, self.limit * self.backoff)
+                    self.epoch += 1
+            elif was_full:
+                # about one more for each limit's worth of queries
+                self.limit = min(
+                    self.max_limit, self.limit + 1.0 / self.limit)
+            return self._take_startable()
+
+    def _record(self, query, elapsed):
+        # called with the lock held, returns whether the query suggests
+        # the database is overloaded
+        key = (query.layer_name, query.zoom)
+        stats = self.query_stats.get(key)
+        if stats is None:
+            stats = self.query_stats[key] = QueryStats()
+        stats.queries += 1
+        if query.exc_info is not None:
+            stats.errors += 1
+            return True
+
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        stats.total_rows += _row_count(query.value)
+
+        baseline = stats.baseline
+        if baseline is None or elapsed < baseline:
+            stats.baseline = elapsed
+            return False
+        stats.baseline += self.baseline_alpha * (elapsed - baseline)
+        return elapsed > self.tolerance * max(baseline, self.min_time)
+
+    def stats(self):
+        with self.lock:
+            layers = {}
+            for (layer_name, zoom), stats in self.query_stats.items():
+                by_zoom = layers.setdefault(layer_name, {})
+                by_zoom[zoom] = stats.as_dict()
+            return dict(
+                limit=int(self.limit),
+                running=self.n_running,
+                waiting=len(self.waiting),
+                layers=layers,
+            )
@@ -0,0 +1,529 @@
+"""replay tile access logs through models of the tile cache
+
+each request in the logs is parsed the way the server would, into the
+key it would be cached under, and played through in-memory models of
+caches with different eviction policies and sizes. for each model this
+reports the hit ratio, the byte hit ratio and the number of renders the
+misses would have caused, over each interval of the logs and overall.
+
+logs are read a line at a time, so can be as long as need be, and may be
+gzipped. lines are expected in the common or combined log format, or
+as written by the gevent or werkzeug servers, with the response size used
+as the size of the tile. lines whose time can't be read are skipped, and
+counted at the end.
+
+policies are given as name:size, with sizes in bytes or with a K, M or G
+suffix. ttl takes the expiry in seconds and optionally a size, to model
+the redis cache's expires.
+
+    lru:1G  lfu:512M  gdsf:1G  ttl:900  ttl:900:2G  unbounded
+"""
+from collections import Counter
+from collections import OrderedDict
+from datetime import datetime
+from tileserver import LayerConfig
+from tileserver import parse_layer_spec
+from tileserver import parse_request_path
+from tileserver.cache import CacheKey
+import argparse
+import gzip
+import heapq
+import re
+import sys
+import yaml
+
+
+class CacheModel(object):
+    """
+    A cache which only keeps track of what it holds and how big it is.
+    access() returns whether the tile was held, and adds it if not.
+    """
+
+    def __init__(self, capacity=None):
+        # total bytes which can be held, or None for no limit
+        self.capacity = capacity
+        self.used = 0
+
+    def access(self, key, size, now):
+        raise NotImplementedError()
+
+
+class UnboundedModel(CacheModel):
+    """keeps everything, the best any policy could do"""
+
+    def __init__(self):
+        super(UnboundedModel, self).__init__()
+        self.keys = set()
+
+    def access(self, key, size, now):
+        if key in self.keys:
+            return True
+        self.keys.add(key)
+        self.used += size
+        return False
+
+
+class LRUModel(CacheModel):
+
+    def __init__(self, capacity):
+        super(LRUModel, self).__init__(capacity)
+        self.entries = OrderedDict()
+
+    def access(self, key, size, now):
+        entry_size = self.entries.pop(key, None)
+        if entry_size is not None:
+            self.entries[key] = entry_size
+            return True
+        if size > self.capacity:
+            return False
+        while self.used + size > self.capacity:
+            _, evicted_size = self.entries.popitem(last=False)
+            self.used -= evicted_size
+        self.entries[key] = size
+        self.used += size
+        return False
+
+
+class LFUModel(CacheModel):
+    """evicts the least often used tile, the least recent among equals"""
+
+    def __init__(self, capacity):
+        super(LFUModel, self).__init__(capacity)
+        # key -> (size, count)
+        self.entries = {}
+        # count -> keys with that count, oldest first
+        self.by_count = {}
+        self.min_count = 0
+
+    def _bump(self, key, size, count):
+        keys = self.by_count[count]
+        del keys[key]
+        if not keys:
+            del self.by_count[count]
+            if self.min_count == count:
+                self.min_count = count + 1
+        self.entries[key] = (size, count + 1)
+        self.by_count.setdefault(count + 1, OrderedDict())[key] = None
+
+    def access(self, key, size, now):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self._bump(key, *entry)
+            return True
+        if size > self.capacity:
+            return False
+        while self.used + size > self.capacity:
+            keys = self.by_count[self.min_count]
+            evicted, _ = keys.popitem(last=False)
+            if not keys:
+                del self.by_count[self.min_count]
+                self.min_count = min(self.by_count) if self.by_count else 0
+            self.used -= self.entries.pop(evicted)[0]
+        self.entries[key] = (size, 1)
+        self.by_count.setdefault(1, OrderedDict())[key] = None
+        self.min_count = 1
+        self.used += size
+        return False
+
+
+class TTLModel(LRUModel):
+    """
+    Tiles expire a fixed time after they were stored, whether or not they
+    were read since, as with the redis cache. With a capacity, the least
+    recently used are evicted to make room, as with redis' allkeys-lru.
+    """
+
+    def __init__(self, ttl, capacity=None):
+        super(TTLModel, self).__init__(capacity)
+        self.ttl = ttl
+        # (expiry time, key) in the order stored, which is also the
+        # order they expire in
+        self.expiries = []
+        self.expiries_start = 0
+        # key -> expiry time, for telling stale entries in expiries
+        self.expires_at = {}
+
+    def _expire(self, now):
+        expiries = self.expiries
+        i = self.expiries_start
+        while i < len(expiries) and expiries[i][0] <= now:
+            expires_at, key = expiries[i]
+            if self.expires_at.get(key) == expires_at:
+                del self.expires_at[key]
+                # unless it was already evicted to make room
+                size = self.entries.pop(key, None)
+                if size is not None:
+                    self.used -= size
+            i += 1
+        # drop the expired part of the list once it's most of it
+        if i > 1024 and i > len(expiries) // 2:
+            del expiries[:i]
+            i = 0
+        self.expiries_start = i
+
+    def access(self, key, size, now):
+        self._expire(now)
+        if self.capacity is None:
+            if key in self.entries:
+                return True
+            self.entries[key] = size
+            self.used += size
+        else:
+            if super(TTLModel, self).access(key, size, now):
+                return True
+            if key not in self.entries:
+                # too big to be kept
+                return False
+        expires_at = now + self.ttl
+        self.expires_at[key] = expires_at
+        self.expiries.append((expires_at, key))
+        return False
+
+
+class GDSFModel(CacheModel):
+    """
+    Greedy dual size frequency: each tile's priority is how often it has
+    been used divided by its size, plus an inflation value which rises
+    as tiles are evicted, so that tiles which were once popular age out.
+    The lowest priority is evicted first. Small popular tiles are kept in
+    preference to large ones, favouring the hit ratio over the byte hit
+    ratio.
+    """
+
+    def __init__(self, capacity):
+        super(GDSFModel, self).__init__(capacity)
+        # key -> (priority, size, count)
+        self.entries = {}
+        # (priority, sequence, key), including out of date entries which
+        # are skipped over when they come up
+        self.heap = []
+        self.inflation = 0.0
+        self.sequence = 0
+
+    def _push(self, key, size, count):
+        priority = self.inflation + float(count) / size
+        self.entries[key] = (priority, size, count)
+        self.sequence += 1
+        heapq.heappush(self.heap, (priority, self.sequence, key))
+        # rebuild the heap when it's mostly out of date entries
+        if len(self.heap) > 2 * len(self.entries) + 1024:
+            self.heap = [(p, i, k) for i, (k, (p, _, _))
+                         in enumerate(self.entries.iteritems())]
+            heapq.heapify(self.heap)
+
+    def access(self, key, size, now):
+        size = max(size, 1)
+        entry = self.entries.get(key)
+        if entry is not None:
+            _, entry_size, count = entry
+            self._push(key, entry_size, count + 1)
+            return True
+        if size > self.capacity:
+            return False
+        while self.used + size > self.capacity:
+            priority, _, evicted = heapq.heappop(self.heap)
+            entry = self.entries.get(evicted)
+            if entry is None or entry[0] != priority:
+                continue
+            self.inflation = priority
+            self.used -= entry[1]
+            del self.entries[evicted]
+        self._push(key, size, 1)
+        self.used += size
+        return False
+
+
+def parse_size(size_str):
+    multipliers = dict(K=1024, M=1024 ** 2, G=1024 ** 3)
+    size_str = size_str.strip().upper()
+    if size_str[-1:] in multipliers:
+        return int(float(size_str[:-1]) * multipliers[size_str[-1]])
+    return int(size_str)
+
+
+def create_model(policy_str):
+    """create a cache model from a description such as lru:1G"""
+    parts = policy_str.split(':')
+    name = parts[0].lower()
+    if name == 'unbounded' and len(parts) == 1:
+        return UnboundedModel()
+    elif name == 'lru' and len(parts) == 2:
+        return LRUModel(parse_size(parts[1]))
+    elif name == 'lfu' and len(parts) == 2:
+        return LFUModel(parse_size(parts[1]))
+    elif name == 'gdsf' and len(parts) == 2:
+        return GDSFModel(parse_size(parts[1]))
+    elif name == 'ttl' and len(parts) in (2, 3):
+        capacity = parse_size(parts[2]) if len(parts) == 3 else None
+        return TTLModel(float(parts[1]), capacity)
+    raise ValueError('Unknown policy: %s' % policy_str)
+
+
+def parse_policy(policy_str):
+    try:
+        return policy_str, create_model(policy_str)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Unknown policy: %s' % policy_str)
+
+
+LOG_LINE_RE = re.compile(
+    r'\[(?P<time>[^\]]+)\] "(?:GET|HEAD) (?P<path>\S+)[^"]*" '
+    r'(?P<status>\d{3}) (?P<size>\d+|-)')
+
+
+# the times written by the common log format, gevent and werkzeug. any
+# timezone after them is ignored, only the time between requests matters.
+LOG_TIME_FORMATS = (
+    '%d/%b/%Y:%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S',
+    '%d/%b/%Y %H:%M:%S',
+)
+
+
+class LogParser(object):
+    """turns access log lines into cache keys, as the server would"""
+
+    max_layer_specs = 10000
+
+    def __init__(self, layer_config, extensions, path_tile_size=None,
+                 max_interesting_zoom=None, default_size=20000):
+        self.layer_config = layer_config
+        self.extensions = extensions
+        self.path_tile_size = path_tile_size or {}
+        self.max_interesting_zoom = max_interesting_zoom or 20
+        # size assumed for tiles whose size wasn't logged
+        self.default_size = default_size
+        self.layer_specs = {}
+        # timestamps repeat for every request in the same second
+        self.last_time_str = None
+        self.last_time = None
+        self.time_format = LOG_TIME_FORMATS[0]
+        self.n_unparsed = 0
+
+    def _layers(self, layer_spec):
+        layers = self.layer_specs.get(layer_spec)
+        if layers is None:
+            result = parse_layer_spec(layer_spec, self.layer_config)
+            layers = '' if result is None else ','.join(
+                result.sorted_layer_names)
+            if len(self.layer_specs) >= self.max_layer_specs:
+                self.layer_specs.clear()
+            self.layer_specs[layer_spec] = layers
+        return layers
+
+    def _parse_time(self, time_str):
+        # the format of the last line is tried first, as all lines in a
+        # log are usually the same
+        for time_format in (self.time_format,) + LOG_TIME_FORMATS:
+            # strptime won't ignore a trailing timezone by itself
+            n_parts = time_format.count(' ') + 1
+            try:
+                parsed = datetime.strptime(
+                    ' '.join(time_str.split()[:n_parts]), time_format)
+            except ValueError:
+                continue
+            self.time_format = time_format
+            return (parsed - datetime(1970, 1, 1)).total_seconds()
+        return None
+
+    def _time(self, time_str):
+        if time_str != self.last_time_str:
+            parsed = self._parse_time(time_str)
+            if parsed is None:
+                return None
+            self.last_time = parsed
+            self.last_time_str = time_str
+        return self.last_time
+
+    def parse(self, line):
+        """
+        Returns (time, cache key, size) for a tile request that the server
+        would have answered from the cache, or None for anything else.
+        """
+        match = LOG_LINE_RE.search(line)
+        if match is None or match.group('status') not in ('200', '304'):
+            return None
+        path = match.group('path').split('?', 1)[0]
+        request_data = parse_request_path(
+            path, self.extensions, self.path_tile_size,
+            self.max_interesting_zoom)
+        if request_data is None:
+            return None
+        layers = self._layers(request_data.layer_spec)
+        if not layers:
+            return None
+
+        size_str = match.group('size')
+        if match.group('status') == '200' and size_str != '-':
+            size = int(size_str)
+        else:
+            size = self.default_size
+        now = self._time(match.group('time'))
+        if now is None:
+            self.n_unparsed += 1
+            return None
+        cache_key = CacheKey(request_data.coord, request_data.tile_size,
+                             layers, request_data.format)
+        return now, cache_key, size
+
+
+def model_key(cache_key):
+    # much smaller than the cache key itself, which matters when there
+    # are millions held
+    coord = cache_key.coord
+    return (coord.zoom, coord.column, coord.row, cache_key.tile_size,
+            cache_key.layers, cache_key.fmt.extension)
+
+
+class PolicyStats(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.hits = 0
+        self.bytes = 0
+        self.hit_bytes = 0
+
+    def add(self, hit, size):
+        self.requests += 1
+        self.bytes += size
+        if hit:
+            self.hits += 1
+            self.hit_bytes += size
+
+    def add_stats(self, other):
+        self.requests += other.requests
+        self.bytes += other.bytes
+        self.hits += other.hits
+        self.hit_bytes += other.hit_bytes
+
+    def format(self, seconds):
+        renders = self.requests - self.hits
+        return 'hits=%5.1f%% byte_hits=%5.1f%% renders=%d (%.2f/s)' % (
+            100.0 * self.hits / max(self.requests, 1),
+            100.0 * self.hit_bytes / max(self.bytes, 1),
+            renders, float(renders) / max(seconds, 1))
+
+
+class Simulation(object):
+    """plays requests through several cache models side by side"""
+
+    def __init__(self, models, interval=3600, out=sys.stdout):
+        # list of (name, model)
+        self.models = models
+        self.interval = interval
+        self.out = out
+        self.totals = [PolicyStats() for x in models]
+        self.current = [PolicyStats() for x in models]
+        self.interval_start = None
+        self.start = None
+        self.last = None
+        self.tile_sizes = Counter()
+        self.layer_specs = Counter()
+
+    def _report(self, title, stats, seconds):
+        print >>self.out, '%s: %d requests' % (title, stats[0].requests)
+        for (name, model), x in zip(self.models, stats):
+            print >>self.out, '  %-16s %s used=%d' % (
+                name, x.format(seconds), model.used)
+
+    def _report_interval(self, seconds):
+        start = datetime.utcfromtimestamp(self.interval_start)
+        self._report(start.isoformat(), self.current, seconds)
+        for total, current in zip(self.totals, self.current):
+            total.add_stats(current)
+        self.current = [PolicyStats() for x in self.models]
+
+    def add(self, now, cache_key, size):
+        if self.start is None:
+            self.start = self.interval_start = now
+        while now >= self.interval_start + self.interval:
+            if self.current[0].requests:
+                self._report_interval(self.interval)
+            self.interval_start += self.interval
+        self.last = now
+
+        key = model_key(cache_key)
+        for (name, model), current in zip(self.models, self.current):
+            current.add(model.access(key, size, now), size)
+        self.tile_sizes[cache_key.tile_size] += 1
+        self.layer_specs[cache_key.layers] += 1
+
+    def finish(self):
+        if self.start is None:
+            print >>self.out, 'No tile requests found'
+            return
+        if self.current[0].requests:
+            self._report_interval(self.last - self.interval_start)
+        self._report('Overall', self.totals, self.last - self.start)
+        print >>self.out, 'Tile sizes: %s' % ', '.join(
+            '%s=%d' % x for x in sorted(self.tile_sizes.items()))
+        print >>self.out, 'Most requested layers: %s' % ', '.join(
+            '%s=%d' % x for x in self.layer_specs.most_common(10))
+
+
+def open_log(path):
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path)
+    return open(path)
+
+
+def layer_config_from_queries(queries_config):
+    # only the layer names are needed to parse layer specs, which saves
+    # loading everything that rendering needs
+    layer_data = [dict(name=x) for x in queries_config['layers']]
+    return LayerConfig(queries_config['all'], layer_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        epilog=__doc__.split('\n\n', 1)[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config', help='path to the tileserver config')
+    parser.add_argument('logs', nargs='+',
+                        help='access logs, in order, or - for stdin')
+    parser.add_argument('--policy', type=parse_policy, action='append',
+                        dest='policies', default=[], metavar='POLICY',
+                        help='cache policy and size to model, may be given '
+                        'more than once')
+    parser.add_argument('--interval', type=float, default=3600,
+                        help='seconds between reports')
+    parser.add_argument('--default-size', type=parse_size, default=20000,
+                        help='size of tiles whose size was not logged')
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        config = yaml.load(fp)
+    with open(config['queries']['config']) as fp:
+        queries_config = yaml.load(fp)
+
+    log_parser = LogParser(
+        layer_config_from_queries(queries_config),
+        set(config.get('formats') or ['json', 'topojson', 'mvt']),
+        config.get('path_tile_size'),
+        config.get('max_interesting_zoom'),
+        args.default_size)
+
+    policies = args.policies or [parse_policy('unbounded')]
+    simulation = Simulation(policies, args.interval)
+
+    for log_path in args.logs:
+        fp = open_log(log_path)
+        try:
+            for line in fp:
+                request = log_parser.parse(line)
+                if request is not None:
+                    simulation.add(*request)
+        finally:
+            if fp is not sys.stdin:
+                fp.close()
+    simulation.finish()
+    if log_parser.n_unparsed:
+        print 'Skipped %d requests whose time could not be read' % (
+            log_parser.n_unparsed)
+
+
+if __name__ == '__main__':
+    main()
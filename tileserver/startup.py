@@ -0,0 +1,254 @@
+"""caching of compiled configuration between server starts
+
+parsing the queries config and compiling the vector-datasource yaml into
+python functions makes up most of the time it takes to start a server.
+the results are stored on disk keyed by a hash of everything that went
+into them, so that later starts with the same inputs can load them
+instead.
+"""
+from contextlib import contextmanager
+import cPickle as pickle
+import hashlib
+import importlib
+import marshal
+import os
+import os.path
+import sys
+import tempfile
+import time
+import types
+
+
+class StartupTimer(object):
+    """records how long each phase of startup takes"""
+
+    def __init__(self):
+        self.phases = []
+        self.start_time = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        phase_start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - phase_start))
+
+    def report(self):
+        for name, duration in self.phases:
+            print 'Startup: %s took %.3fs' % (name, duration)
+        print 'Startup: total %.3fs' % (time.time() - self.start_time)
+
+
+def _package_version(name):
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution(name).version
+    except Exception:
+        return None
+
+
+def resource_paths(queries_config, cfg_path):
+    """paths of the files read by post process resources"""
+    paths = []
+    for post_process_item in queries_config.get('post_process', []):
+        resources = post_process_item.get('resources') or {}
+        for resource_name in sorted(resources):
+            resource_cfg = resources[resource_name]
+            if resource_cfg.get('type') == 'file' and resource_cfg.get('path'):
+                paths.append(os.path.join(cfg_path, resource_cfg['path']))
+    return paths
+
+
+def hash_files(paths):
+    """path -> hash of its contents, or None if it can't be read"""
+    hashes = {}
+    for path in paths:
+        try:
+            with open(path, 'rb') as fp:
+                hashes[path] = hashlib.sha1(fp.read()).hexdigest()
+        except IOError:
+            hashes[path] = None
+    return hashes
+
+
+def config_fingerprint(queries_config_path, buffer_cfg, yaml_config):
+    """hash of the inputs to the compiled configuration
+
+    the yaml files are only included when they're parsed at startup,
+    otherwise the output functions are referred to by name and any changes
+    to them are picked up when they're imported. files read by post
+    process resources are named in the queries config, which isn't parsed
+    here, so they're checked when the artifacts are loaded instead."""
+    h = hashlib.sha1()
+    h.update(sys.version)
+    for package_name in ('tilequeue', 'vectordatasource'):
+        h.update('%s=%s' % (package_name, _package_version(package_name)))
+    h.update(repr(sorted(buffer_cfg.items())))
+    h.update(repr(yaml_config))
+
+    with open(queries_config_path) as fp:
+        h.update(fp.read())
+
+    if yaml_config.get('type') == 'parse':
+        yaml_path = yaml_config['parse']['path']
+        for dirpath, dirnames, filenames in os.walk(yaml_path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.endswith('.yaml'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                h.update(os.path.relpath(path, yaml_path))
+                with open(path) as fp:
+                    h.update(fp.read())
+
+    return h.hexdigest()
+
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_code_names(const))
+    return names
+
+
+def dump_functions(fn_mapping):
+    """convert a mapping of name to function into something picklable
+
+    functions that can be found by name on import are pickled as they are.
+    functions generated at runtime, such as those compiled from yaml, are
+    stored as their bytecode along with the globals they use, as long as
+    those can in turn be pickled by name, or are modules, which are stored
+    by name and imported again. returns None if any function can't be
+    stored either way."""
+    dumped = {}
+    for name, fn in fn_mapping.items():
+        try:
+            dumped[name] = ('pickle', pickle.dumps(fn, -1))
+            continue
+        except Exception:
+            pass
+
+        if not isinstance(fn, types.FunctionType) or fn.__closure__:
+            return None
+        fn_globals = {}
+        fn_modules = {}
+        for global_name in _code_names(fn.__code__):
+            if global_name not in fn.__globals__:
+                continue
+            value = fn.__globals__[global_name]
+            if isinstance(value, types.ModuleType):
+                fn_modules[global_name] = value.__name__
+            else:
+                fn_globals[global_name] = value
+        try:
+            dumped[name] = ('code', marshal.dumps(fn.__code__),
+                            pickle.dumps(fn_globals, -1),
+                            pickle.dumps(fn.__defaults__, -1),
+                            fn_modules)
+        except Exception:
+            return None
+    return dumped
+
+
+def load_functions(dumped):
+    """inverse of dump_functions"""
+    fn_mapping = {}
+    for name, stored in dumped.items():
+        if stored[0] == 'pickle':
+            fn_mapping[name] = pickle.loads(stored[1])
+        else:
+            _, code_bytes, globals_bytes, defaults_bytes, fn_modules = stored
+            code = marshal.loads(code_bytes)
+            fn_globals = pickle.loads(globals_bytes)
+            for global_name, module_name in fn_modules.items():
+                fn_globals[global_name] = importlib.import_module(
+                    module_name)
+            fn_globals.setdefault('__builtins__', __builtins__)
+            fn_mapping[name] = types.FunctionType(
+                code, fn_globals, code.co_name, pickle.loads(defaults_bytes))
+    return fn_mapping
+
+
+# layer data lists, which share the same layer dicts
+LAYER_DATA_KEYS = ('all_layer_data', 'layer_data')
+
+
+def _without_bounds_pad_fns(artifacts):
+    # with a buffer configured, each layer's query bounds pad function is
+    # a closure over it, which can't be pickled, so it's left out and
+    # made again from the buffer config when loaded
+    copies = {}
+    stripped = {}
+    for key in LAYER_DATA_KEYS:
+        if key not in artifacts:
+            continue
+        layer_data = []
+        for layer_datum in artifacts[key]:
+            layer_copy = copies.get(id(layer_datum))
+            if layer_copy is None:
+                layer_copy = copies[id(layer_datum)] = dict(layer_datum)
+                layer_copy.pop('query_bounds_pad_fn', None)
+            layer_data.append(layer_copy)
+        stripped[key] = layer_data
+    return dict(artifacts, **stripped)
+
+
+def _add_bounds_pad_fns(artifacts):
+    from tilequeue.config import create_query_bounds_pad_fn
+
+    buffer_cfg = artifacts.get('buffer_cfg') or {}
+    for key in LAYER_DATA_KEYS:
+        for layer_datum in artifacts.get(key, []):
+            if 'query_bounds_pad_fn' not in layer_datum:
+                layer_datum['query_bounds_pad_fn'] = \
+                    create_query_bounds_pad_fn(buffer_cfg, layer_datum['name'])
+
+
+class ArtifactCache(object):
+    """stores compiled configuration in a directory, keyed by fingerprint"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _artifact_path(self, fingerprint):
+        return os.path.join(self.path, '%s.pickle' % fingerprint)
+
+    def load(self, fingerprint):
+        try:
+            with open(self._artifact_path(fingerprint), 'rb') as fp:
+                artifacts = pickle.load(fp)
+            # post process resources, such as spreadsheets, are built into
+            # the post process data, so it's out of date if they've changed
+            resource_hashes = artifacts.get('resource_hashes', {})
+            if hash_files(resource_hashes) != resource_hashes:
+                return None
+            artifacts['output_calc_mapping'] = load_functions(
+                artifacts['output_calc_mapping'])
+            _add_bounds_pad_fns(artifacts)
+            return artifacts
+        except Exception:
+            # missing, from an incompatible version or otherwise unusable,
+            # in which case everything just gets compiled again
+            return None
+
+    def store(self, fingerprint, artifacts):
+        """store the artifacts, returning whether they could be"""
+        dumped_mapping = dump_functions(artifacts['output_calc_mapping'])
+        if dumped_mapping is None:
+            return False
+        artifacts = dict(_without_bounds_pad_fns(artifacts),
+                         output_calc_mapping=dumped_mapping)
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(artifacts, fp, -1)
+            os.rename(tmp_path, self._artifact_path(fingerprint))
+        except Exception:
+            os.remove(tmp_path)
+            return False
+        return True